@@ -1,1769 +1,5417 @@
-import logging
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from datetime import datetime, time, timedelta
-import pytz
-import os
-import json
-import asyncio
-from typing import Dict, Any, List
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
-
-# Токен бота из переменных окружения Railway
-BOT_TOKEN = os.environ.get('BOT_TOKEN', '7952222222:AAHNNBA5OnoQrblwY4BO0BoETb-9jZg_z_g')
-
-# Таймзона Москвы
-MOSCOW_TZ = pytz.timezone('Europe/Moscow')
-
-# Сообщение для автоответа
-AUTO_REPLY_MESSAGE = """Здравствуйте, вы написали в нерабочее время компании!
-
-Мы отвечаем с понедельника по пятницу | c 10:00 до 19:00 по МСК
-
-**сообщение автоматическое, отвечать на него не нужно**"""
-
-# ID администраторов
-ADMIN_IDS = {7842709072, 1772492746, 1661202178, 478084322}
-
-# Файлы для сохранения данных
-FLAGS_FILE = "auto_reply_flags.json"
-WORK_CHAT_FILE = "work_chat.json"
-PENDING_MESSAGES_FILE = "pending_messages.json"
-FUNNELS_CONFIG_FILE = "funnels_config.json"
-EXCLUDED_USERS_FILE = "excluded_users.json"
-FUNNELS_STATE_FILE = "funnels_state.json"
-MASTER_NOTIFICATION_FILE = "master_notification.json"
-
-# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ГЛАВНЫМ УВЕДОМЛЕНИЕМ ==========
-
-class MasterNotificationManager:
-    def __init__(self):
-        self.data = self.load_data()
-        self.last_notification_time = None
-        self.notification_cooldown = 1800  # 15 минут в секундах
-    
-    def load_data(self) -> Dict[str, Any]:
-        """Загружает данные главного уведомления из файла"""
-        try:
-            if os.path.exists(MASTER_NOTIFICATION_FILE):
-                with open(MASTER_NOTIFICATION_FILE, 'r') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки главного уведомления: {e}")
-        return {"message_ids": [], "last_update": None}
-    
-    def save_data(self):
-        """Сохраняет данные главного уведомления в файл"""
-        try:
-            with open(MASTER_NOTIFICATION_FILE, 'w') as f:
-                json.dump(self.data, f, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения главного уведомления: {e}")
-    
-    def add_message_id(self, message_id: int):
-        """Добавляет ID сообщения в список"""
-        if "message_ids" not in self.data:
-            self.data["message_ids"] = []
-        
-        self.data["message_ids"].append(message_id)
-        self.data["last_update"] = datetime.now(MOSCOW_TZ).isoformat()
-        self.save_data()
-        logger.info(f"✅ Добавлен ID уведомления: {message_id}")
-    
-    def get_message_ids(self) -> List[int]:
-        """Возвращает список ID сообщений уведомлений"""
-        return self.data.get("message_ids", [])
-    
-    def clear_old_messages(self, keep_last: int = 3):
-        """Очищает старые сообщения, оставляя только последние"""
-        if "message_ids" in self.data and len(self.data["message_ids"]) > keep_last:
-            # Оставляем только последние keep_last сообщений
-            self.data["message_ids"] = self.data["message_ids"][-keep_last:]
-            self.save_data()
-    
-    def should_update(self) -> bool:
-        """Проверяет, нужно ли обновлять уведомление (каждые 15 минут)"""
-        # Если никогда не отправляли - отправляем
-        if not self.last_notification_time:
-            return True
-        
-        now = datetime.now(MOSCOW_TZ)
-        time_diff = now - self.last_notification_time
-        
-        return time_diff.total_seconds() >= self.notification_cooldown
-    
-    def update_notification_time(self):
-        """Обновляет время последней отправки уведомления"""
-        self.last_notification_time = datetime.now(MOSCOW_TZ)
-        logger.info(f"🕐 Обновлено время уведомления: {self.last_notification_time.strftime('%H:%M:%S')}")
-
-# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ СОСТОЯНИЕМ ВОРОНОК ==========
-
-class FunnelsStateManager:
-    def __init__(self):
-        self.state = self.load_state()
-    
-    def load_state(self) -> Dict[str, Any]:
-        """Загружает состояние воронок из файла"""
-        try:
-            if os.path.exists(FUNNELS_STATE_FILE):
-                with open(FUNNELS_STATE_FILE, 'r') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки состояния воронок: {e}")
-        
-        return {
-            "last_funnel_1_check": None,
-            "last_funnel_2_check": None, 
-            "last_funnel_3_check": None,
-            "funnel_1_messages_processed": [],
-            "funnel_2_messages_processed": [],
-            "funnel_3_messages_processed": []
-        }
-    
-    def save_state(self):
-        """Сохраняет состояние воронок в файл"""
-        try:
-            with open(FUNNELS_STATE_FILE, 'w') as f:
-                json.dump(self.state, f, indent=2, default=str)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения состояния воронок: {e}")
-    
-    def update_last_check(self, funnel_number: int):
-        """Обновляет время последней проверки для воронки"""
-        self.state[f"last_funnel_{funnel_number}_check"] = datetime.now(MOSCOW_TZ).isoformat()
-        self.save_state()
-    
-    def get_last_check(self, funnel_number: int) -> datetime:
-        """Возвращает время последней проверки для воронки"""
-        timestamp = self.state.get(f"last_funnel_{funnel_number}_check")
-        if timestamp:
-            return datetime.fromisoformat(timestamp)
-        return datetime.now(MOSCOW_TZ) - timedelta(days=1)
-    
-    def add_processed_message(self, funnel_number: int, message_key: str):
-        """Добавляет сообщение в список обработанных для воронки"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        if message_key not in self.state[key]:
-            self.state[key].append(message_key)
-            self.save_state()
-    
-    def is_message_processed(self, funnel_number: int, message_key: str) -> bool:
-        """Проверяет, было ли сообщение уже обработано воронкой"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        return message_key in self.state[key]
-    
-    def clear_processed_messages(self, funnel_number: int):
-        """Очищает список обработанных сообщений для воронки"""
-        key = f"funnel_{funnel_number}_messages_processed"
-        self.state[key] = []
-        self.save_state()
-
-# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ИСКЛЮЧЕНИЯМИ ==========
-
-class ExcludedUsersManager:
-    def __init__(self):
-        self.excluded_users = self.load_excluded_users()
-    
-    def load_excluded_users(self) -> Dict[str, Any]:
-        """Загружает список исключенных пользователей из файла"""
-        try:
-            if os.path.exists(EXCLUDED_USERS_FILE):
-                with open(EXCLUDED_USERS_FILE, 'r') as f:
-                    data = json.load(f)
-                    return data
-        except Exception as e:
-            logger.error(f"Ошибка загрузки исключенных пользователей: {e}")
-        
-        return {
-            "user_ids": [433733509, 1661202178, 478084322, 868325393, 1438860417, 879901619, 6107771545, 253353687, 2113096625, 91047831, 7842709072],
-            "usernames": []
-        }
-    
-    def save_excluded_users(self):
-        """Сохраняет список исключенных пользователей в файл"""
-        try:
-            with open(EXCLUDED_USERS_FILE, 'w') as f:
-                json.dump(self.excluded_users, f, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения исключенных пользователей: {e}")
-    
-    def is_user_excluded(self, user_id: int, username: str = None) -> bool:
-        """Проверяет, является ли пользователь исключенным"""
-        if user_id in self.excluded_users["user_ids"]:
-            return True
-        
-        if username and username.lower() in [u.lower() for u in self.excluded_users["usernames"]]:
-            return True
-        
-        return False
-    
-    def add_user_id(self, user_id: int) -> bool:
-        """Добавляет ID пользователя в исключения"""
-        if user_id not in self.excluded_users["user_ids"]:
-            self.excluded_users["user_ids"].append(user_id)
-            self.save_excluded_users()
-            logger.info(f"✅ Добавлен ID в исключения: {user_id}")
-            return True
-        return False
-    
-    def add_username(self, username: str) -> bool:
-        """Добавляет username в исключения"""
-        username = username.lstrip('@').lower()
-        if username not in [u.lower() for u in self.excluded_users["usernames"]]:
-            self.excluded_users["usernames"].append(username)
-            self.save_excluded_users()
-            logger.info(f"✅ Добавлен username в исключения: @{username}")
-            return True
-        return False
-    
-    def remove_user_id(self, user_id: int) -> bool:
-        """Удаляет ID пользователя из исключений"""
-        if user_id in self.excluded_users["user_ids"]:
-            self.excluded_users["user_ids"].remove(user_id)
-            self.save_excluded_users()
-            logger.info(f"✅ Удален ID из исключений: {user_id}")
-            return True
-        return False
-    
-    def remove_username(self, username: str) -> bool:
-        """Удаляет username из исключений"""
-        username = username.lstrip('@').lower()
-        for u in self.excluded_users["usernames"]:
-            if u.lower() == username:
-                self.excluded_users["usernames"].remove(u)
-                self.save_excluded_users()
-                logger.info(f"✅ Удален username из исключений: @{username}")
-                return True
-        return False
-    
-    def get_all_excluded(self) -> Dict[str, List]:
-        """Возвращает всех исключенных пользователей"""
-        return self.excluded_users
-    
-    def clear_all(self):
-        """Очищает все исключения"""
-        self.excluded_users = {"user_ids": [], "usernames": []}
-        self.save_excluded_users()
-        logger.info("✅ Все исключения очищены")
-
-# ========== КЛАССЫ ДЛЯ УПРАВЛЕНИЯ ДАННЫМИ ==========
-
-class FunnelsConfig:
-    def __init__(self):
-        self.funnels = self.load_funnels()
-    
-    def load_funnels(self) -> Dict[int, int]:
-        """Загружает конфигурацию воронок из файла или использует значения по умолчания"""
-        try:
-            if os.path.exists(FUNNELS_CONFIG_FILE):
-                with open(FUNNELS_CONFIG_FILE, 'r') as f:
-                    data = json.load(f)
-                    return {int(k): v for k, v in data.items()}
-        except Exception as e:
-            logger.error(f"Ошибка загрузки конфигурации воронок: {e}")
-        
-        return {
-            1: 60,    # 1 час
-            2: 180,   # 3 часа  
-            3: 300    # 5 часов
-        }
-    
-    def save_funnels(self):
-        """Сохраняет конфигурацию воронок в файл"""
-        try:
-            with open(FUNNELS_CONFIG_FILE, 'w') as f:
-                json.dump(self.funnels, f, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения конфигурации воронок: {e}")
-    
-    def get_funnels(self) -> Dict[int, int]:
-        """Возвращает текущую конфигурацию воронок"""
-        return self.funnels
-    
-    def set_funnel_interval(self, funnel_number: int, minutes: int) -> bool:
-        """Устанавливает интервал для указанной воронки"""
-        if funnel_number in [1, 2, 3] and minutes > 0:
-            self.funnels[funnel_number] = minutes
-            self.save_funnels()
-            logger.info(f"Установлен интервал для воронки {funnel_number}: {minutes} минут")
-            return True
-        return False
-    
-    def get_funnel_interval(self, funnel_number: int) -> int:
-        """Возвращает интервал для указанной воронки"""
-        return self.funnels.get(funnel_number, 0)
-    
-    def reset_to_default(self):
-        """Сбрасывает настройки воронок к значениям по умолчанию"""
-        self.funnels = {1: 60, 2: 180, 3: 300}
-        self.save_funnels()
-        logger.info("Настройки воронок сброшены к значениям по умолчанию")
-
-class AutoReplyFlags:
-    def __init__(self):
-        self.flags = self.load_flags()
-    
-    def load_flags(self) -> Dict[str, bool]:
-        try:
-            if os.path.exists(FLAGS_FILE):
-                with open(FLAGS_FILE, 'r') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки флагов: {e}")
-        return {}
-    
-    def save_flags(self):
-        try:
-            with open(FLAGS_FILE, 'w') as f:
-                json.dump(self.flags, f)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения флагов: {e}")
-    
-    def has_replied(self, key: str) -> bool:
-        return self.flags.get(key, False)
-    
-    def set_replied(self, key: str):
-        self.flags[key] = True
-        self.save_flags()
-    
-    def clear_replied(self, key: str):
-        if key in self.flags:
-            del self.flags[key]
-            self.save_flags()
-    
-    def clear_all(self):
-        self.flags = {}
-        self.save_flags()
-    
-    def count_flags(self):
-        return len(self.flags)
-
-class WorkChatManager:
-    def __init__(self):
-        self.work_chat_id = self.load_work_chat()
-    
-    def load_work_chat(self):
-        try:
-            if os.path.exists(WORK_CHAT_FILE):
-                with open(WORK_CHAT_FILE, 'r') as f:
-                    data = json.load(f)
-                    return data.get('work_chat_id')
-        except Exception as e:
-            logger.error(f"Ошибка загрузки рабочего чата: {e}")
-        return None
-    
-    def save_work_chat(self, chat_id):
-        try:
-            with open(WORK_CHAT_FILE, 'w') as f:
-                json.dump({'work_chat_id': chat_id}, f)
-            self.work_chat_id = chat_id
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка сохранения рабочего чата: {e}")
-            return False
-    
-    def get_work_chat_id(self):
-        return self.work_chat_id
-    
-    def is_work_chat_set(self):
-        return self.work_chat_id is not None
-
-class PendingMessagesManager:
-    def __init__(self, funnels_config: FunnelsConfig):
-        self.pending_messages = self.load_pending_messages()
-        self.funnels_config = funnels_config
-    
-    def load_pending_messages(self) -> Dict[str, Any]:
-        try:
-            if os.path.exists(PENDING_MESSAGES_FILE):
-                with open(PENDING_MESSAGES_FILE, 'r') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Ошибка загрузки непрочитанных сообщений: {e}")
-        return {}
-    
-    def save_pending_messages(self):
-        try:
-            with open(PENDING_MESSAGES_FILE, 'w') as f:
-                json.dump(self.pending_messages, f, indent=2)
-        except Exception as e:
-            logger.error(f"Ошибка сохранения непрочитанных сообщений: {e}")
-    
-    def add_message(self, chat_id: int, user_id: int, message_text: str, message_id: int, chat_title: str = None, username: str = None, first_name: str = None):
-        key = f"{chat_id}_{user_id}_{message_id}_{int(datetime.now().timestamp())}"
-        
-        if not message_text:
-            message_text = "[Сообщение без текста]"
-        
-        self.pending_messages[key] = {
-            'chat_id': chat_id,
-            'user_id': user_id,
-            'message_text': message_text,
-            'message_id': message_id,
-            'chat_title': chat_title,
-            'username': username,
-            'first_name': first_name,
-            'timestamp': datetime.now(MOSCOW_TZ).isoformat(),
-            'funnels_sent': [],
-            'current_funnel': 0,
-            'message_key': key
-        }
-        self.save_pending_messages()
-        logger.info(f"✅ Добавлено непрочитанное сообщение: {key}")
-    
-    def remove_message_by_key(self, key: str):
-        if key in self.pending_messages:
-            del self.pending_messages[key]
-            self.save_pending_messages()
-            logger.info(f"✅ Удалено непрочитанное сообщение: {key}")
-            return True
-        return False
-    
-    def remove_all_chat_messages(self, chat_id: int, user_id: int = None):
-        keys_to_remove = []
-        for key, message in self.pending_messages.items():
-            if message['chat_id'] == chat_id:
-                if user_id is None or message['user_id'] == user_id:
-                    keys_to_remove.append(key)
-        
-        for key in keys_to_remove:
-            del self.pending_messages[key]
-        
-        if keys_to_remove:
-            self.save_pending_messages()
-            logger.info(f"✅ Удалено {len(keys_to_remove)} сообщений из чата {chat_id}")
-            return len(keys_to_remove)
-        return 0
-    
-    def get_all_pending_messages(self) -> List[Dict[str, Any]]:
-        return list(self.pending_messages.values())
-    
-    def mark_funnel_sent(self, message_key: str, funnel_number: int):
-        if message_key in self.pending_messages:
-            if funnel_number not in self.pending_messages[message_key]['funnels_sent']:
-                self.pending_messages[message_key]['funnels_sent'].append(funnel_number)
-                self.pending_messages[message_key]['current_funnel'] = funnel_number
-                self.save_pending_messages()
-    
-    def find_messages_by_chat(self, chat_id: int) -> List[Dict[str, Any]]:
-        result = []
-        for message in self.pending_messages.values():
-            if message['chat_id'] == chat_id:
-                result.append(message)
-        return result
-    
-    def get_messages_for_funnel(self, funnel_number: int, funnels_state: FunnelsStateManager) -> List[Dict[str, Any]]:
-        """Получает сообщения для указанной воронки - ПРОСТАЯ И НАДЕЖНАЯ ЛОГИКА"""
-        result = []
-        now = datetime.now(MOSCOW_TZ)
-        FUNNELS = self.funnels_config.get_funnels()
-        funnel_minutes = FUNNELS[funnel_number]
-        
-        for message_key, message in self.pending_messages.items():
-            # УБРАНА ПРОВЕРКА НА ОБРАБОТАННЫЕ СООБЩЕНИЯ
-            # if funnels_state.is_message_processed(funnel_number, message_key):
-            #     continue
-                
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
-            
-            funnels_sent = message.get('funnels_sent', [])
-            
-            # ПРОСТАЯ ЛОГИКА: если прошло достаточно времени и воронка еще не отправлена
-            if (minutes_passed >= funnel_minutes and 
-                funnel_number not in funnels_sent):
-                message['message_key'] = message_key
-                message['minutes_passed'] = minutes_passed
-                result.append(message)
-        
-        return result
-    
-    def update_funnel_statuses(self):
-        """Автоматически обновляет статусы воронок - ПРОСТАЯ ЛОГИКА"""
-        updated_count = 0
-        now = datetime.now(MOSCOW_TZ)
-        FUNNELS = self.funnels_config.get_funnels()
-        
-        for message_key, message in self.pending_messages.items():
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
-            
-            current_funnel = message.get('current_funnel', 0)
-            
-            # Определяем текущую воронку на основе времени
-            new_funnel = 0
-            if minutes_passed >= FUNNELS[3]:
-                new_funnel = 3
-            elif minutes_passed >= FUNNELS[2]:
-                new_funnel = 2
-            elif minutes_passed >= FUNNELS[1]:
-                new_funnel = 1
-            
-            # Обновляем если изменилась
-            if new_funnel != current_funnel:
-                self.pending_messages[message_key]['current_funnel'] = new_funnel
-                updated_count += 1
-                logger.info(f"🔄 Сообщение {message_key}: воронка {current_funnel} -> {new_funnel} ({minutes_passed} минут)")
-        
-        if updated_count > 0:
-            self.save_pending_messages()
-            logger.info(f"✅ Обновлено статусов воронок: {updated_count} сообщений")
-        
-        return updated_count
-    
-    def get_all_messages_older_than(self, minutes_threshold: int) -> List[Dict[str, Any]]:
-        result = []
-        now = datetime.now(MOSCOW_TZ)
-        
-        for message_key, message in self.pending_messages.items():
-            timestamp = datetime.fromisoformat(message['timestamp'])
-            time_diff = now - timestamp
-            minutes_passed = int(time_diff.total_seconds() / 60)
-            
-            if minutes_passed >= minutes_threshold:
-                message['message_key'] = message_key
-                message['minutes_passed'] = minutes_passed
-                result.append(message)
-        
-        return result
-    
-    def clear_all(self):
-        count = len(self.pending_messages)
-        self.pending_messages = {}
-        self.save_pending_messages()
-        logger.info(f"✅ Очищены все непрочитанные сообщения ({count} шт.)")
-        return count
-
-# ========== ГЛОБАЛЬНЫЕ ЭКЗЕМПЛЯРЫ ==========
-
-funnels_config = FunnelsConfig()
-flags_manager = AutoReplyFlags()
-work_chat_manager = WorkChatManager()
-pending_messages_manager = PendingMessagesManager(funnels_config)
-excluded_users_manager = ExcludedUsersManager()
-funnels_state_manager = FunnelsStateManager()
-master_notification_manager = MasterNotificationManager()
-
-# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
-
-def is_admin(user_id: int) -> bool:
-    return user_id in ADMIN_IDS
-
-def is_manager(user_id: int, username: str = None) -> bool:
-    return excluded_users_manager.is_user_excluded(user_id, username)
-
-def is_excluded_user(user_id: int) -> bool:
-    return excluded_users_manager.is_user_excluded(user_id)
-
-def is_working_hours():
-    now = datetime.now(MOSCOW_TZ)
-    current_time = now.time()
-    if current_time >= time(10, 0) and current_time <= time(19, 0):
-        return True
-    return False
-
-def should_respond_to_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
-    if not update or not update.message:
-        return False
-    
-    if update.message.from_user.id == context.bot.id:
-        return False
-        
-    if is_excluded_user(update.message.from_user.id):
-        return False
-        
-    if update.message.new_chat_members or update.message.left_chat_member:
-        return False
-        
-    if update.message.pinned_message:
-        return False
-        
-    if update.edited_message:
-        return False
-        
-    if update.message.text and update.message.text.startswith('/'):
-        return False
-        
-    if update.message.text and len(update.message.text.strip()) < 1:
-        return False
-        
-    return True
-
-def get_chat_display_name(chat_data: Dict[str, Any]) -> str:
-    chat_title = chat_data.get('chat_title')
-    if chat_title:
-        return chat_title
-    else:
-        return f"Чат {chat_data['chat_id']}"
-
-def get_funnel_emoji(funnel_number: int) -> str:
-    emojis = {1: "🟡", 2: "🟠", 3: "🔴"}
-    return emojis.get(funnel_number, "⚪")
-
-def format_time_ago(timestamp: str) -> str:
-    message_time = datetime.fromisoformat(timestamp)
-    now = datetime.now(MOSCOW_TZ)
-    time_diff = now - message_time
-    
-    total_minutes = int(time_diff.total_seconds() / 60)
-    hours = total_minutes // 60
-    minutes = total_minutes % 60
-    
-    if hours > 0:
-        return f"{hours}ч {minutes}м"
-    else:
-        return f"{minutes}м"
-
-def minutes_to_hours_text(minutes: int) -> str:
-    hours = minutes // 60
-    if hours == 1:
-        return "1 ЧАС"
-    elif hours == 3:
-        return "3 ЧАСА"
-    elif hours == 5:
-        return "5 ЧАСОВ"
-    else:
-        return f"{hours} ЧАСОВ"
-
-# ========== ФУНКЦИИ АВТОМАТИЧЕСКОГО ОБНОВЛЕНИЯ ВОРОНОК ==========
-
-async def update_message_funnel_statuses():
-    """Автоматически обновляет статусы воронок для всех сообщений"""
-    logger.info("🔄 Автоматическое обновление статусов воронок...")
-    return pending_messages_manager.update_funnel_statuses()
-
-# ========== СИСТЕМА ЕДИНОГО УВЕДОМЛЕНИЯ ==========
-
-def create_master_notification_text() -> str:
-    """Создает текст единого уведомления со всеми воронками (без дублирования чатов)"""
-    FUNNELS = funnels_config.get_funnels()
-    
-    # Собираем ВСЕ сообщения и группируем по чатам
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'message_count': 0,
-                'oldest_time': msg['timestamp'],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['message_count'] += 1
-        if msg['timestamp'] < chats_data[chat_id]['oldest_time']:
-            chats_data[chat_id]['oldest_time'] = msg['timestamp']
-        
-        # Определяем максимальную воронку для чата
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    # Распределяем чаты по воронкам
-    funnel_1_chats = {}
-    funnel_2_chats = {}
-    funnel_3_chats = {}
-    
-    for chat_id, chat_data in chats_data.items():
-        funnel = chat_data['current_funnel']
-        if funnel == 1:
-            funnel_1_chats[chat_id] = chat_data
-        elif funnel == 2:
-            funnel_2_chats[chat_id] = chat_data
-        elif funnel == 3:
-            funnel_3_chats[chat_id] = chat_data
-    
-    # Создаем текст уведомления
-    notification_text = "📊 **ОБЗОР НЕОТВЕЧЕННЫХ СООБЩЕНИЙ**\n\n"
-    
-    # Воронка 1
-    notification_text += f"🟡 {minutes_to_hours_text(FUNNELS[1])} без ответа\n"
-    if funnel_1_chats:
-        for chat_id, chat_data in funnel_1_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
-            notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    else:
-        notification_text += "  Таких нет\n"
-    notification_text += "\n"
-    
-    # Воронка 2
-    notification_text += f"🟠 {minutes_to_hours_text(FUNNELS[2])} без ответа\n"
-    if funnel_2_chats:
-        for chat_id, chat_data in funnel_2_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
-            notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    else:
-        notification_text += "  Таких нет\n"
-    notification_text += "\n"
-    
-    # Воронка 3
-    notification_text += f"🔴 БОЛЕЕ {minutes_to_hours_text(FUNNELS[3])} без ответа\n"
-    if funnel_3_chats:
-        for chat_id, chat_data in funnel_3_chats.items():
-            chat_display = get_chat_display_name(chat_data['chat_info'])
-            message_count = chat_data['message_count']
-            time_ago = format_time_ago(chat_data['oldest_time'])
-            notification_text += f"  • {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    else:
-        notification_text += "  Таких нет\n"
-    
-    # Добавляем общую статистику
-    total_messages = len(all_messages)
-    total_chats = len(chats_data)
-    
-    notification_text += f"\n📈 **ИТОГО:** {total_messages} сообщений в {total_chats} чатах"
-    notification_text += f"\n⏰ Обновлено: {datetime.now(MOSCOW_TZ).strftime('%H:%M:%S')}"
-    
-    return notification_text
-
-async def delete_old_notifications(context: ContextTypes.DEFAULT_TYPE):
-    """Удаляет старые уведомления"""
-    work_chat_id = work_chat_manager.get_work_chat_id()
-    if not work_chat_id:
-        return
-    
-    try:
-        message_ids = master_notification_manager.get_message_ids()
-        for message_id in message_ids:
-            try:
-                await context.bot.delete_message(
-                    chat_id=work_chat_id,
-                    message_id=message_id
-                )
-                logger.info(f"✅ Удалено старое уведомление: {message_id}")
-            except Exception as e:
-                logger.warning(f"❌ Не удалось удалить сообщение {message_id}: {e}")
-        
-        # Очищаем список сообщений после удаления
-        master_notification_manager.data["message_ids"] = []
-        master_notification_manager.save_data()
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка при удалении старых уведомлений: {e}")
-
-async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force: bool = False):
-    """Отправляет новое уведомление (удаляет старые и отправляет новое)"""
-    work_chat_id = work_chat_manager.get_work_chat_id()
-    if not work_chat_id:
-        logger.error("❌ Не могу отправить уведомление: рабочий чат не установлен")
-        return False
-    
-    # Проверяем cooldown, если не форсированная отправка
-    if not force and not master_notification_manager.should_update():
-        logger.info("⏳ Cooldown: уведомление не отправляется (еще не прошло 30 минут)")
-        return False
-    
-    try:
-        # Сначала удаляем старые уведомления
-        await delete_old_notifications(context)
-        
-        # Затем отправляем новое
-        notification_text = create_master_notification_text()
-        
-        sent_message = await context.bot.send_message(
-            chat_id=work_chat_id,
-            text=notification_text,
-            parse_mode='Markdown'
-        )
-        
-        # Сохраняем ID нового сообщения
-        master_notification_manager.add_message_id(sent_message.message_id)
-        
-        # УБРАНА АВТОМАТИЧЕСКАЯ ПОМЕТКА СООБЩЕНИЙ КАК ОБРАБОТАННЫХ
-        # Сообщения будут продолжать показываться пока на них не ответят
-        
-        # Обновляем время последней отправки
-        master_notification_manager.update_notification_time()
-        
-        # Очищаем старые сообщения (оставляем только последние 3)
-        master_notification_manager.clear_old_messages(keep_last=3)
-        
-        logger.info("✅ Отправлено новое единое уведомление")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Ошибка отправки нового уведомления: {e}")
-        return False
-
-async def check_and_send_new_notification(context: ContextTypes.DEFAULT_TYPE):
-    """Проверяет и отправляет новое уведомление каждые 30 минут с автоматическим обновлением статусов"""
-    logger.info("🔄 Проверка необходимости отправки уведомления...")
-    
-    # СНАЧАЛА ОБНОВЛЯЕМ СТАТУСЫ ВСЕХ СООБЩЕНИЙ
-    updated_count = await update_message_funnel_statuses()
-    if updated_count > 0:
-        logger.info(f"🔄 Обновлено {updated_count} статусов воронок перед отправкой уведомления")
-    
-    # ПОТОМ ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ
-    await send_new_master_notification(context)
-
-# ========== ОБРАБОТЧИК ОТВЕТОВ МЕНЕДЖЕРА ==========
-
-async def handle_manager_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обрабатывает ответы менеджеров и обновляет уведомление"""
-    if not update or not update.message:
-        return
-        
-    username = update.message.from_user.username
-    if not is_manager(update.message.from_user.id, username):
-        return
-        
-    if update.message.text and update.message.text.startswith('/'):
-        return
-    
-    chat_id = update.message.chat.id
-    logger.info(f"🔍 Менеджер ответил в чате {chat_id}")
-    
-    # Удаляем сообщения из pending для этого чата
-    removed_count = pending_messages_manager.remove_all_chat_messages(chat_id)
-    
-    if removed_count > 0:
-        logger.info(f"✅ Удалено {removed_count} сообщений из чата {chat_id} после ответа менеджера")
-        
-        # Немедленно отправляем новое уведомление (форсированно)
-        await send_new_master_notification(context, force=True)
-
-# ========== КОМАНДЫ БОТА ==========
-
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    await update.message.reply_text(
-        "🤖 Бот-автоответчик запущен!\n\n"
-        "📋 Доступные команды:\n"
-        "/status - статус системы\n"
-        "/funnels - настройки воронок\n"
-        "/pending - список непрочитанных\n"
-        "/managers - список менеджеров\n"
-        "/stats - статистика\n"
-        "/help - помощь\n"
-        "/update_notification - обновить уведомление\n"
-        "/force_update_funnels - принудительно обновить воронки\n"
-        "/debug_funnels - отладка воронок\n"
-        "/fix_funnels - исправить статусы воронок\n\n"
-        "👥 **Управление исключениями:**\n"
-        "/add_exception - добавить исключение\n"
-        "/remove_exception - удалить исключение\n"
-        "/list_exceptions - список исключений\n"
-        "/clear_exceptions - очистить все исключения"
-    )
-
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    help_text = """
-📖 **СПРАВКА ПО КОМАНДАМ БОТА**
-
-**Основные команды:**
-/start - запуск бота
-/status - статус системы
-/help - эта справка
-
-**Управление воронками:**
-/funnels - текущие настройки воронок
-/set_funnel_1 <минуты> - установить интервал 1-й воронки
-/set_funnel_2 <минуты> - установить интервал 2-й воронки  
-/set_funnel_3 <минуты> - установить интервал 3-й воронки
-/reset_funnels - сбросить настройки воронок
-/force_update_funnels - принудительно обновить статусы воронок
-/debug_funnels - отладка воронок
-/fix_funnels - исправить статусы воронок
-
-**Рабочий чат:**
-/set_work_chat - установить этот чат как рабочий (для уведомлений)
-
-**Управление сообщениями:**
-/pending - список непрочитанных сообщений
-/clear_chat - очистить сообщения из текущего чата
-/clear_all - очистить все сообщения
-
-**Управление исключениями:**
-/add_exception <ID/@username> - добавить менеджера
-/remove_exception <ID/@username> - удалить менеджера
-/list_exceptions - список всех менеджеров
-/clear_exceptions - очистить все исключения
-
-**Обновление уведомления:**
-/update_notification - обновить единое уведомление
-
-**Статистика:**
-/stats - статистика системы
-/managers - список менеджеров
-
-📝 **Логика работы воронок:**
-🟡 Воронка 1: через 1 час без ответа
-🟠 Воронка 2: через 3 часа без ответа
-🔴 Воронка 3: через 5 часов без ответа
-**БЕЗ ДУБЛИРОВАНИЯ** - каждый чат показывается только в одной воронке
-    """
-    await update.message.reply_text(help_text, parse_mode='Markdown')
-
-async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    FUNNELS = funnels_config.get_funnels()
-    now = datetime.now(MOSCOW_TZ)
-    excluded_users = excluded_users_manager.get_all_excluded()
-    total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
-    
-    # Получаем статистику по воронкам (без дублирования)
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {'current_funnel': 0}
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    funnel_1_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 1)
-    funnel_2_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 2)
-    funnel_3_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 3)
-    
-    # Время последнего уведомления
-    last_notification = master_notification_manager.last_notification_time
-    last_notification_str = last_notification.strftime('%H:%M:%S') if last_notification else "Никогда"
-    
-    status_text = f"""
-📊 **СТАТУС СИСТЕМЫ**
-
-⏰ **Время:** {now.strftime('%d.%m.%Y %H:%M:%S')}
-🕐 **Рабочие часы:** {'✅ ДА' if is_working_hours() else '❌ НЕТ'}
-
-📋 **Непрочитанные сообщения:** {len(all_messages)}
-🚩 **Флаги автоответов:** {flags_manager.count_flags()}
-💬 **Рабочий чат:** {'✅ Установлен' if work_chat_manager.is_work_chat_set() else '❌ Не установлен'}
-📢 **Последнее уведомление:** {last_notification_str}
-
-⚙️ **НАСТРОЙКИ ВОРОНОК:**
-🟡 Воронка 1: {FUNNELS[1]} мин ({minutes_to_hours_text(FUNNELS[1])}) - {funnel_1_count} чатов
-🟠 Воронка 2: {FUNNELS[2]} мин ({minutes_to_hours_text(FUNNELS[2])}) - {funnel_2_count} чатов
-🔴 Воронка 3: {FUNNELS[3]} мин ({minutes_to_hours_text(FUNNELS[3])}) - {funnel_3_count} чатов
-
-👥 **Менеджеров в системе:** {total_excluded} ({len(excluded_users["user_ids"])} ID + {len(excluded_users["usernames"])} username)
-
-🔄 **Логика уведомлений:** Удаление старого + отправка нового каждые 30 минут
-⏳ **Cooldown:** {'✅ Активен' if not master_notification_manager.should_update() else '❌ Можно отправлять'}
-🔧 **Логика воронок:** ✅ Без дублирования (1 чат = 1 воронка)
-    """
-    
-    await update.message.reply_text(status_text, parse_mode='Markdown')
-
-async def funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    FUNNELS = funnels_config.get_funnels()
-    
-    funnels_text = f"""
-⚙️ **ТЕКУЩИЕ НАСТРОЙКИ ВОРОНОК**
-
-🟡 **Воронка 1 (начальное уведомление):**
-   - Интервал: {FUNNELS[1]} минут ({minutes_to_hours_text(FUNNELS[1])})
-   - Команда: `/set_funnel_1 <минуты>`
-
-🟠 **Воронка 2 (повторное уведомление):**
-   - Интервал: {FUNNELS[2]} минут ({minutes_to_hours_text(FUNNELS[2])})
-   - Команда: `/set_funnel_2 <минуты>`
-
-🔴 **Воронка 3 (срочное уведомление):**
-   - Интервал: {FUNNELS[3]} минут ({minutes_to_hours_text(FUNNELS[3])})
-   - Команда: `/set_funnel_3 <минуты>`
-
-🔄 Сбросить настройки: `/reset_funnels`
-🚀 Принудительное обновление: `/force_update_funnels`
-🐛 Отладка: `/debug_funnels`
-🔧 Исправить статусы: `/fix_funnels`
-
-📝 **Логика работы:**
-Единое уведомление обновляется каждые 30 минут
-**СТАРОЕ УДАЛЯЕТСЯ, ОТПРАВЛЯЕТСЯ НОВОЕ**
-**COOLDOWN 15 МИНУТ** - защита от частых отправок
-**БЕЗ ДУБЛИРОВАНИЯ** - каждый чат показывается только в одной воронке
-    """
-    
-    await update.message.reply_text(funnels_text, parse_mode='Markdown')
-
-async def set_funnel_1_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    if not context.args or not context.args[0].isdigit():
-        await update.message.reply_text("❌ Использование: /set_funnel_1 <минуты>")
-        return
-    
-    minutes = int(context.args[0])
-    if minutes <= 0:
-        await update.message.reply_text("❌ Количество минут должно быть положительным числом")
-        return
-    
-    if funnels_config.set_funnel_interval(1, minutes):
-        await update.message.reply_text(f"✅ Воронка 1 установлена на {minutes} минут ({minutes_to_hours_text(minutes)})")
-        logger.info("✅ Настройки воронки 1 обновлены")
-    else:
-        await update.message.reply_text("❌ Ошибка установки интервала воронки")
-
-async def set_funnel_2_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    if not context.args or not context.args[0].isdigit():
-        await update.message.reply_text("❌ Использование: /set_funnel_2 <минуты>")
-        return
-    
-    minutes = int(context.args[0])
-    if minutes <= 0:
-        await update.message.reply_text("❌ Количество минут должно быть положительным числом")
-        return
-    
-    if funnels_config.set_funnel_interval(2, minutes):
-        await update.message.reply_text(f"✅ Воронка 2 установлена на {minutes} минут ({minutes_to_hours_text(minutes)})")
-        logger.info("✅ Настройки воронки 2 обновлены")
-    else:
-        await update.message.reply_text("❌ Ошибка установки интервала воронки")
-
-async def set_funnel_3_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    if not context.args or not context.args[0].isdigit():
-        await update.message.reply_text("❌ Использование: /set_funnel_3 <минуты>")
-        return
-    
-    minutes = int(context.args[0])
-    if minutes <= 0:
-        await update.message.reply_text("❌ Количество минут должно быть положительным числом")
-        return
-    
-    if funnels_config.set_funnel_interval(3, minutes):
-        await update.message.reply_text(f"✅ Воронка 3 установлена на {minutes} минут ({minutes_to_hours_text(minutes)})")
-        logger.info("✅ Настройки воронки 3 обновлены")
-    else:
-        await update.message.reply_text("❌ Ошибка установки интервала воронки")
-
-async def reset_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    funnels_config.reset_to_default()
-    await update.message.reply_text("✅ Настройки воронок сброшены к значениям по умолчанию")
-    logger.info("✅ Настройки воронок сброшены")
-
-async def force_update_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Принудительно обновляет статусы воронок для всех сообщений"""
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    await update.message.reply_text("🔄 Принудительное обновление статусов воронок...")
-    
-    updated_count = await update_message_funnel_statuses()
-    
-    if updated_count > 0:
-        await update.message.reply_text(f"✅ Обновлено статусов воронок: {updated_count} сообщений")
-        # Сразу отправляем обновленное уведомление
-        await send_new_master_notification(context, force=True)
-    else:
-        await update.message.reply_text("ℹ️ Не требуется обновление статусов воронок")
-
-async def debug_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для отладки воронок"""
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    # Получаем все сообщения и группируем по чатам
-    all_messages = pending_messages_manager.get_all_pending_messages()
-    chats_data = {}
-    
-    for msg in all_messages:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'messages': [],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['messages'].append(msg)
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    debug_text = "🐛 **ОТЛАДКА ВОРОНОК**\n\n"
-    
-    FUNNELS = funnels_config.get_funnels()
-    
-    # Показываем чаты по воронкам
-    funnel_1_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 1}
-    funnel_2_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 2}
-    funnel_3_chats = {chat_id: data for chat_id, data in chats_data.items() if data['current_funnel'] == 3}
-    
-    debug_text += f"🟡 Воронка 1 ({FUNNELS[1]} мин): {len(funnel_1_chats)} чатов\n"
-    for chat_id, chat_data in funnel_1_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
-        debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    
-    debug_text += f"\n🟠 Воронка 2 ({FUNNELS[2]} мин): {len(funnel_2_chats)} чатов\n"
-    for chat_id, chat_data in funnel_2_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
-        debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    
-    debug_text += f"\n🔴 Воронка 3 ({FUNNELS[3]} мин): {len(funnel_3_chats)} чатов\n"
-    for chat_id, chat_data in funnel_3_chats.items():
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest_time = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest_time)
-        debug_text += f"   - {chat_display} ({message_count} сообщ., {time_ago} назад)\n"
-    
-    await update.message.reply_text(debug_text, parse_mode='Markdown')
-
-async def fix_funnel_statuses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Исправляет статусы воронок для всех сообщений"""
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    await update.message.reply_text("🔧 Исправляю статусы воронок...")
-    
-    all_pending = pending_messages_manager.get_all_pending_messages()
-    fixed_count = 0
-    
-    for message in all_pending:
-        message_key = message.get('message_key')
-        if not message_key:
-            continue
-            
-        timestamp = datetime.fromisoformat(message['timestamp'])
-        now = datetime.now(MOSCOW_TZ)
-        time_diff = now - timestamp
-        minutes_passed = int(time_diff.total_seconds() / 60)
-        
-        FUNNELS = funnels_config.get_funnels()
-        current_funnel = message.get('current_funnel', 0)
-        
-        # Определяем правильную воронку на основе времени
-        correct_funnel = 0
-        if minutes_passed >= FUNNELS[3]:
-            correct_funnel = 3
-        elif minutes_passed >= FUNNELS[2]:
-            correct_funnel = 2
-        elif minutes_passed >= FUNNELS[1]:
-            correct_funnel = 1
-        
-        # Исправляем если необходимо
-        if correct_funnel != current_funnel:
-            pending_messages_manager.pending_messages[message_key]['current_funnel'] = correct_funnel
-            fixed_count += 1
-            logger.info(f"🔧 Исправлена воронка для {message_key}: {current_funnel} -> {correct_funnel}")
-    
-    if fixed_count > 0:
-        pending_messages_manager.save_pending_messages()
-        await update.message.reply_text(f"✅ Исправлено статусов воронок: {fixed_count} сообщений")
-        # Сразу отправляем обновленное уведомление
-        await send_new_master_notification(context, force=True)
-    else:
-        await update.message.reply_text("ℹ️ Не требуется исправление статусов воронок")
-
-async def update_notification_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда для ручного обновления уведомления"""
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    await update.message.reply_text("🔄 Обновляю единое уведомление...")
-    success = await send_new_master_notification(context, force=True)
-    
-    if success:
-        await update.message.reply_text("✅ Единое уведомление обновлено")
-    else:
-        await update.message.reply_text("❌ Ошибка обновления уведомления")
-
-async def set_work_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    chat_id = update.message.chat.id
-    if work_chat_manager.save_work_chat(chat_id):
-        await update.message.reply_text(f"✅ Этот чат установлен как рабочий (ID: {chat_id})")
-        # Сразу отправляем уведомление в новый рабочий чат (форсированно)
-        await send_new_master_notification(context, force=True)
-    else:
-        await update.message.reply_text("❌ Ошибка сохранения рабочего чата")
-
-async def managers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    excluded_users = excluded_users_manager.get_all_excluded()
-    
-    if not excluded_users["user_ids"] and not excluded_users["usernames"]:
-        await update.message.reply_text("📝 Список менеджеров пуст")
-        return
-    
-    text = "👥 **СПИСОК МЕНЕДЖЕРОВ**\n\n"
-    
-    if excluded_users["user_ids"]:
-        text += "🆔 **По ID:**\n"
-        for i, user_id in enumerate(excluded_users["user_ids"], 1):
-            text += f"{i}. `{user_id}`\n"
-        text += "\n"
-    
-    if excluded_users["usernames"]:
-        text += "👤 **По username:**\n"
-        for i, username in enumerate(excluded_users["usernames"], 1):
-            text += f"{i}. `@{username}`\n"
-    
-    text += f"\n📊 Всего: {len(excluded_users['user_ids'])} ID + {len(excluded_users['usernames'])} username"
-    
-    await update.message.reply_text(text, parse_mode='Markdown')
-
-async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    all_pending = pending_messages_manager.get_all_pending_messages()
-    excluded_users = excluded_users_manager.get_all_excluded()
-    total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
-    
-    # Группируем по чатам для статистики воронок
-    chats_data = {}
-    for msg in all_pending:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {'current_funnel': 0}
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    funnel_1_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 1)
-    funnel_2_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 2)
-    funnel_3_count = sum(1 for chat_data in chats_data.values() if chat_data['current_funnel'] == 3)
-    
-    now = datetime.now(MOSCOW_TZ)
-    time_stats = {"менее 1 часа": 0, "1-3 часа": 0, "3-6 часов": 0, "более 6 часов": 0}
-    
-    for message in all_pending:
-        timestamp = datetime.fromisoformat(message['timestamp'])
-        time_diff = now - timestamp
-        hours_passed = time_diff.total_seconds() / 3600
-        
-        if hours_passed < 1:
-            time_stats["менее 1 часа"] += 1
-        elif hours_passed < 3:
-            time_stats["1-3 часа"] += 1
-        elif hours_passed < 6:
-            time_stats["3-6 часов"] += 1
-        else:
-            time_stats["более 6 часов"] += 1
-    
-    # Время последнего уведомления
-    last_notification = master_notification_manager.last_notification_time
-    last_notification_str = last_notification.strftime('%H:%M:%S') if last_notification else "Никогда"
-    
-    stats_text = f"""
-📈 **СТАТИСТИКА СИСТЕМЫ**
-
-📊 **Общая статистика:**
-   - Непрочитанных сообщений: {len(all_pending)}
-   - Чатов с сообщениями: {len(chats_data)}
-   - Флагов автоответов: {flags_manager.count_flags()}
-   - Менеджеров в системе: {total_excluded} ({len(excluded_users["user_ids"])} ID + {len(excluded_users["usernames"])} username)
-   - Последнее уведомление: {last_notification_str}
-
-⚙️ **Статистика воронок:**
-   - 🟡 Воронка 1: {funnel_1_count} чатов
-   - 🟠 Воронка 2: {funnel_2_count} чатов  
-   - 🔴 Воронка 3: {funnel_3_count} чатов
-
-⏱ **Время ожидания ответа:**
-   - Менее 1 часа: {time_stats['менее 1 часа']}
-   - 1-3 часа: {time_stats['1-3 часа']}
-   - 3-6 часов: {time_stats['3-6 часов']}
-   - Более 6 часов: {time_stats['более 6 часов']}
-
-💬 **Рабочий чат:** {'✅ Установлен' if work_chat_manager.is_work_chat_set() else '❌ Не установлен'}
-🔄 **Логика уведомлений:** Удаление старого + отправка нового каждые 15 минут
-⏳ **Cooldown:** {'✅ Активен' if not master_notification_manager.should_update() else '❌ Можно отправлять'}
-🔧 **Логика воронок:** ✅ Без дублирования (1 чат = 1 воронка)
-🕐 **Текущее время:** {now.strftime('%H:%M:%S')}
-    """
-    
-    await update.message.reply_text(stats_text, parse_mode='Markdown')
-
-async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    all_pending = pending_messages_manager.get_all_pending_messages()
-    
-    if not all_pending:
-        await update.message.reply_text("✅ Нет непрочитанных сообщений")
-        return
-    
-    # Группируем по чатам
-    chats_data = {}
-    for msg in all_pending:
-        chat_id = msg['chat_id']
-        if chat_id not in chats_data:
-            chats_data[chat_id] = {
-                'chat_info': msg,
-                'messages': [],
-                'current_funnel': 0
-            }
-        chats_data[chat_id]['messages'].append(msg)
-        
-        current_funnel = msg.get('current_funnel', 0)
-        if current_funnel > chats_data[chat_id]['current_funnel']:
-            chats_data[chat_id]['current_funnel'] = current_funnel
-    
-    pending_text = f"📋 **НЕПРОЧИТАННЫЕ СООБЩЕНИЯ**\n\nВсего сообщений: {len(all_pending)}\nЧатов: {len(chats_data)}\n\n"
-    
-    for i, (chat_id, chat_data) in enumerate(chats_data.items(), 1):
-        chat_display = get_chat_display_name(chat_data['chat_info'])
-        message_count = len(chat_data['messages'])
-        oldest = min(msg['timestamp'] for msg in chat_data['messages'])
-        time_ago = format_time_ago(oldest)
-        
-        current_funnel = chat_data['current_funnel']
-        funnel_emoji = get_funnel_emoji(current_funnel) if current_funnel > 0 else "⚪"
-        
-        pending_text += f"{i}. {chat_display} {funnel_emoji}\n"
-        pending_text += f"   📝 Сообщений: {message_count}\n"
-        pending_text += f"   ⏰ Самое старое: {time_ago} назад\n"
-        pending_text += f"   🚀 Текущая воронка: {current_funnel}\n\n"
-    
-    if len(pending_text) > 4000:
-        pending_text = pending_text[:4000] + "\n\n... (сообщение обрезано)"
-    
-    await update.message.reply_text(pending_text, parse_mode='Markdown')
-
-async def clear_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    chat_id = update.message.chat.id
-    removed_count = pending_messages_manager.remove_all_chat_messages(chat_id)
-    
-    if removed_count > 0:
-        await update.message.reply_text(f"✅ Удалено {removed_count} сообщений из этого чата")
-        logger.info(f"✅ Удалены сообщения из чата {chat_id}")
-    else:
-        await update.message.reply_text("✅ В этом чате нет непрочитанных сообщений")
-
-async def clear_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    removed_count = pending_messages_manager.clear_all()
-    await update.message.reply_text(f"✅ Удалены все непрочитанные сообщения ({removed_count} шт.)")
-    logger.info("✅ Все сообщения очищены")
-
-# ========== КОМАНДЫ УПРАВЛЕНИЯ ИСКЛЮЧЕНИЯМИ ==========
-
-async def add_exception_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("❌ Использование: /add_exception <ID или @username>")
-        return
-    
-    identifier = context.args[0]
-    
-    if identifier.isdigit():
-        user_id = int(identifier)
-        if excluded_users_manager.add_user_id(user_id):
-            await update.message.reply_text(f"✅ ID `{user_id}` добавлен в исключения")
-        else:
-            await update.message.reply_text(f"ℹ️ ID `{user_id}` уже в исключениях")
-    else:
-        if excluded_users_manager.add_username(identifier):
-            await update.message.reply_text(f"✅ Username `{identifier}` добавлен в исключения")
-        else:
-            await update.message.reply_text(f"ℹ️ Username `{identifier}` уже в исключениях")
-
-async def remove_exception_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    if not context.args:
-        await update.message.reply_text("❌ Использование: /remove_exception <ID или @username>")
-        return
-    
-    identifier = context.args[0]
-    
-    if identifier.isdigit():
-        user_id = int(identifier)
-        if excluded_users_manager.remove_user_id(user_id):
-            await update.message.reply_text(f"✅ ID `{user_id}` удален из исключений")
-        else:
-            await update.message.reply_text(f"❌ ID `{user_id}` не найден в исключениях")
-    else:
-        if excluded_users_manager.remove_username(identifier):
-            await update.message.reply_text(f"✅ Username `{identifier}` удален из исключений")
-        else:
-            await update.message.reply_text(f"❌ Username `{identifier}` не найден в исключениях")
-
-async def list_exceptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    excluded_users = excluded_users_manager.get_all_excluded()
-    
-    if not excluded_users["user_ids"] and not excluded_users["usernames"]:
-        await update.message.reply_text("📝 Список исключений пуст")
-        return
-    
-    text = "👥 **СПИСОК ИСКЛЮЧЕННЫХ ПОЛЬЗОВАТЕЛЕЙ**\n\n"
-    
-    if excluded_users["user_ids"]:
-        text += "🆔 **По ID:**\n"
-        for i, user_id in enumerate(excluded_users["user_ids"], 1):
-            text += f"{i}. `{user_id}`\n"
-        text += "\n"
-    
-    if excluded_users["usernames"]:
-        text += "👤 **По username:**\n"
-        for i, username in enumerate(excluded_users["usernames"], 1):
-            text += f"{i}. `@{username}`\n"
-    
-    text += f"\n📊 Всего: {len(excluded_users['user_ids'])} ID + {len(excluded_users['usernames'])} username"
-    
-    await update.message.reply_text(text, parse_mode='Markdown')
-
-async def clear_exceptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    if not is_admin(update.message.from_user.id):
-        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
-        return
-    
-    excluded_users_manager.clear_all()
-    await update.message.reply_text("✅ Все исключения очищены")
-
-# ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
-
-async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    logger.info(f"📨 Получено групповое сообщение: {update.message.chat.title} - {update.message.text[:50] if update.message.text else '[медиа]'}...")
-    
-    username = update.message.from_user.username
-    if is_manager(update.message.from_user.id, username):
-        await handle_manager_reply(update, context)
-        return
-    
-    if not should_respond_to_message(update, context):
-        logger.info("❌ Сообщение не требует обработки")
-        return
-    
-    if update.message.chat.type in ['group', 'supergroup']:
-        chat_id = update.message.chat.id
-        replied_key = f'chat_{chat_id}'
-        
-        if not is_working_hours():
-            # Проверяем, не отправляли ли уже автоответ в этот чат
-            if not flags_manager.has_replied(replied_key):
-                await update.message.reply_text(AUTO_REPLY_MESSAGE)
-                flags_manager.set_replied(replied_key)
-                logger.info(f"✅ Автоответ отправлен в чат {chat_id}")
-            else:
-                logger.info(f"ℹ️ Автоответ уже был отправлен в чат {chat_id}, пропускаем")
-        else:
-            # В рабочее время сбрасываем флаг автоответа для этого чата
-            if flags_manager.has_replied(replied_key):
-                flags_manager.clear_replied(replied_key)
-                logger.info(f"🔄 Флаг автоответа сброшен для чата {chat_id} (рабочее время)")
-            
-            # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
-            if not is_manager(update.message.from_user.id, username):
-                chat_title = update.message.chat.title
-                username = update.message.from_user.username
-                first_name = update.message.from_user.first_name
-                message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
-                
-                pending_messages_manager.add_message(
-                    chat_id=update.message.chat.id,
-                    user_id=update.message.from_user.id,
-                    message_text=message_text,
-                    message_id=update.message.message_id,
-                    chat_title=chat_title,
-                    username=username,
-                    first_name=first_name
-                )
-                logger.info(f"✅ Добавлено в непрочитанные: чат '{chat_title}', пользователь {update.message.from_user.id}")
-                
-                # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
-                logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
-
-async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update or not update.message:
-        return
-        
-    logger.info(f"📨 Получено личное сообщение от {update.message.from_user.id}: {update.message.text[:50] if update.message.text else '[медиа]'}...")
-    
-    username = update.message.from_user.username
-    if is_manager(update.message.from_user.id, username):
-        await handle_manager_reply(update, context)
-        return
-    
-    if not should_respond_to_message(update, context):
-        logger.info("❌ Сообщение не требует обработки")
-        return
-    
-    user_id = update.message.from_user.id
-    replied_key = f'user_{user_id}'
-    
-    if not is_working_hours():
-        # Проверяем, не отправляли ли уже автоответ этому пользователю
-        if not flags_manager.has_replied(replied_key):
-            await update.message.reply_text(AUTO_REPLY_MESSAGE)
-            flags_manager.set_replied(replied_key)
-            logger.info(f"✅ Автоответ отправлен пользователю {user_id}")
-        else:
-            logger.info(f"ℹ️ Автоответ уже был отправлен пользователю {user_id}, пропускаем")
-    else:
-        # В рабочее время сбрасываем флаг автоответа для этого пользователя
-        if flags_manager.has_replied(replied_key):
-            flags_manager.clear_replied(replied_key)
-            logger.info(f"🔄 Флаг автоответа сброшен для пользователя {user_id} (рабочее время)")
-        
-        # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
-        if not is_manager(update.message.from_user.id, username):
-            username = update.message.from_user.username
-            first_name = update.message.from_user.first_name
-            message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
-            
-            pending_messages_manager.add_message(
-                chat_id=update.message.chat.id,
-                user_id=update.message.from_user.id,
-                message_text=message_text,
-                message_id=update.message.message_id,
-                username=username,
-                first_name=first_name
-            )
-            logger.info(f"✅ Добавлено в непрочитанные: пользователь {first_name or username or user_id}")
-            
-            # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
-            logger.info("📝 Новое сообщение добавлено, уведомление будет отправлено по расписанию")
-async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик ошибок - логирует в консоль, но не отправляет уведомления в Telegram"""
-    logger.error(f"💥 Ошибка при обработке сообщения: {context.error}")
-    
-    if update:
-        logger.error(f"💥 Update object: {update}")
-        if update.message:
-            logger.error(f"💥 Message info: chat_id={update.message.chat.id}, user_id={update.message.from_user.id if update.message.from_user else 'None'}")
-    
-    # Логируем дополнительную информацию об ошибке
-    logger.error(f"💥 Traceback: {context.error.__traceback__}")
-    
-    # УБРАНА ОТПРАВКА УВЕДОМЛЕНИЙ АДМИНИСТРАТОРАМ
-    # Ошибки будут только в консоли/логах, но не в Telegram
-
-# ========== ЗАПУСК БОТА ==========
-
-def main():
-    try:
-        print("=" * 50)
-        print("🤖 ЗАПУСК БОТА-АВТООТВЕТЧИКА")
-        print("=" * 50)
-        
-        application = Application.builder().token(BOT_TOKEN).build()
-        
-        # Команды для управления воронками
-        application.add_handler(CommandHandler("funnels", funnels_command))
-        application.add_handler(CommandHandler("set_funnel_1", set_funnel_1_command))
-        application.add_handler(CommandHandler("set_funnel_2", set_funnel_2_command))
-        application.add_handler(CommandHandler("set_funnel_3", set_funnel_3_command))
-        application.add_handler(CommandHandler("reset_funnels", reset_funnels_command))
-        application.add_handler(CommandHandler("force_update_funnels", force_update_funnels_command))
-        application.add_handler(CommandHandler("debug_funnels", debug_funnels_command))
-        application.add_handler(CommandHandler("fix_funnels", fix_funnel_statuses_command))
-        
-        # Команды для обновления уведомления
-        application.add_handler(CommandHandler("update_notification", update_notification_command))
-        
-        # Команды для управления исключениями
-        application.add_handler(CommandHandler("add_exception", add_exception_command))
-        application.add_handler(CommandHandler("remove_exception", remove_exception_command))
-        application.add_handler(CommandHandler("list_exceptions", list_exceptions_command))
-        application.add_handler(CommandHandler("clear_exceptions", clear_exceptions_command))
-        
-        # Команды для ручного управления сообщениями
-        application.add_handler(CommandHandler("clear_chat", clear_chat_command))
-        application.add_handler(CommandHandler("clear_all", clear_all_command))
-        application.add_handler(CommandHandler("pending", pending_command))
-        
-        # Основные команды
-        application.add_handler(CommandHandler("start", start_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("status", status_command))
-        application.add_handler(CommandHandler("set_work_chat", set_work_chat_command))
-        application.add_handler(CommandHandler("managers", managers_command))
-        application.add_handler(CommandHandler("stats", stats_command))
-        
-        # Обработчики сообщений
-        application.add_handler(MessageHandler(
-            filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL, 
-            handle_group_message,
-            block=False
-        ))
-        application.add_handler(MessageHandler(
-            filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL,
-            handle_private_message, 
-            block=False
-        ))
-        
-        # Обработчик ошибок
-        application.add_error_handler(error_handler)
-        
-        # Периодическая проверка и отправка нового уведомления (каждые 15 минут)
-        job_queue = application.job_queue
-        if job_queue:
-            job_queue.run_repeating(check_and_send_new_notification, interval=1800, first=10)  # 15 минут
-            print("✅ Планировщик задач запущен (удаление старого + отправка нового каждые 15 минут)")
-            print("🛡️  COOLDOWN АКТИВИРОВАН - защита от частых отправок")
-            print("🔧 ЛОГИКА ВОРОНОК: Без дублирования (1 чат = 1 воронка)")
-            print("✅ СООБЩЕНИЯ ПОКАЗЫВАЮТСЯ ПОКА НЕ ОТВЕТЯТ")
-        else:
-            print("❌ Планировщик задач недоступен")
-        
-        # Запуск
-        FUNNELS = funnels_config.get_funnels()
-        excluded_users = excluded_users_manager.get_all_excluded()
-        total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
-        
-        print("🚀 Бот запускается...")
-        print(f"📊 Загружено флагов: {flags_manager.count_flags()}")
-        print(f"📋 Непрочитанных сообщений: {len(pending_messages_manager.get_all_pending_messages())}")
-        print(f"👥 Менеджеров в системе: {total_excluded}")
-        print(f"⚙️ Воронки уведомлений: {FUNNELS}")
-        
-        if work_chat_manager.is_work_chat_set():
-            print(f"💬 Рабочий чат установлен: {work_chat_manager.get_work_chat_id()}")
-        else:
-            print("⚠️ Рабочий чат не установлен! Используйте /set_work_chat")
-        
-        print("🔄 Логика уведомлений: УДАЛЕНИЕ СТАРОГО + ОТПРАВКА НОВОГО каждые 15 минут")
-        print("⏳ COOLDOWN: 15 минут между отправками")
-        print("🔧 ЛОГИКА ВОРОНОК: без дублирования (1 чат = 1 воронка)")
-        print("✅ СООБЩЕНИЯ: показываются пока не ответят")
-        print("⏰ Ожидание сообщений...")
-        print("=" * 50)
-        
-        application.run_polling(
-            allowed_updates=Update.ALL_TYPES,
-            drop_pending_updates=False,
-            close_loop=False
-        )
-        
-    except Exception as e:
-        print(f"💥 КРИТИЧЕСКАЯ ОШИБКА: {e}")
-        logger.error(f"💥 Критическая ошибка при запуске бота: {e}")
-
-if __name__ == "__main__":
-    main()
+import logging
+import logging.handlers
+import queue
+import atexit
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import Application, ApplicationHandlerStop, CommandHandler, CallbackQueryHandler, MessageHandler, TypeHandler, filters, ContextTypes
+from telegram.helpers import escape_markdown
+from datetime import datetime, date, time, timedelta
+import pytz
+import os
+import json
+import asyncio
+import collections
+import contextvars
+import signal
+import time as time_module
+import csv
+import gzip
+import tempfile
+import bisect
+import random
+import socket
+import sqlite3
+import sys
+import threading
+import traceback
+import gc
+import tracemalloc
+import cProfile
+import pstats
+import io
+import re
+import base64
+import hashlib
+import hmac
+from urllib.parse import urlsplit, parse_qs
+from array import array
+from typing import Dict, Any, List, Optional, Callable, Sequence
+
+try:
+    import numpy
+except ImportError:  # NumPy не обязателен: без него работает путь на array/bisect
+    numpy = None
+
+# ========== НАСТРОЙКА ЛОГИРОВАНИЯ ==========
+
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')  # text или json
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+# Логи на каждое входящее сообщение: не больше N записей за интервал
+MESSAGE_LOG_RATE = int(os.environ.get('MESSAGE_LOG_RATE', 20))
+MESSAGE_LOG_INTERVAL = 10  # секунд
+
+class JsonFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra= попадают в объект"""
+    
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+    
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class RateLimitFilter(logging.Filter):
+    """Пропускает не больше rate записей за interval секунд.
+    
+    Предупреждения и ошибки проходят всегда; число отброшенных записей
+    дописывается к первой записи следующего интервала.
+    """
+    
+    def __init__(self, rate: int, interval: float):
+        super().__init__()
+        self.rate = rate
+        self.interval = interval
+        self.window_start = 0.0
+        self.passed = 0
+        self.suppressed = 0
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if record.created - self.window_start >= self.interval:
+            if self.suppressed:
+                record.msg = f"{record.msg} (пропущено похожих записей: {self.suppressed})"
+            self.window_start = record.created
+            self.passed = 0
+            self.suppressed = 0
+        if self.passed >= self.rate:
+            self.suppressed += 1
+            return False
+        self.passed += 1
+        return True
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Записи уходят в очередь, а в поток вывода их пишет отдельный поток QueueListener"""
+    stream_handler = logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+    # httpx пишет INFO-строку на каждый запрос getUpdates
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
+# Логгер для записей на каждое входящее сообщение (с ограничением частоты)
+message_logger = logging.getLogger(f"{__name__}.messages")
+message_logger.addFilter(RateLimitFilter(MESSAGE_LOG_RATE, MESSAGE_LOG_INTERVAL))
+
+# Токен бота из переменных окружения Railway
+BOT_TOKEN = os.environ.get('BOT_TOKEN', '7952222222:AAHNNBA5OnoQrblwY4BO0BoETb-9jZg_z_g')
+# Другой сервер Bot API (локальный или fake_telegram.py для тестов), например http://127.0.0.1:8081/bot
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', '')
+TELEGRAM_FILE_URL = os.environ.get('TELEGRAM_FILE_URL', '')
+
+# Таймзона Москвы
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+# Сообщение для автоответа
+AUTO_REPLY_MESSAGE = """Здравствуйте, вы написали в нерабочее время компании!
+
+Мы отвечаем с понедельника по пятницу | c 10:00 до 19:00 по МСК
+
+**сообщение автоматическое, отвечать на него не нужно**"""
+
+# Расписание проверки уведомлений
+NOTIFICATION_INTERVAL = 1800  # базовый интервал проверок, секунд
+# Адаптивная частота: границы интервала и сколько сообщений в последней воронке ускоряют проверки вдвое
+CADENCE_MIN_SECONDS = int(os.environ.get('CADENCE_MIN_SECONDS', '600'))
+CADENCE_MAX_SECONDS = int(os.environ.get('CADENCE_MAX_SECONDS', '7200'))
+CADENCE_TOP_STEP = int(os.environ.get('CADENCE_TOP_STEP', '3'))
+NOTIFICATION_JITTER = 120  # случайный сдвиг запуска, секунд
+NOTIFICATION_STARTUP_DELAY = 10  # минимальная задержка первой проверки после старта
+NOTIFICATION_JOB_NAME = "master_notification"
+REFRESH_DEBOUNCE_SECONDS = 20  # окно тишины перед обновлением после ответов менеджеров
+REFRESH_MAX_WAIT_SECONDS = 120  # обновление не откладывается дольше этого срока
+
+# Склейка серий сообщений: подряд идущие сообщения одного клиента в чате
+# в пределах окна (и все элементы одного альбома) - одна запись
+COALESCE_WINDOW_SECONDS = int(os.environ.get('COALESCE_WINDOW_SECONDS', 120))
+
+# Очередь исходящих сообщений
+OUTBOX_WORKERS = 2
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 2  # секунд, удваивается с каждой попыткой
+OUTBOX_BACKOFF_MAX = 300
+# Общий для всех ботов процесса лимит вызовов Bot API из очереди исходящих
+OUTBOX_RATE = float(os.environ.get('OUTBOX_RATE', '25'))  # вызовов в секунду
+OUTBOX_BURST = int(os.environ.get('OUTBOX_BURST', '25'))
+
+# Чатов на одной странице /pending
+PENDING_PAGE_SIZE = 10
+
+# Защита от повторной обработки обновлений после перезапуска
+UPDATE_DEDUP_WINDOW = 1000  # последних update_id в памяти и в файле
+UPDATE_ID_RESET_GAP = 1000000  # откат update_id больше этого - новая последовательность у Telegram
+UPDATE_DEDUP_FLUSH_SECONDS = 5  # отметка обработанных обновлений пишется в файл не чаще
+CATCH_UP_MAX_SECONDS = 120  # после этого догонка пропущенных обновлений считается завершённой
+
+# Несколько процессов на одной машине: работает только лидер, остальные ждут аренды
+LEADER_ELECTION = os.environ.get('LEADER_ELECTION', '0') == '1'
+LEADER_LEASE_SECONDS = int(os.environ.get('LEADER_LEASE_SECONDS', 30))
+INSTANCE_ID = os.environ.get('INSTANCE_ID', f"{socket.gethostname()}:{os.getpid()}")
+
+# Контроль блокировок цикла событий
+WATCHDOG_INTERVAL = 0.5  # секунд между замерами задержки
+STALL_THRESHOLD = float(os.environ.get('STALL_THRESHOLD', 1.0))  # задержка, считающаяся блокировкой
+STALL_ALERTS = os.environ.get('STALL_ALERTS', '0') == '1'  # сообщать администраторам
+STALL_ALERT_INTERVAL = 900  # не чаще одного сообщения за столько секунд
+HEALTH_WRITE_INTERVAL = 10
+
+# Статистика потока сообщений (/load): сколько недель помнит тепловая карта
+ARRIVAL_WEEKS = 4
+# Окно частоты по чатам (чаты без сообщений дольше окна не сохраняются)
+CHAT_RATE_HOURS = 24
+LOAD_TOP_CHATS = 10
+
+# Поиск по тексту сообщений (/find): бюджет памяти индекса (оценка)
+SEARCH_INDEX_BUDGET_MB = int(os.environ.get('SEARCH_INDEX_BUDGET_MB', '64'))
+SEARCH_MIN_TOKEN_LENGTH = 2
+SEARCH_SNIPPET_LENGTH = 120
+SEARCH_RESULTS_LIMIT = 15
+
+# Максимальный размер файла для /import_exceptions
+IMPORT_MAX_FILE_SIZE = 1024 * 1024
+
+# Профилирование по запросу (/profile)
+PROFILE_DEFAULT_UPDATES = 50
+PROFILE_DEFAULT_SECONDS = 120
+PROFILE_MAX_SECONDS = 600
+PROFILE_REPORT_LINES = 40
+
+# ID администраторов
+ADMIN_IDS = {7842709072, 1772492746, 1661202178, 478084322}
+
+# Файлы для сохранения данных
+FLAGS_FILE = "auto_reply_flags.json"
+WORK_CHAT_FILE = "work_chat.json"
+PENDING_MESSAGES_FILE = "pending_messages.json"
+FUNNELS_CONFIG_FILE = "funnels_config.json"
+EXCLUDED_USERS_FILE = "excluded_users.json"
+FUNNELS_STATE_FILE = "funnels_state.json"
+MASTER_NOTIFICATION_FILE = "master_notification.json"
+BUSINESS_CALENDAR_FILE = "business_calendar.json"
+MESSAGE_HISTORY_FILE = "message_history.jsonl"
+# Текст автоответа; если файла нет - AUTO_REPLY_MESSAGE или текст из настроек бота
+AUTO_REPLY_FILE = "auto_reply.txt"
+ARRIVAL_STATS_FILE = "arrival_stats.json"
+OUTBOX_FILE = "outbox.json"
+UPDATE_DEDUP_FILE = "processed_updates.json"
+LEADER_LEASE_FILE = os.environ.get('LEADER_LEASE_FILE', "leader_lease.sqlite3")
+# Несколько ботов в одном процессе: список ботов с токенами и каталогами данных
+BOTS_CONFIG_FILE = os.environ.get('BOTS_CONFIG_FILE', "bots.json")
+DEFAULT_BOT_NAME = "main"
+# Файл живости: обновляется, пока цикл событий не заблокирован
+HEALTH_FILE = os.environ.get('HEALTH_FILE', "health.json")
+# Локальный JSON API для дашбордов (выключен, пока не задан порт; без токена не запускается)
+API_HOST = os.environ.get('API_HOST', "127.0.0.1")
+API_PORT = int(os.environ.get('API_PORT', '0'))
+API_TOKEN = os.environ.get('API_TOKEN', '')
+# Как часто проверять файлы настроек на изменения, секунд
+CONFIG_WATCH_INTERVAL = float(os.environ.get('CONFIG_WATCH_INTERVAL', '5'))
+
+# ========== ЗАПИСЬ ФАЙЛОВ СОСТОЯНИЯ ==========
+
+class PersistenceWorker:
+    """Одна на процесс очередь записи файлов состояния.
+    
+    Менеджеры всех ботов сериализуют данные в потоке событий (пока их никто
+    не меняет) и отдают готовый текст сюда, а на диск его пишет отдельный поток:
+    через временный файл и os.replace. Несколько записей одного файла, ещё не
+    дошедших до диска, сводятся к последней, и файл встаёт в конец очереди -
+    файлы пишутся в порядке их последнего сохранения (отметка обработанных
+    обновлений остаётся после непрочитанных).
+    """
+    
+    def __init__(self):
+        self.pending: Dict[str, tuple] = {}
+        self.condition = threading.Condition()
+        self.busy = False
+        self.stopping = False
+        self.writes_count = 0
+        self.coalesced_count = 0
+        self.errors_count = 0
+        self.thread = threading.Thread(target=self.run, name="persistence", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+    
+    def write_json(self, path: str, data: Any, description: str, **dump_kwargs) -> bool:
+        """Ставит JSON в очередь записи; description - для сообщения об ошибке"""
+        try:
+            content = json.dumps(data, **dump_kwargs)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {description}: {e}")
+            return False
+        with self.condition:
+            if self.pending.pop(path, None) is not None:
+                self.coalesced_count += 1
+            self.pending[path] = (content, description)
+            self.condition.notify_all()
+        return True
+    
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopping:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                path = next(iter(self.pending))
+                content, description = self.pending.pop(path)
+                self.busy = True
+            try:
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(content)
+                os.replace(tmp_path, path)
+                self.writes_count += 1
+            except Exception as e:
+                self.errors_count += 1
+                logger.error(f"Ошибка сохранения {description}: {e}")
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+    
+    def flush(self, timeout: float = None) -> bool:
+        """Ждёт, пока очередь запишется на диск (из потока событий - только при остановке)"""
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+    
+    def close(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        self.thread.join()
+    
+    def queued(self) -> int:
+        return len(self.pending)
+
+persistence = PersistenceWorker()
+
+# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ГЛАВНЫМ УВЕДОМЛЕНИЕМ ==========
+
+class MasterNotificationManager:
+    def __init__(self):
+        self.data = self.load_data()
+        # Время последней отправки и следующего запуска хранятся в файле,
+        # чтобы перезапуск не обходил cooldown
+        last_time = self.data.get("last_notification_time")
+        self.last_notification_time = datetime.fromisoformat(last_time) if last_time else None
+        # Частоту задаёт планировщик, cooldown лишь не даёт слать чаще нижней границы
+        self.notification_cooldown = CADENCE_MIN_SECONDS
+    
+    def load_data(self) -> Dict[str, Any]:
+        """Загружает данные главного уведомления из файла"""
+        try:
+            if os.path.exists(state_path(MASTER_NOTIFICATION_FILE)):
+                with open(state_path(MASTER_NOTIFICATION_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки главного уведомления: {e}")
+        return {"message_ids": [], "last_update": None}
+    
+    def save_data(self):
+        """Сохраняет данные главного уведомления в файл"""
+        persistence.write_json(state_path(MASTER_NOTIFICATION_FILE), self.data, "главного уведомления", indent=2)
+    
+    def get_chat_data(self, chat_id: int) -> Dict[str, Any]:
+        """Данные уведомления конкретного рабочего чата"""
+        return self.data.setdefault("chats", {}).setdefault(str(chat_id), {"message_ids": []})
+    
+    def add_message_id(self, message_id: int, chat_id: int):
+        """Добавляет ID сообщения в список рабочего чата"""
+        self.get_chat_data(chat_id)["message_ids"].append(message_id)
+        self.data["last_update"] = datetime.now(MOSCOW_TZ).isoformat()
+        self.save_data()
+        logger.info(f"✅ Добавлен ID уведомления: {message_id} (чат {chat_id})")
+    
+    def get_message_ids(self, chat_id: int) -> List[int]:
+        """Возвращает список ID сообщений уведомлений рабочего чата"""
+        return self.data.get("chats", {}).get(str(chat_id), {}).get("message_ids", [])
+    
+    def take_message_ids(self, chat_id: int, include_legacy: bool = False) -> List[int]:
+        """Забирает ID уведомлений чата для удаления (include_legacy - и общий список старого формата)"""
+        message_ids = self.get_chat_data(chat_id)["message_ids"]
+        self.get_chat_data(chat_id)["message_ids"] = []
+        if include_legacy:
+            message_ids = self.data.pop("message_ids", []) + message_ids
+        self.save_data()
+        return message_ids
+    
+    def clear_old_messages(self, chat_id: int, keep_last: int = 3):
+        """Очищает старые сообщения, оставляя только последние"""
+        chat_data = self.get_chat_data(chat_id)
+        if len(chat_data["message_ids"]) > keep_last:
+            # Оставляем только последние keep_last сообщений
+            chat_data["message_ids"] = chat_data["message_ids"][-keep_last:]
+            self.save_data()
+    
+    def get_last_time(self, chat_id: int = None) -> Optional[datetime]:
+        """Время последней отправки (в рабочий чат или в любой, если чат не указан)"""
+        if chat_id is None:
+            return self.last_notification_time
+        last_time = self.data.get("chats", {}).get(str(chat_id), {}).get("last_notification_time")
+        return datetime.fromisoformat(last_time) if last_time else None
+    
+    def should_update(self, chat_id: int = None) -> bool:
+        """Проверяет, нужно ли обновлять уведомление (не чаще CADENCE_MIN_SECONDS - нижней границы интервала)"""
+        last_time = self.get_last_time(chat_id)
+        # Если никогда не отправляли - отправляем
+        if not last_time:
+            return True
+        
+        now = datetime.now(MOSCOW_TZ)
+        time_diff = now - last_time
+        
+        return time_diff.total_seconds() >= self.notification_cooldown
+    
+    def get_next_run(self) -> Optional[datetime]:
+        """Запланированное время следующей проверки (сохраняется между перезапусками)"""
+        next_run = self.data.get("next_run")
+        return datetime.fromisoformat(next_run) if next_run else None
+    
+    def set_next_run(self, next_run: datetime):
+        self.data["next_run"] = next_run.isoformat()
+        self.save_data()
+    
+    def update_notification_time(self, chat_id: int = None):
+        """Обновляет время последней отправки уведомления"""
+        self.last_notification_time = datetime.now(MOSCOW_TZ)
+        self.data["last_notification_time"] = self.last_notification_time.isoformat()
+        if chat_id is not None:
+            self.get_chat_data(chat_id)["last_notification_time"] = self.last_notification_time.isoformat()
+        self.save_data()
+        logger.info(f"🕐 Обновлено время уведомления: {self.last_notification_time.strftime('%H:%M:%S')}")
+
+# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ СОСТОЯНИЕМ ВОРОНОК ==========
+
+class FunnelsStateManager:
+    def __init__(self):
+        self.state = self.load_state()
+    
+    def load_state(self) -> Dict[str, Any]:
+        """Загружает состояние воронок из файла"""
+        try:
+            if os.path.exists(state_path(FUNNELS_STATE_FILE)):
+                with open(state_path(FUNNELS_STATE_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки состояния воронок: {e}")
+        
+        return {
+            "last_funnel_1_check": None,
+            "last_funnel_2_check": None, 
+            "last_funnel_3_check": None,
+            "funnel_1_messages_processed": [],
+            "funnel_2_messages_processed": [],
+            "funnel_3_messages_processed": []
+        }
+    
+    def save_state(self):
+        """Сохраняет состояние воронок в файл"""
+        persistence.write_json(state_path(FUNNELS_STATE_FILE), self.state, "состояния воронок", indent=2, default=str)
+    
+    def update_last_check(self, funnel_number: int):
+        """Обновляет время последней проверки для воронки"""
+        self.state[f"last_funnel_{funnel_number}_check"] = datetime.now(MOSCOW_TZ).isoformat()
+        self.save_state()
+    
+    def get_last_check(self, funnel_number: int) -> datetime:
+        """Возвращает время последней проверки для воронки"""
+        timestamp = self.state.get(f"last_funnel_{funnel_number}_check")
+        if timestamp:
+            return datetime.fromisoformat(timestamp)
+        return datetime.now(MOSCOW_TZ) - timedelta(days=1)
+    
+    def add_processed_message(self, funnel_number: int, message_key: str):
+        """Добавляет сообщение в список обработанных для воронки"""
+        key = f"funnel_{funnel_number}_messages_processed"
+        processed = self.state.setdefault(key, [])
+        if message_key not in processed:
+            processed.append(message_key)
+            self.save_state()
+    
+    def is_message_processed(self, funnel_number: int, message_key: str) -> bool:
+        """Проверяет, было ли сообщение уже обработано воронкой"""
+        key = f"funnel_{funnel_number}_messages_processed"
+        return message_key in self.state.get(key, [])
+    
+    def clear_processed_messages(self, funnel_number: int):
+        """Очищает список обработанных сообщений для воронки"""
+        key = f"funnel_{funnel_number}_messages_processed"
+        self.state[key] = []
+        self.save_state()
+
+# ========== КЛАСС ДЛЯ УПРАВЛЕНИЯ ИСКЛЮЧЕНИЯМИ ==========
+
+USERNAME_PATTERN = re.compile(r'^[A-Za-z][A-Za-z0-9_]{2,31}$')
+IMPORT_ID_COLUMNS = {"id", "user_id", "userid", "telegram_id"}
+IMPORT_USERNAME_COLUMNS = {"username", "user_name", "login", "логин"}
+
+def parse_user_identifier(token: str):
+    """ID (int) или username (str без @, в нижнем регистре); None - не распознан"""
+    token = token.strip().strip('"\'')
+    if token.isdigit():
+        return int(token)
+    username = token.lstrip('@')
+    if USERNAME_PATTERN.match(username):
+        return username.lower()
+    return None
+
+def parse_identifiers_document(content: str) -> List[str]:
+    """Идентификаторы из загруженного CSV/текстового файла.
+    
+    Если первая строка - заголовок CSV, берутся только колонки id/username,
+    иначе - все непустые ячейки через запятую, точку с запятой или пробел.
+    """
+    lines = content.lstrip('\ufeff').splitlines()
+    if not lines:
+        return []
+    try:
+        dialect = csv.Sniffer().sniff(lines[0], delimiters=",;\t")
+    except csv.Error:
+        dialect = None
+    if dialect:
+        rows = list(csv.reader(lines, dialect))
+        header = [cell.strip().casefold() for cell in rows[0]]
+        columns = [i for i, name in enumerate(header) if name in IMPORT_ID_COLUMNS | IMPORT_USERNAME_COLUMNS]
+        if columns:
+            return [row[i] for row in rows[1:] for i in columns if i < len(row) and row[i].strip()]
+    return [token for token in re.split(r'[\s,;]+', content.lstrip('\ufeff')) if token]
+
+class ExcludedUsersManager:
+    def __init__(self):
+        self.excluded_users = self.load_excluded_users()
+        self.rebuild_lookup()
+    
+    def rebuild_lookup(self):
+        """Множества для проверки менеджеров; подменяются одним присваиванием"""
+        self.lookup = (frozenset(self.excluded_users["user_ids"]),
+                       frozenset(u.lower() for u in self.excluded_users["usernames"]))
+    
+    def reload(self):
+        self.excluded_users = self.load_excluded_users()
+        self.rebuild_lookup()
+    
+    def load_excluded_users(self) -> Dict[str, Any]:
+        """Загружает список исключенных пользователей из файла"""
+        try:
+            if os.path.exists(state_path(EXCLUDED_USERS_FILE)):
+                with open(state_path(EXCLUDED_USERS_FILE), 'r') as f:
+                    data = json.load(f)
+                    return data
+        except Exception as e:
+            logger.error(f"Ошибка загрузки исключенных пользователей: {e}")
+        
+        return {
+            "user_ids": [433733509, 1661202178, 478084322, 868325393, 1438860417, 879901619, 6107771545, 253353687, 2113096625, 91047831, 7842709072],
+            "usernames": []
+        }
+    
+    def save_excluded_users(self):
+        """Сохраняет список исключенных пользователей в файл"""
+        persistence.write_json(state_path(EXCLUDED_USERS_FILE), self.excluded_users, "исключенных пользователей", indent=2)
+    
+    def is_user_excluded(self, user_id: int, username: str = None) -> bool:
+        """Проверяет, является ли пользователь исключенным"""
+        user_ids, usernames = self.lookup
+        if user_id in user_ids:
+            return True
+        
+        if username and username.lower() in usernames:
+            return True
+        
+        return False
+    
+    def add_user_id(self, user_id: int) -> bool:
+        """Добавляет ID пользователя в исключения"""
+        if user_id not in self.excluded_users["user_ids"]:
+            self.excluded_users["user_ids"].append(user_id)
+            self.rebuild_lookup()
+            self.save_excluded_users()
+            logger.info(f"✅ Добавлен ID в исключения: {user_id}")
+            return True
+        return False
+    
+    def add_username(self, username: str) -> bool:
+        """Добавляет username в исключения"""
+        username = username.lstrip('@').lower()
+        if username not in [u.lower() for u in self.excluded_users["usernames"]]:
+            self.excluded_users["usernames"].append(username)
+            self.rebuild_lookup()
+            self.save_excluded_users()
+            logger.info(f"✅ Добавлен username в исключения: @{username}")
+            return True
+        return False
+    
+    def remove_user_id(self, user_id: int) -> bool:
+        """Удаляет ID пользователя из исключений"""
+        if user_id in self.excluded_users["user_ids"]:
+            self.excluded_users["user_ids"].remove(user_id)
+            self.rebuild_lookup()
+            self.save_excluded_users()
+            logger.info(f"✅ Удален ID из исключений: {user_id}")
+            return True
+        return False
+    
+    def remove_username(self, username: str) -> bool:
+        """Удаляет username из исключений"""
+        username = username.lstrip('@').lower()
+        for u in self.excluded_users["usernames"]:
+            if u.lower() == username:
+                self.excluded_users["usernames"].remove(u)
+                self.rebuild_lookup()
+                self.save_excluded_users()
+                logger.info(f"✅ Удален username из исключений: @{username}")
+                return True
+        return False
+    
+    def apply_batch(self, tokens: List[str], remove: bool = False) -> Dict[str, List[str]]:
+        """Добавляет/удаляет пачку идентификаторов за одну проверку и одну запись файла.
+        
+        Возвращает {"applied": [...], "skipped": [...], "invalid": [...]}:
+        skipped - уже были в исключениях (или не найдены при удалении) и повторы.
+        """
+        user_ids, usernames = self.lookup
+        new_ids = list(self.excluded_users["user_ids"])
+        new_usernames = list(self.excluded_users["usernames"])
+        result = {"applied": [], "skipped": [], "invalid": []}
+        seen = set()
+        
+        for token in tokens:
+            identifier = parse_user_identifier(token)
+            if identifier is None:
+                result["invalid"].append(token)
+                continue
+            label = str(identifier) if isinstance(identifier, int) else f"@{identifier}"
+            present = identifier in (user_ids if isinstance(identifier, int) else usernames)
+            if identifier in seen or present != remove:
+                result["skipped"].append(label)
+                continue
+            seen.add(identifier)
+            result["applied"].append(label)
+            if isinstance(identifier, int):
+                if remove:
+                    new_ids.remove(identifier)
+                else:
+                    new_ids.append(identifier)
+            elif remove:
+                new_usernames = [u for u in new_usernames if u.lower() != identifier]
+            else:
+                new_usernames.append(identifier)
+        
+        if result["applied"]:
+            self.excluded_users = {**self.excluded_users, "user_ids": new_ids, "usernames": new_usernames}
+            self.rebuild_lookup()
+            self.save_excluded_users()
+            logger.info(f"✅ Исключения {'удалены' if remove else 'добавлены'} пачкой: {len(result['applied'])}")
+        return result
+    
+    def get_all_excluded(self) -> Dict[str, List]:
+        """Возвращает всех исключенных пользователей"""
+        return self.excluded_users
+    
+    def clear_all(self):
+        """Очищает все исключения"""
+        self.excluded_users = {"user_ids": [], "usernames": []}
+        self.rebuild_lookup()
+        self.save_excluded_users()
+        logger.info("✅ Все исключения очищены")
+
+# ========== КЛАССЫ ДЛЯ УПРАВЛЕНИЯ ДАННЫМИ ==========
+
+DEFAULT_FUNNEL_STAGES = [
+    {"interval": 60, "emoji": "🟡", "label": "начальное уведомление"},    # 1 час
+    {"interval": 180, "emoji": "🟠", "label": "повторное уведомление"},   # 3 часа
+    {"interval": 300, "emoji": "🔴", "label": "срочное уведомление"}      # 5 часов
+]
+
+class FunnelsConfig:
+    """Упорядоченный список стадий воронки (интервал, эмодзи, подпись).
+    
+    Классификация возраста сообщения - bisect по отсортированным порогам,
+    для массовой переклассификации есть векторный путь classify_batch.
+    """
+    
+    def __init__(self):
+        self.stages = self.load_funnels()
+        self.rebuild_thresholds()
+    
+    def load_funnels(self) -> List[Dict[str, Any]]:
+        """Загружает конфигурацию воронок из файла или использует значения по умолчания"""
+        try:
+            if os.path.exists(state_path(FUNNELS_CONFIG_FILE)):
+                with open(state_path(FUNNELS_CONFIG_FILE), 'r') as f:
+                    return self.parse_stages(json.load(f))
+        except Exception as e:
+            logger.error(f"Ошибка загрузки конфигурации воронок: {e}")
+        
+        return [dict(stage) for stage in DEFAULT_FUNNEL_STAGES]
+    
+    @staticmethod
+    def parse_stages(data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Стадии из содержимого файла; ValueError, если пороги не положительные или повторяются"""
+        if "stages" in data:
+            stages = [dict(stage) for stage in data["stages"]]
+        else:
+            # Старый формат: {"1": 60, "2": 180, "3": 300}
+            stages = []
+            for number, minutes in sorted((int(k), v) for k, v in data.items()):
+                stage = dict(DEFAULT_FUNNEL_STAGES[number - 1]) if number <= len(DEFAULT_FUNNEL_STAGES) else {"emoji": "⚪", "label": ""}
+                stage["interval"] = minutes
+                stages.append(stage)
+        intervals = sorted(stage["interval"] for stage in stages)
+        if not stages or not all(isinstance(minutes, int) and minutes > 0 for minutes in intervals):
+            raise ValueError("нужна хотя бы одна стадия с положительным целым интервалом")
+        if len(set(intervals)) != len(intervals):
+            raise ValueError("интервалы стадий повторяются")
+        stages.sort(key=lambda stage: stage["interval"])
+        return stages
+    
+    def save_funnels(self):
+        """Сохраняет конфигурацию воронок в файл"""
+        persistence.write_json(state_path(FUNNELS_CONFIG_FILE), {"stages": self.stages}, "конфигурации воронок", indent=2, ensure_ascii=False)
+    
+    def rebuild_thresholds(self):
+        """Пересобирает отсортированные пороги для bisect/searchsorted"""
+        self.stages.sort(key=lambda stage: stage["interval"])
+        self.thresholds = [stage["interval"] for stage in self.stages]
+        self.funnels = {number: minutes for number, minutes in enumerate(self.thresholds, 1)}
+        self.thresholds_array = numpy.array(self.thresholds, dtype=numpy.float64) if numpy is not None else None
+        self.version = getattr(self, 'version', 0) + 1
+    
+    def get_funnels(self) -> Dict[int, int]:
+        """Возвращает текущую конфигурацию воронок"""
+        return self.funnels
+    
+    def get_stages(self) -> List[Dict[str, Any]]:
+        return self.stages
+    
+    def stage_count(self) -> int:
+        return len(self.stages)
+    
+    def get_emoji(self, funnel_number: int) -> str:
+        if 1 <= funnel_number <= len(self.stages):
+            return self.stages[funnel_number - 1].get("emoji", "⚪")
+        return "⚪"
+    
+    def get_label(self, funnel_number: int) -> str:
+        if 1 <= funnel_number <= len(self.stages):
+            return self.stages[funnel_number - 1].get("label", "")
+        return ""
+    
+    def classify(self, minutes_passed: float) -> int:
+        """Номер стадии для возраста в минутах (0 - ни одна стадия не достигнута)"""
+        return bisect.bisect_right(self.thresholds, minutes_passed)
+    
+    def classify_batch(self, minutes_column) -> Sequence[int]:
+        """Номера стадий для колонки возрастов (NumPy searchsorted, если доступен)"""
+        if numpy is not None:
+            return numpy.searchsorted(self.thresholds_array, numpy.asarray(minutes_column), side='right')
+        thresholds = self.thresholds
+        bisect_right = bisect.bisect_right
+        return array('b', [bisect_right(thresholds, minutes) for minutes in minutes_column])
+    
+    def set_funnel_interval(self, funnel_number: int, minutes: int) -> bool:
+        """Устанавливает интервал для указанной воронки (порядок стадий должен сохраниться)"""
+        if not 1 <= funnel_number <= len(self.stages) or minutes <= 0:
+            return False
+        lower = self.thresholds[funnel_number - 2] if funnel_number > 1 else 0
+        upper = self.thresholds[funnel_number] if funnel_number < len(self.stages) else None
+        if minutes <= lower or (upper is not None and minutes >= upper):
+            return False
+        
+        self.stages[funnel_number - 1]["interval"] = minutes
+        self.rebuild_thresholds()
+        self.save_funnels()
+        logger.info(f"Установлен интервал для воронки {funnel_number}: {minutes} минут")
+        return True
+    
+    def add_stage(self, minutes: int, emoji: str = "⚪", label: str = "") -> int:
+        """Добавляет стадию; возвращает её номер или 0, если интервал занят"""
+        if minutes <= 0 or minutes in self.thresholds:
+            return 0
+        self.stages.append({"interval": minutes, "emoji": emoji, "label": label})
+        self.rebuild_thresholds()
+        self.save_funnels()
+        logger.info(f"Добавлена воронка на {minutes} минут")
+        return self.thresholds.index(minutes) + 1
+    
+    def remove_stage(self, funnel_number: int) -> bool:
+        """Удаляет стадию (последняя оставшаяся не удаляется)"""
+        if not 1 <= funnel_number <= len(self.stages) or len(self.stages) == 1:
+            return False
+        del self.stages[funnel_number - 1]
+        self.rebuild_thresholds()
+        self.save_funnels()
+        logger.info(f"Удалена воронка {funnel_number}")
+        return True
+    
+    def get_funnel_interval(self, funnel_number: int) -> int:
+        """Возвращает интервал для указанной воронки"""
+        return self.funnels.get(funnel_number, 0)
+    
+    def reset_to_default(self):
+        """Сбрасывает настройки воронок к значениям по умолчанию"""
+        self.stages = [dict(stage) for stage in DEFAULT_FUNNEL_STAGES]
+        self.rebuild_thresholds()
+        self.save_funnels()
+        logger.info("Настройки воронок сброшены к значениям по умолчанию")
+
+# ========== БИЗНЕС-КАЛЕНДАРЬ ==========
+
+DEFAULT_BUSINESS_CALENDAR = {
+    "weekdays": [0, 1, 2, 3, 4],  # понедельник - пятница
+    "start": "10:00",
+    "end": "19:00",
+    "holidays": [],
+    "overrides": {}  # "YYYY-MM-DD": ["HH:MM", "HH:MM"] или null (выходной)
+}
+
+WEEKDAY_NAMES = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"]
+
+def parse_hhmm(value: str) -> time:
+    hours, minutes = value.split(':')
+    return time(int(hours), int(minutes))
+
+def to_epoch(moment=None) -> float:
+    """datetime/epoch/None (сейчас) -> epoch-секунды"""
+    if moment is None:
+        return datetime.now(MOSCOW_TZ).timestamp()
+    if isinstance(moment, datetime):
+        return moment.timestamp()
+    return float(moment)
+
+class BusinessCalendar:
+    """Рабочее время компании: будни, праздники и переопределения отдельных дней.
+    
+    Календарь компилируется в отсортированный индекс рабочих интервалов
+    (epoch-секунды) с префиксными суммами рабочего времени, поэтому
+    is_working_time и business_minutes_between работают за O(log n).
+    Интервалы каждого дня кэшируются.
+    """
+    
+    HORIZON_BACK_DAYS = 60
+    HORIZON_FORWARD_DAYS = 30
+    
+    def __init__(self):
+        self.config = self.load_calendar()
+        self.compile()
+    
+    def load_calendar(self) -> Dict[str, Any]:
+        """Загружает настройки календаря из файла"""
+        config = json.loads(json.dumps(DEFAULT_BUSINESS_CALENDAR))
+        try:
+            if os.path.exists(state_path(BUSINESS_CALENDAR_FILE)):
+                with open(state_path(BUSINESS_CALENDAR_FILE), 'r') as f:
+                    config.update(json.load(f))
+        except Exception as e:
+            logger.error(f"Ошибка загрузки бизнес-календаря: {e}")
+        return config
+    
+    def save_calendar(self):
+        """Сохраняет настройки календаря и перекомпилирует индекс"""
+        persistence.write_json(state_path(BUSINESS_CALENDAR_FILE), self.config, "бизнес-календаря", indent=2)
+        self.compile()
+    
+    def day_intervals(self, day: date) -> List[tuple]:
+        """Рабочие интервалы дня в epoch-секундах (с кэшем на день)"""
+        cached = self.day_cache.get(day)
+        if cached is not None:
+            return cached
+        
+        day_str = day.isoformat()
+        overrides = self.config.get("overrides", {})
+        if day_str in overrides:
+            hours = overrides[day_str]
+        elif day_str in self.config.get("holidays", []) or day.weekday() not in self.config.get("weekdays", []):
+            hours = None
+        else:
+            hours = [self.config["start"], self.config["end"]]
+        
+        intervals = []
+        if hours:
+            start = MOSCOW_TZ.localize(datetime.combine(day, parse_hhmm(hours[0]))).timestamp()
+            end = MOSCOW_TZ.localize(datetime.combine(day, parse_hhmm(hours[1]))).timestamp()
+            if end > start:
+                intervals.append((start, end))
+        self.day_cache[day] = intervals
+        return intervals
+    
+    def compile(self, first_day: date = None, last_day: date = None):
+        """Строит индекс интервалов для диапазона дат"""
+        today = datetime.now(MOSCOW_TZ).date()
+        self.first_day = first_day or today - timedelta(days=self.HORIZON_BACK_DAYS)
+        self.last_day = last_day or today + timedelta(days=self.HORIZON_FORWARD_DAYS)
+        self.day_cache: Dict[date, List[tuple]] = {}
+        
+        self.starts = array('d')
+        self.ends = array('d')
+        self.cumulative = array('d')  # рабочие секунды до начала интервала
+        total = 0.0
+        day = self.first_day
+        while day <= self.last_day:
+            for start, end in self.day_intervals(day):
+                self.starts.append(start)
+                self.ends.append(end)
+                self.cumulative.append(total)
+                total += end - start
+            day += timedelta(days=1)
+        self.total_seconds = total
+        self.range_start = MOSCOW_TZ.localize(datetime.combine(self.first_day, time(0, 0))).timestamp()
+        self.range_end = MOSCOW_TZ.localize(datetime.combine(self.last_day + timedelta(days=1), time(0, 0))).timestamp()
+    
+    def ensure_covered(self, *epochs: float):
+        """Расширяет индекс, если момент времени выходит за его границы"""
+        low, high = min(epochs), max(epochs)
+        if low >= self.range_start and high < self.range_end:
+            return
+        first_day = self.first_day
+        last_day = self.last_day
+        if low < self.range_start:
+            first_day = datetime.fromtimestamp(low, MOSCOW_TZ).date() - timedelta(days=self.HORIZON_BACK_DAYS)
+        if high >= self.range_end:
+            last_day = datetime.fromtimestamp(high, MOSCOW_TZ).date() + timedelta(days=self.HORIZON_FORWARD_DAYS)
+        self.compile(first_day, last_day)
+    
+    def is_working_time(self, moment=None) -> bool:
+        """Рабочее ли время в указанный момент (datetime или epoch)"""
+        epoch = to_epoch(moment)
+        self.ensure_covered(epoch)
+        i = bisect.bisect_right(self.starts, epoch) - 1
+        return i >= 0 and epoch < self.ends[i]
+    
+    def business_seconds_at(self, epoch: float) -> float:
+        """Рабочие секунды от начала индекса до момента epoch"""
+        i = bisect.bisect_right(self.starts, epoch) - 1
+        if i < 0:
+            return 0.0
+        return self.cumulative[i] + min(epoch, self.ends[i]) - self.starts[i]
+    
+    def business_seconds_batch(self, epochs) -> Sequence[float]:
+        """business_seconds_at для колонки моментов (NumPy searchsorted, если доступен)"""
+        if not len(epochs):
+            return array('d')
+        self.ensure_covered(min(epochs), max(epochs))
+        if numpy is None or not self.starts:
+            return array('d', [self.business_seconds_at(epoch) for epoch in epochs])
+        epochs = numpy.asarray(epochs, dtype=numpy.float64)
+        starts = numpy.frombuffer(self.starts, dtype=numpy.float64)
+        ends = numpy.frombuffer(self.ends, dtype=numpy.float64)
+        cumulative = numpy.frombuffer(self.cumulative, dtype=numpy.float64)
+        index = numpy.searchsorted(starts, epochs, side='right') - 1
+        clipped = numpy.maximum(index, 0)
+        seconds = cumulative[clipped] + numpy.minimum(epochs, ends[clipped]) - starts[clipped]
+        return numpy.where(index >= 0, seconds, 0.0)
+    
+    def business_minutes_between(self, a, b) -> float:
+        """Рабочие минуты между двумя моментами (datetime или epoch)"""
+        a, b = to_epoch(a), to_epoch(b)
+        self.ensure_covered(a, b)
+        return (self.business_seconds_at(b) - self.business_seconds_at(a)) / 60
+    
+    def cutoff_epoch(self, now, minutes: float) -> float:
+        """Самый поздний момент, от которого до now прошло не меньше minutes рабочих минут"""
+        now = to_epoch(now)
+        self.ensure_covered(now)
+        target = self.business_seconds_at(now) - minutes * 60
+        while target < 0 and self.first_day > date(2000, 1, 1):
+            # Индекс слишком короткий - расширяем назад и пересчитываем
+            self.compile(self.first_day - timedelta(days=self.HORIZON_BACK_DAYS * 2), self.last_day)
+            target = self.business_seconds_at(now) - minutes * 60
+        if target < 0:
+            return float('-inf')
+        i = bisect.bisect_right(self.cumulative, target) - 1
+        return self.starts[i] + (target - self.cumulative[i])
+    
+    def next_working_time(self, moment=None) -> float:
+        """Ближайший момент рабочего времени (сам момент, если он рабочий)"""
+        epoch = to_epoch(moment)
+        self.ensure_covered(epoch)
+        for _ in range(2):
+            i = bisect.bisect_right(self.starts, epoch) - 1
+            if i >= 0 and epoch < self.ends[i]:
+                return epoch
+            if i + 1 < len(self.starts):
+                return self.starts[i + 1]
+            # Впереди нет рабочих интервалов - расширяем индекс вперёд
+            self.compile(self.first_day, self.last_day + timedelta(days=self.HORIZON_FORWARD_DAYS * 4))
+        return epoch
+    
+    def set_holiday(self, day: date, is_holiday: bool = True) -> bool:
+        holidays = self.config.setdefault("holidays", [])
+        day_str = day.isoformat()
+        if is_holiday == (day_str in holidays):
+            return False
+        if is_holiday:
+            holidays.append(day_str)
+            holidays.sort()
+        else:
+            holidays.remove(day_str)
+        self.save_calendar()
+        return True
+    
+    def set_day_override(self, day: date, hours: Optional[List[str]]):
+        """Переопределяет часы дня (None - выходной)"""
+        self.config.setdefault("overrides", {})[day.isoformat()] = hours
+        self.save_calendar()
+    
+    def clear_day_override(self, day: date) -> bool:
+        overrides = self.config.get("overrides", {})
+        if day.isoformat() not in overrides:
+            return False
+        del overrides[day.isoformat()]
+        self.save_calendar()
+        return True
+
+class AutoReplyFlags:
+    def __init__(self):
+        self.flags = self.load_flags()
+        self.batching = False
+        self.dirty = False
+    
+    def load_flags(self) -> Dict[str, bool]:
+        try:
+            if os.path.exists(state_path(FLAGS_FILE)):
+                with open(state_path(FLAGS_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки флагов: {e}")
+        return {}
+    
+    def save_flags(self):
+        if self.batching:
+            self.dirty = True
+            return
+        self.dirty = False
+        persistence.write_json(state_path(FLAGS_FILE), self.flags, "флагов")
+    
+    def begin_batch(self):
+        """Откладывает запись файла до end_batch"""
+        self.batching = True
+    
+    def end_batch(self):
+        self.batching = False
+        if self.dirty:
+            self.save_flags()
+    
+    def has_replied(self, key: str) -> bool:
+        return self.flags.get(key, False)
+    
+    def set_replied(self, key: str):
+        self.flags[key] = True
+        self.save_flags()
+    
+    def clear_replied(self, key: str):
+        if key in self.flags:
+            del self.flags[key]
+            self.save_flags()
+    
+    def clear_all(self):
+        self.flags = {}
+        self.save_flags()
+    
+    def count_flags(self):
+        return len(self.flags)
+
+class WorkChatManager:
+    """Рабочие чаты и маршрутизация клиентских чатов по тегам.
+    
+    work_chat_id - рабочий чат по умолчанию. Клиентский чат получает тег явно
+    или по подстроке в названии, тег сопоставлен своему рабочему чату.
+    Тег чата вычисляется один раз и кэшируется, поэтому маршрут - O(1).
+    """
+    
+    def __init__(self, data: Dict[str, Any] = None):
+        if data is None:
+            data = self.load_work_chat()
+        self.work_chat_id = data.get('work_chat_id')
+        self.routes: Dict[str, int] = data.get('routes', {})
+        self.chat_tags: Dict[str, str] = data.get('chat_tags', {})
+        self.title_patterns: Dict[str, str] = data.get('title_patterns', {})
+        self.resolved_tags: Dict[int, Optional[str]] = {}
+    
+    def load_work_chat(self) -> Dict[str, Any]:
+        try:
+            if os.path.exists(state_path(WORK_CHAT_FILE)):
+                with open(state_path(WORK_CHAT_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки рабочего чата: {e}")
+        return {}
+    
+    def save_config(self) -> bool:
+        return persistence.write_json(state_path(WORK_CHAT_FILE), {
+            'work_chat_id': self.work_chat_id,
+            'routes': self.routes,
+            'chat_tags': self.chat_tags,
+            'title_patterns': self.title_patterns
+        }, "рабочего чата", ensure_ascii=False)
+    
+    def save_work_chat(self, chat_id):
+        self.work_chat_id = chat_id
+        return self.save_config()
+    
+    def get_work_chat_id(self):
+        return self.work_chat_id
+    
+    def is_work_chat_set(self):
+        return self.work_chat_id is not None or bool(self.routes)
+    
+    def get_all_work_chats(self) -> List[int]:
+        """Все рабочие чаты: по умолчанию и назначенные тегам"""
+        work_chats = [self.work_chat_id] if self.work_chat_id is not None else []
+        for chat_id in self.routes.values():
+            if chat_id not in work_chats:
+                work_chats.append(chat_id)
+        return work_chats
+    
+    def get_tag(self, chat_id: int, chat_title: str = None) -> Optional[str]:
+        if chat_id in self.resolved_tags:
+            return self.resolved_tags[chat_id]
+        tag = self.chat_tags.get(str(chat_id))
+        if tag is None and chat_title:
+            title = chat_title.casefold()
+            for pattern, pattern_tag in self.title_patterns.items():
+                if pattern in title:
+                    tag = pattern_tag
+                    break
+        self.resolved_tags[chat_id] = tag
+        return tag
+    
+    def route(self, chat_id: int, chat_title: str = None) -> Optional[int]:
+        """Рабочий чат, в уведомление которого попадает клиентский чат"""
+        tag = self.get_tag(chat_id, chat_title)
+        if tag is not None and tag in self.routes:
+            return self.routes[tag]
+        return self.work_chat_id
+    
+    def set_route(self, tag: str, work_chat_id: int) -> bool:
+        self.routes[tag.lower()] = work_chat_id
+        return self.save_config()
+    
+    def remove_route(self, tag: str) -> bool:
+        if self.routes.pop(tag.lower(), None) is None:
+            return False
+        return self.save_config()
+    
+    def set_chat_tag(self, chat_id: int, tag: Optional[str]) -> bool:
+        """Назначает тег клиентскому чату (None - снять)"""
+        if tag is None:
+            self.chat_tags.pop(str(chat_id), None)
+        else:
+            self.chat_tags[str(chat_id)] = tag.lower()
+        self.resolved_tags.pop(chat_id, None)
+        return self.save_config()
+    
+    def add_title_pattern(self, pattern: str, tag: str) -> bool:
+        self.title_patterns[pattern.casefold()] = tag.lower()
+        self.resolved_tags = {}
+        return self.save_config()
+    
+    def remove_title_pattern(self, pattern: str) -> bool:
+        if self.title_patterns.pop(pattern.casefold(), None) is None:
+            return False
+        self.resolved_tags = {}
+        return self.save_config()
+
+class MessageHistoryArchive:
+    """Архив закрытых сообщений: одна JSON-строка на запись, только дозапись"""
+    
+    def __init__(self, path: str = MESSAGE_HISTORY_FILE):
+        self.path = path
+    
+    def append(self, messages: List[Dict[str, Any]], reason: str):
+        if not messages:
+            return
+        closed_at = datetime.now(MOSCOW_TZ).isoformat()
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                for message in messages:
+                    record = dict(message, closed_at=closed_at, close_reason=reason)
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        except Exception as e:
+            logger.error(f"Ошибка записи архива сообщений: {e}")
+    
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+    
+    def iter_records(self):
+        """Построчно читает архив, не загружая его в память целиком"""
+        if not self.exists():
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Пропущена повреждённая строка архива")
+
+def tokenize_text(text: str) -> List[str]:
+    """Слова текста для поиска: регистр и ё не различаются, кириллица - как латиница"""
+    words = re.findall(r'\w+', text.casefold().replace('ё', 'е'))
+    return [word for word in words if len(word) >= SEARCH_MIN_TOKEN_LENGTH]
+
+class MessageSearchIndex:
+    """Инвертированный индекс по тексту ожидающих и архивных сообщений.
+    
+    Номера документов выдаются по порядку, поэтому списки вхождений - это
+    отсортированные array('I') с одной дозаписью. Вытесненные документы убираются
+    из списков лениво, при уплотнении. Если оценка памяти выходит за бюджет,
+    вытесняются самые давно закрытые архивные сообщения; ожидающие - никогда.
+    """
+    
+    DOC_OVERHEAD = 200
+    TOKEN_OVERHEAD = 120
+    
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self.postings: Dict[str, array] = {}
+        # id -> (chat_id, chat_title, epoch, автор, фрагмент, число слов)
+        self.docs: Dict[int, tuple] = {}
+        self.pending_ids: Dict[str, int] = {}
+        self.pending_docs = set()
+        self.archived_ids = collections.deque()
+        self.next_id = 0
+        self.estimated_bytes = 0
+        self.live_postings = 0
+        self.dead_postings = 0
+        self.evicted = 0
+    
+    def index_archive(self, history: MessageHistoryArchive):
+        """Индексирует архив при запуске (старые записи вытесняются по бюджету)"""
+        try:
+            for record in history.iter_records():
+                self.add(record)
+        except Exception as e:
+            logger.error(f"Ошибка индексации архива сообщений: {e}")
+    
+    def add(self, message: Dict[str, Any], pending_key: str = None) -> int:
+        text = message.get('message_text') or ''
+        tokens = set(tokenize_text(text))
+        doc_id = self.next_id
+        self.next_id += 1
+        epoch = datetime.fromisoformat(message.get('last_timestamp') or message['timestamp']).timestamp()
+        if message.get('username'):
+            author = f"@{message['username']}"
+        else:
+            author = message.get('first_name') or str(message.get('user_id', ''))
+        snippet = text[:SEARCH_SNIPPET_LENGTH]
+        self.docs[doc_id] = (message['chat_id'], message.get('chat_title'), epoch, author, snippet, len(tokens))
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = array('I')
+                self.estimated_bytes += self.TOKEN_OVERHEAD + len(token)
+            posting.append(doc_id)
+        self.live_postings += len(tokens)
+        self.estimated_bytes += self.DOC_OVERHEAD + 2 * len(snippet) + 4 * len(tokens)
+        if pending_key is not None:
+            self.pending_ids[pending_key] = doc_id
+            self.pending_docs.add(doc_id)
+        else:
+            self.archived_ids.append(doc_id)
+            self.enforce_budget()
+        return doc_id
+    
+    def mark_archived(self, keys: List[str]):
+        """Ожидающие сообщения закрыты - остаются в поиске как архивные"""
+        for key in keys:
+            doc_id = self.pending_ids.pop(key, None)
+            if doc_id is not None:
+                self.pending_docs.discard(doc_id)
+                self.archived_ids.append(doc_id)
+        self.enforce_budget()
+    
+    def sync_pending(self, pending_messages: Dict[str, Any]):
+        """Сверяет ожидающие документы с перечитанным файлом сообщений"""
+        self.mark_archived([key for key in self.pending_ids if key not in pending_messages])
+        for key, message in pending_messages.items():
+            if key not in self.pending_ids:
+                self.add(message, key)
+    
+    def enforce_budget(self):
+        while self.estimated_bytes > self.budget_bytes and self.archived_ids:
+            doc_id = self.archived_ids.popleft()
+            doc = self.docs.pop(doc_id, None)
+            if doc is None:
+                continue
+            self.estimated_bytes -= self.DOC_OVERHEAD + 2 * len(doc[4]) + 4 * doc[5]
+            self.live_postings -= doc[5]
+            self.dead_postings += doc[5]
+            self.evicted += 1
+        if self.dead_postings > self.live_postings:
+            self.compact()
+    
+    def compact(self):
+        """Убирает вытесненные документы из списков вхождений"""
+        docs = self.docs
+        for token in list(self.postings):
+            posting = array('I', [doc_id for doc_id in self.postings[token] if doc_id in docs])
+            if posting:
+                self.postings[token] = posting
+            else:
+                del self.postings[token]
+                self.estimated_bytes -= self.TOKEN_OVERHEAD + len(token)
+        self.dead_postings = 0
+    
+    @staticmethod
+    def contains(posting: array, doc_id: int) -> bool:
+        pos = bisect.bisect_left(posting, doc_id)
+        return pos < len(posting) and posting[pos] == doc_id
+    
+    def search(self, query: str, limit: int = SEARCH_RESULTS_LIMIT) -> List[Dict[str, Any]]:
+        """Чаты, где есть сообщение со всеми словами запроса, от свежих к старым.
+        
+        Перебирается самый короткий список вхождений с конца (новые документы),
+        остальные слова проверяются bisect'ом; от каждого чата берётся первое совпадение.
+        """
+        terms = set(tokenize_text(query))
+        if not terms or any(term not in self.postings for term in terms):
+            return []
+        lists = sorted((self.postings[term] for term in terms), key=len)
+        first, rest = lists[0], lists[1:]
+        found: Dict[int, int] = {}
+        for doc_id in reversed(first):
+            doc = self.docs.get(doc_id)
+            if doc is None or doc[0] in found:
+                continue
+            if all(self.contains(posting, doc_id) for posting in rest):
+                found[doc[0]] = doc_id
+                if len(found) >= limit:
+                    break
+        
+        results = []
+        for chat_id, doc_id in found.items():
+            _, chat_title, epoch, author, snippet, _ = self.docs[doc_id]
+            results.append({'chat_id': chat_id, 'chat_title': chat_title, 'epoch': epoch, 'author': author,
+                            'snippet': snippet, 'pending': doc_id in self.pending_docs})
+        results.sort(key=lambda result: result['epoch'], reverse=True)
+        return results
+
+class PendingMessagesManager:
+    def __init__(self, funnels_config: FunnelsConfig, business_calendar: BusinessCalendar, history: MessageHistoryArchive = None, search_index: MessageSearchIndex = None):
+        self.pending_messages = self.load_pending_messages()
+        self.history = history
+        self.search_index = search_index
+        self.funnels_config = funnels_config
+        self.business_calendar = business_calendar
+        self.listeners: List[Callable[[Optional[int]], None]] = []
+        self.chat_index: Dict[int, Dict[str, None]] = {}
+        self.batching = False
+        self.rebuild_chat_index()
+    
+    def rebuild_chat_index(self):
+        """Перестраивает индекс chat_id -> ключи сообщений и отсортированную колонку времени"""
+        self.chat_index = {}
+        self.chat_last_key: Dict[int, str] = {}
+        self.media_group_index: Dict[tuple, str] = {}
+        self.dirty = False
+        rows = []
+        for key, message in self.pending_messages.items():
+            self.chat_index.setdefault(message['chat_id'], {})[key] = None
+            self.chat_last_key[message['chat_id']] = key
+            if message.get('media_group_id'):
+                self.media_group_index[(message['chat_id'], message['media_group_id'])] = key
+            rows.append((datetime.fromisoformat(message['timestamp']).timestamp(), key))
+        rows.sort()
+        # Колонки отсортированы по времени: стадии - это непрерывные диапазоны,
+        # границы которых ищутся bisect'ом (аналог searchsorted)
+        self.epoch_column = array('d', [epoch for epoch, _ in rows])
+        self.column_keys: List[str] = [key for _, key in rows]
+        self.funnel_column = array('h', [self.pending_messages[key].get('current_funnel', 0) for _, key in rows])
+        if self.search_index is not None:
+            self.search_index.sync_pending(self.pending_messages)
+    
+    def column_insert(self, key: str, message: Dict[str, Any]):
+        epoch = datetime.fromisoformat(message['timestamp']).timestamp()
+        pos = bisect.bisect_right(self.epoch_column, epoch)
+        self.epoch_column.insert(pos, epoch)
+        self.column_keys.insert(pos, key)
+        self.funnel_column.insert(pos, message.get('current_funnel', 0))
+    
+    def column_find(self, key: str, message: Dict[str, Any]) -> int:
+        epoch = datetime.fromisoformat(message['timestamp']).timestamp()
+        pos = bisect.bisect_left(self.epoch_column, epoch)
+        while self.column_keys[pos] != key:
+            pos += 1
+        return pos
+    
+    def column_remove(self, key: str, message: Dict[str, Any]):
+        pos = self.column_find(key, message)
+        del self.epoch_column[pos]
+        del self.column_keys[pos]
+        del self.funnel_column[pos]
+    
+    def add_listener(self, callback: Callable[[Optional[int]], None]):
+        """Подписывает обработчик на изменения чатов (None - изменилось всё)"""
+        self.listeners.append(callback)
+    
+    def notify_chat_changed(self, chat_id: Optional[int]):
+        for callback in self.listeners:
+            callback(chat_id)
+    
+    def load_pending_messages(self) -> Dict[str, Any]:
+        try:
+            if os.path.exists(state_path(PENDING_MESSAGES_FILE)):
+                with open(state_path(PENDING_MESSAGES_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки непрочитанных сообщений: {e}")
+        return {}
+    
+    def save_pending_messages(self):
+        if self.batching:
+            self.dirty = True
+            return
+        self.dirty = False
+        persistence.write_json(state_path(PENDING_MESSAGES_FILE), self.pending_messages, "непрочитанных сообщений", indent=2)
+    
+    def find_duplicate(self, chat_id: int, message_id: int) -> Optional[str]:
+        """Ключ записи, уже содержащей это сообщение (повторная доставка обновления).
+        
+        message_id в чате растут монотонно, поэтому сообщение входит в запись,
+        если лежит между её первым и последним склеенным сообщением.
+        """
+        for key in self.chat_index.get(chat_id, ()):
+            message = self.pending_messages[key]
+            if message['message_id'] <= message_id <= message.get('last_message_id', message['message_id']):
+                return key
+        return None
+    
+    def find_coalesce_target(self, chat_id: int, user_id: int, media_group_id: Optional[str], now: datetime) -> Optional[str]:
+        """Ключ записи, в которую нужно склеить новое сообщение (или None)"""
+        if media_group_id:
+            key = self.media_group_index.get((chat_id, media_group_id))
+            if key in self.pending_messages:
+                return key
+        
+        key = self.chat_last_key.get(chat_id)
+        if key not in self.pending_messages:
+            return None
+        message = self.pending_messages[key]
+        if message['user_id'] != user_id:
+            return None
+        last_time = datetime.fromisoformat(message.get('last_timestamp', message['timestamp']))
+        if (now - last_time).total_seconds() <= COALESCE_WINDOW_SECONDS:
+            return key
+        return None
+    
+    def add_message(self, chat_id: int, user_id: int, message_text: str, message_id: int, chat_title: str = None, username: str = None, first_name: str = None, media_group_id: str = None) -> tuple:
+        """Добавляет сообщение или склеивает его с предыдущей записью серии.
+        
+        Возвращает (ключ записи, была ли склейка). Воронка считается от первого
+        сообщения серии, поэтому склейка не меняет классификацию.
+        """
+        now = datetime.now(MOSCOW_TZ)
+        
+        duplicate_key = self.find_duplicate(chat_id, message_id)
+        if duplicate_key:
+            message_logger.info("♻️ Сообщение %s уже учтено в %s, пропускаем", message_id, duplicate_key)
+            return duplicate_key, True
+        
+        target_key = self.find_coalesce_target(chat_id, user_id, media_group_id, now)
+        if target_key:
+            message = self.pending_messages[target_key]
+            message['count'] = message.get('count', 1) + 1
+            message['last_timestamp'] = now.isoformat()
+            message['last_message_id'] = message_id
+            if media_group_id:
+                self.media_group_index[(chat_id, media_group_id)] = target_key
+            self.chat_last_key[chat_id] = target_key
+            # Запись уже есть в файле - счётчик сохранится при следующей записи или flush
+            self.dirty = True
+            self.notify_chat_changed(chat_id)
+            message_logger.debug("➕ Сообщение %s склеено с %s (всего %s)", message_id, target_key, message['count'])
+            return target_key, True
+        
+        key = f"{chat_id}_{user_id}_{message_id}_{int(now.timestamp())}"
+        
+        if not message_text:
+            message_text = "[Сообщение без текста]"
+        
+        self.pending_messages[key] = {
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'message_text': message_text,
+            'message_id': message_id,
+            'chat_title': chat_title,
+            'username': username,
+            'first_name': first_name,
+            'timestamp': now.isoformat(),
+            'last_timestamp': now.isoformat(),
+            'count': 1,
+            'media_group_id': media_group_id,
+            'funnels_sent': [],
+            'current_funnel': 0,
+            'message_key': key
+        }
+        self.chat_index.setdefault(chat_id, {})[key] = None
+        self.chat_last_key[chat_id] = key
+        if media_group_id:
+            self.media_group_index[(chat_id, media_group_id)] = key
+        self.column_insert(key, self.pending_messages[key])
+        if self.search_index is not None:
+            self.search_index.add(self.pending_messages[key], key)
+        self.notify_chat_changed(chat_id)
+        self.save_pending_messages()
+        message_logger.info("✅ Добавлено непрочитанное сообщение: %s", key)
+        return key, False
+    
+    def flush(self):
+        """Сохраняет отложенные изменения (счётчики склеенных серий)"""
+        if self.dirty:
+            self.save_pending_messages()
+    
+    def begin_batch(self):
+        """Откладывает запись файла до end_batch (применение пачки обновлений)"""
+        self.batching = True
+    
+    def end_batch(self):
+        self.batching = False
+        self.flush()
+    
+    def forget_chat_links(self, chat_id: int):
+        """Убирает ссылки склейки для чата без сообщений"""
+        self.chat_last_key.pop(chat_id, None)
+        for group_key in [k for k in self.media_group_index if k[0] == chat_id]:
+            del self.media_group_index[group_key]
+    
+    def archive(self, messages: List[Dict[str, Any]], reason: str):
+        if self.history is not None:
+            self.history.append(messages, reason)
+        if self.search_index is not None:
+            self.search_index.mark_archived([message.get('message_key') for message in messages])
+    
+    def remove_message_by_key(self, key: str, reason: str = 'removed'):
+        if key in self.pending_messages:
+            message = self.pending_messages.pop(key)
+            self.archive([message], reason)
+            chat_id = message['chat_id']
+            self.column_remove(key, message)
+            chat_keys = self.chat_index.get(chat_id)
+            if chat_keys is not None:
+                chat_keys.pop(key, None)
+                if not chat_keys:
+                    del self.chat_index[chat_id]
+                    self.forget_chat_links(chat_id)
+            self.notify_chat_changed(chat_id)
+            self.save_pending_messages()
+            logger.info(f"✅ Удалено непрочитанное сообщение: {key}")
+            return True
+        return False
+    
+    def remove_all_chat_messages(self, chat_id: int, user_id: int = None, reason: str = 'answered'):
+        chat_keys = self.chat_index.get(chat_id, {})
+        keys_to_remove = []
+        for key in chat_keys:
+            if user_id is None or self.pending_messages[key]['user_id'] == user_id:
+                keys_to_remove.append(key)
+        
+        removed = []
+        for key in keys_to_remove:
+            removed.append(self.pending_messages.pop(key))
+            self.column_remove(key, removed[-1])
+            del chat_keys[key]
+        self.archive(removed, reason)
+        if not chat_keys:
+            self.chat_index.pop(chat_id, None)
+            self.forget_chat_links(chat_id)
+        
+        if keys_to_remove:
+            self.notify_chat_changed(chat_id)
+            self.save_pending_messages()
+            logger.info("✅ Удалено %s сообщений из чата %s", len(keys_to_remove), chat_id)
+            return len(keys_to_remove)
+        return 0
+    
+    def get_all_pending_messages(self) -> List[Dict[str, Any]]:
+        return list(self.pending_messages.values())
+    
+    def mark_funnel_sent(self, message_key: str, funnel_number: int):
+        if message_key in self.pending_messages:
+            if funnel_number not in self.pending_messages[message_key]['funnels_sent']:
+                self.pending_messages[message_key]['funnels_sent'].append(funnel_number)
+                self.set_current_funnel(message_key, funnel_number)
+                self.save_pending_messages()
+    
+    def set_current_funnel(self, message_key: str, funnel_number: int):
+        """Меняет текущую воронку сообщения (без сохранения в файл)"""
+        message = self.pending_messages[message_key]
+        if message.get('current_funnel', 0) != funnel_number:
+            message['current_funnel'] = funnel_number
+            self.funnel_column[self.column_find(message_key, message)] = funnel_number
+            self.notify_chat_changed(message['chat_id'])
+    
+    def find_messages_by_chat(self, chat_id: int) -> List[Dict[str, Any]]:
+        return [self.pending_messages[key] for key in self.chat_index.get(chat_id, ())]
+    
+    def get_messages_for_funnel(self, funnel_number: int, funnels_state: FunnelsStateManager) -> List[Dict[str, Any]]:
+        """Получает сообщения для указанной воронки - ПРОСТАЯ И НАДЕЖНАЯ ЛОГИКА"""
+        result = []
+        now = datetime.now(MOSCOW_TZ)
+        FUNNELS = self.funnels_config.get_funnels()
+        funnel_minutes = FUNNELS[funnel_number]
+        
+        for message_key, message in self.pending_messages.items():
+            # УБРАНА ПРОВЕРКА НА ОБРАБОТАННЫЕ СООБЩЕНИЯ
+            # if funnels_state.is_message_processed(funnel_number, message_key):
+            #     continue
+                
+            timestamp = datetime.fromisoformat(message['timestamp'])
+            minutes_passed = int(self.business_calendar.business_minutes_between(timestamp, now))
+            
+            funnels_sent = message.get('funnels_sent', [])
+            
+            # ПРОСТАЯ ЛОГИКА: если прошло достаточно времени и воронка еще не отправлена
+            if (minutes_passed >= funnel_minutes and 
+                funnel_number not in funnels_sent):
+                message['message_key'] = message_key
+                message['minutes_passed'] = minutes_passed
+                result.append(message)
+        
+        return result
+    
+    def stage_ranges(self, now_epoch: float) -> List[tuple]:
+        """Диапазоны позиций колонки по стадиям: [(начало, конец, стадия)]
+        
+        Возраст считается в рабочих минутах: порог стадии переводится календарём
+        в момент-отсечку, после чего граница ищется bisect'ом.
+        """
+        cutoffs = [self.business_calendar.cutoff_epoch(now_epoch, minutes) for minutes in self.funnels_config.thresholds]
+        bounds = [bisect.bisect_right(self.epoch_column, cutoff) for cutoff in cutoffs]
+        ranges = []
+        end = len(self.epoch_column)
+        for stage, start in enumerate(bounds):
+            ranges.append((start, end, stage))
+            end = start
+        ranges.append((0, end, len(bounds)))
+        return ranges
+    
+    def find_mismatches(self, start: int, end: int, stage: int, result: List[int]):
+        """Позиции диапазона, где сохранённая стадия отличается; сравнение срезов идёт на C-скорости"""
+        if start >= end or self.funnel_column[start:end] == array('h', [stage]) * (end - start):
+            return
+        if end - start <= 16:
+            result.extend(pos for pos in range(start, end) if self.funnel_column[pos] != stage)
+            return
+        middle = (start + end) // 2
+        self.find_mismatches(start, middle, stage, result)
+        self.find_mismatches(middle, end, stage, result)
+    
+    def classify_all(self, now_epoch: float) -> List[tuple]:
+        """Пакетно классифицирует все сообщения; возвращает [(позиция, новая воронка)] только для изменившихся"""
+        changes = []
+        for start, end, stage in self.stage_ranges(now_epoch):
+            positions = []
+            self.find_mismatches(start, end, stage, positions)
+            changes.extend((pos, stage) for pos in positions)
+        return changes
+    
+    def update_funnel_statuses(self):
+        """Автоматически обновляет статусы воронок (пакетная классификация по колонке времени)"""
+        changes = self.classify_all(datetime.now(MOSCOW_TZ).timestamp())
+        
+        for pos, new_funnel in changes:
+            message_key = self.column_keys[pos]
+            message = self.pending_messages[message_key]
+            current_funnel = message.get('current_funnel', 0)
+            message['current_funnel'] = new_funnel
+            self.funnel_column[pos] = new_funnel
+            self.notify_chat_changed(message['chat_id'])
+            logger.debug("🔄 Сообщение %s: воронка %s -> %s", message_key, current_funnel, new_funnel)
+        
+        updated_count = len(changes)
+        if updated_count > 0:
+            self.save_pending_messages()
+            logger.info("✅ Обновлено статусов воронок: %s сообщений", updated_count)
+        
+        return updated_count
+    
+    def get_all_messages_older_than(self, minutes_threshold: int) -> List[Dict[str, Any]]:
+        result = []
+        now = datetime.now(MOSCOW_TZ)
+        
+        for message_key, message in self.pending_messages.items():
+            timestamp = datetime.fromisoformat(message['timestamp'])
+            minutes_passed = int(self.business_calendar.business_minutes_between(timestamp, now))
+            
+            if minutes_passed >= minutes_threshold:
+                message['message_key'] = message_key
+                message['minutes_passed'] = minutes_passed
+                result.append(message)
+        
+        return result
+    
+    def clear_all(self):
+        count = len(self.pending_messages)
+        self.archive(list(self.pending_messages.values()), 'cleared')
+        self.pending_messages = {}
+        self.rebuild_chat_index()
+        self.notify_chat_changed(None)
+        self.save_pending_messages()
+        logger.info(f"✅ Очищены все непрочитанные сообщения ({count} шт.)")
+        return count
+
+# ========== СТАТИСТИКА ПОТОКА СООБЩЕНИЙ ==========
+
+HOURS_PER_WEEK = 168
+HEATMAP_SHADES = " ░▒▓█"
+
+class ArrivalStats:
+    """Счётчики входящих сообщений клиентов в кольцевых буферах array.
+    
+    Часы считаются от эпохи по московскому времени со сдвигом на понедельник,
+    поэтому час % 168 - это час недели. hour_counts хранит ARRIVAL_WEEKS недель
+    почасово, hour_stamps - какой абсолютный час лежит в ячейке (устаревшая
+    ячейка обнуляется при перезаписи). У чата - кольцо на CHAT_RATE_HOURS часов,
+    последний элемент которого - час последнего сообщения. Учёт сообщения - O(1)
+    без выделения памяти; файл пишется раз в час и при остановке.
+    """
+    
+    def __init__(self):
+        self.size = HOURS_PER_WEEK * ARRIVAL_WEEKS
+        # 1970-01-01 - четверг: +72 часа выравнивают неделю на понедельник
+        self.offset_seconds = MOSCOW_TZ.utcoffset(datetime.now()).total_seconds() + 72 * 3600
+        self.hour_counts = array('I', [0]) * self.size
+        self.hour_stamps = array('q', [-1]) * self.size
+        self.chat_rates: Dict[int, array] = {}
+        self.chat_titles: Dict[int, str] = {}
+        self.current_hour = self.hour_of(time_module.time())
+        self.dirty = False
+        self.load()
+    
+    def hour_of(self, epoch: float) -> int:
+        return int((epoch + self.offset_seconds) // 3600)
+    
+    def load(self):
+        try:
+            if not os.path.exists(state_path(ARRIVAL_STATS_FILE)):
+                return
+            with open(state_path(ARRIVAL_STATS_FILE), 'r') as f:
+                data = json.load(f)
+            swap = data.get("byteorder", sys.byteorder) != sys.byteorder
+            hour_counts = self.decode('I', data["hour_counts"], swap)
+            hour_stamps = self.decode('q', data["hour_stamps"], swap)
+            if len(hour_counts) == self.size and len(hour_stamps) == self.size:
+                self.hour_counts, self.hour_stamps = hour_counts, hour_stamps
+            for chat_id, (title, encoded) in data.get("chats", {}).items():
+                rates = self.decode('I', encoded, swap)
+                if len(rates) == CHAT_RATE_HOURS + 1:
+                    self.chat_rates[int(chat_id)] = rates
+                    self.chat_titles[int(chat_id)] = title
+        except Exception as e:
+            logger.error(f"Ошибка загрузки статистики потока: {e}")
+    
+    @staticmethod
+    def decode(typecode: str, encoded: str, swap: bool) -> array:
+        values = array(typecode)
+        values.frombytes(base64.b64decode(encoded))
+        if swap:
+            values.byteswap()
+        return values
+    
+    def save(self):
+        self.dirty = False
+        oldest_hour = self.current_hour - CHAT_RATE_HOURS
+        chats = {
+            str(chat_id): [self.chat_titles.get(chat_id), base64.b64encode(rates.tobytes()).decode('ascii')]
+            for chat_id, rates in self.chat_rates.items() if rates[CHAT_RATE_HOURS] > oldest_hour
+        }
+        data = {
+            "byteorder": sys.byteorder,
+            "hour_counts": base64.b64encode(self.hour_counts.tobytes()).decode('ascii'),
+            "hour_stamps": base64.b64encode(self.hour_stamps.tobytes()).decode('ascii'),
+            "chats": chats,
+        }
+        persistence.write_json(state_path(ARRIVAL_STATS_FILE), data, "статистики потока")
+    
+    def flush(self):
+        if self.dirty:
+            self.save()
+    
+    def record(self, chat_id: int, epoch: float, chat_title: str = None):
+        hour = self.hour_of(epoch)
+        if hour > self.current_hour:
+            # Новый час: сохраняем накопленное за прошлый
+            self.current_hour = hour
+            self.flush()
+        
+        slot = hour % self.size
+        if self.hour_stamps[slot] < hour:
+            self.hour_stamps[slot] = hour
+            self.hour_counts[slot] = 0
+        if self.hour_stamps[slot] == hour:
+            self.hour_counts[slot] += 1
+        
+        rates = self.chat_rates.get(chat_id)
+        if rates is None:
+            rates = self.chat_rates[chat_id] = array('I', [0]) * (CHAT_RATE_HOURS + 1)
+            rates[CHAT_RATE_HOURS] = hour
+        last_hour = rates[CHAT_RATE_HOURS]
+        if hour > last_hour:
+            for skipped in range(last_hour + 1, min(hour, last_hour + CHAT_RATE_HOURS) + 1):
+                rates[skipped % CHAT_RATE_HOURS] = 0
+            rates[CHAT_RATE_HOURS] = hour
+        if hour > last_hour - CHAT_RATE_HOURS:
+            rates[hour % CHAT_RATE_HOURS] += 1
+        if chat_title and self.chat_titles.get(chat_id) != chat_title:
+            self.chat_titles[chat_id] = chat_title
+        self.dirty = True
+    
+    def chat_recent_count(self, rates: array, now_hour: int) -> int:
+        """Сообщений чата за последние CHAT_RATE_HOURS часов"""
+        last_hour = rates[CHAT_RATE_HOURS]
+        first_hour = max(last_hour, now_hour) - CHAT_RATE_HOURS + 1
+        return sum(rates[hour % CHAT_RATE_HOURS] for hour in range(first_hour, last_hour + 1))
+    
+    def busiest_chats(self, limit: int = LOAD_TOP_CHATS) -> List[tuple]:
+        """[(chat_id, название, сообщений за окно)] по убыванию"""
+        now_hour = self.hour_of(time_module.time())
+        counts = []
+        for chat_id, rates in self.chat_rates.items():
+            count = self.chat_recent_count(rates, now_hour)
+            if count:
+                counts.append((chat_id, self.chat_titles.get(chat_id), count))
+        counts.sort(key=lambda item: item[2], reverse=True)
+        return counts[:limit]
+    
+    def week_profile(self) -> tuple:
+        """Среднее число сообщений по часам недели и число недель в окне"""
+        now_hour = self.hour_of(time_module.time())
+        totals = [0] * HOURS_PER_WEEK
+        oldest = now_hour
+        for slot in range(self.size):
+            stamp = self.hour_stamps[slot]
+            if 0 <= now_hour - stamp < self.size:
+                totals[stamp % HOURS_PER_WEEK] += self.hour_counts[slot]
+                oldest = min(oldest, stamp)
+        weeks = max(1, min(ARRIVAL_WEEKS, (now_hour - oldest) // HOURS_PER_WEEK + 1))
+        return [total / weeks for total in totals], weeks
+    
+    def render_heatmap(self) -> tuple:
+        """(карта 7x24, недель в окне, пик в среднем за час, три самых загруженных часа)"""
+        profile, weeks = self.week_profile()
+        peak = max(profile)
+        lines = ["    " + "".join(str(hour // 10) if hour % 6 == 0 else " " for hour in range(24)),
+                 "    " + "".join(str(hour % 10) if hour % 6 == 0 else " " for hour in range(24))]
+        for day, name in enumerate(WEEKDAY_NAMES):
+            row = profile[day * 24:(day + 1) * 24]
+            cells = "".join(HEATMAP_SHADES[0] if not value else HEATMAP_SHADES[min(4, 1 + int(value / peak * 3.999))] for value in row)
+            lines.append(f"{name}  {cells}")
+        busiest = sorted(range(HOURS_PER_WEEK), key=lambda hour: profile[hour], reverse=True)[:3]
+        peaks = ", ".join(f"{WEEKDAY_NAMES[hour // 24]} {hour % 24:02d}:00 ({profile[hour]:.1f})" for hour in busiest if profile[hour])
+        return "\n".join(lines), weeks, peak, peaks
+
+# ========== ИНКРЕМЕНТАЛЬНЫЙ РЕНДЕР УВЕДОМЛЕНИЙ ==========
+
+class NotificationRenderer:
+    """Рендерит уведомления, кэшируя строку каждого чата.
+    
+    Строка чата пересобирается только при изменении количества сообщений,
+    воронки или возраста (с точностью до минуты). Секции воронок склеиваются
+    через join и кэшируются до следующего изменения.
+    
+    Кроме общих секций ведутся секции каждого рабочего чата (target), чтобы
+    уведомление рабочего чата собиралось только из его подмножества.
+    """
+    
+    VIEWS = {
+        'master': "  • {name} ({count} сообщ., {ago} назад)\n",
+        'debug': "   - {name} ({count} сообщ., {ago} назад)\n",
+        'pending': "{name} {emoji}\n   📝 Сообщений: {count}\n   ⏰ Самое старое: {ago} назад\n   🚀 Текущая воронка: {funnel}\n\n",
+    }
+    
+    def __init__(self, pending_manager: PendingMessagesManager, router: Callable[[int, Optional[str]], Optional[int]] = None):
+        self.pending_manager = pending_manager
+        self.router = router
+        self.chats: Dict[int, Dict[str, Any]] = {}
+        self.message_total = 0
+        self.members: Dict[int, Dict[int, None]] = {}
+        self.ordered: Dict[int, List[int]] = {}
+        self.ordered_all: Optional[List[int]] = None
+        self.ordered_by_funnel: Optional[List[int]] = None
+        self.section_gen: Dict[tuple, int] = {}
+        self.target_members: Dict[tuple, Dict[int, None]] = {}
+        self.target_ordered: Dict[tuple, List[int]] = {}
+        self.target_stats: Dict[int, List[int]] = {}
+        self.lines: Dict[tuple, tuple] = {}
+        self.sections: Dict[tuple, tuple] = {}
+        self.dirty_chats: set = set()
+        self.all_dirty = True
+        pending_manager.add_listener(self.on_chat_changed)
+    
+    def on_chat_changed(self, chat_id: Optional[int]):
+        if chat_id is None:
+            self.all_dirty = True
+        else:
+            self.dirty_chats.add(chat_id)
+    
+    def oldest_key(self, chat_id: int) -> float:
+        return self.chats[chat_id]['oldest_epoch']
+    
+    def bump_section(self, target: Optional[int], funnel: int):
+        self.section_gen[(target, funnel)] = self.section_gen.get((target, funnel), 0) + 1
+    
+    def detach_chat(self, chat_id: int):
+        """Убирает чат из секции и упорядоченных списков (без полной пересортировки)"""
+        chat = self.chats[chat_id]
+        funnel, target = chat['funnel'], chat['target']
+        self.members[funnel].pop(chat_id, None)
+        self.bump_section(None, funnel)
+        self.ordered_by_funnel = None
+        orders = [self.ordered.get(funnel), self.ordered_all]
+        if target is not None:
+            self.target_members[(target, funnel)].pop(chat_id, None)
+            self.bump_section(target, funnel)
+            stats = self.target_stats[target]
+            stats[0] -= chat['count']
+            stats[1] -= 1
+            orders.append(self.target_ordered.get((target, funnel)))
+        for order in orders:
+            if order is not None:
+                order.remove(chat_id)
+    
+    def attach_chat(self, chat_id: int):
+        chat = self.chats[chat_id]
+        funnel, target = chat['funnel'], chat['target']
+        self.members.setdefault(funnel, {})[chat_id] = None
+        self.bump_section(None, funnel)
+        self.ordered_by_funnel = None
+        orders = [self.ordered.get(funnel), self.ordered_all]
+        if target is not None:
+            self.target_members.setdefault((target, funnel), {})[chat_id] = None
+            self.bump_section(target, funnel)
+            stats = self.target_stats.setdefault(target, [0, 0])
+            stats[0] += chat['count']
+            stats[1] += 1
+            orders.append(self.target_ordered.get((target, funnel)))
+        for order in orders:
+            if order is not None:
+                bisect.insort(order, chat_id, key=self.oldest_key)
+    
+    def refresh_chat(self, chat_id: int):
+        """Пересчитывает агрегат одного чата по индексу менеджера"""
+        messages = self.pending_manager.find_messages_by_chat(chat_id)
+        if chat_id in self.chats:
+            self.message_total -= self.chats[chat_id]['count']
+            self.detach_chat(chat_id)
+        if not messages:
+            self.chats.pop(chat_id, None)
+            for view in self.VIEWS:
+                self.lines.pop((view, chat_id), None)
+            return
+        
+        oldest_time = min(msg['timestamp'] for msg in messages)
+        funnel = max(msg.get('current_funnel', 0) for msg in messages)
+        count = sum(msg.get('count', 1) for msg in messages)
+        self.message_total += count
+        self.chats[chat_id] = {
+            'name': get_chat_display_name(messages[0]),
+            'user_ids': {msg['user_id'] for msg in messages},
+            'usernames': {msg['username'].lower() for msg in messages if msg.get('username')},
+            'count': count,
+            'oldest_time': oldest_time,
+            'oldest_epoch': datetime.fromisoformat(oldest_time).timestamp(),
+            'funnel': funnel,
+            'target': self.router(chat_id, messages[0].get('chat_title')) if self.router else None
+        }
+        self.attach_chat(chat_id)
+    
+    def sync(self):
+        """Применяет накопленные изменения из менеджера сообщений"""
+        if self.all_dirty:
+            self.all_dirty = False
+            self.dirty_chats.clear()
+            self.chats = {}
+            self.message_total = 0
+            self.members = {}
+            self.lines = {}
+            self.sections = {}
+            self.ordered = {}
+            self.target_members = {}
+            self.target_ordered = {}
+            self.target_stats = {}
+            self.ordered_all = None
+            self.ordered_by_funnel = None
+            for chat_id in list(self.pending_manager.chat_index):
+                self.refresh_chat(chat_id)
+            return
+        
+        while self.dirty_chats:
+            self.refresh_chat(self.dirty_chats.pop())
+    
+    def get_line(self, view: str, chat_id: int, now_minute: int) -> str:
+        chat = self.chats[chat_id]
+        age = max(0, int(now_minute * 60 - chat['oldest_epoch']) // 60)
+        signature = (chat['count'], chat['funnel'], age, chat['name'], funnels_config.version)
+        cached = self.lines.get((view, chat_id))
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        
+        funnel = chat['funnel']
+        line = self.VIEWS[view].format(
+            name=chat['name'],
+            count=chat['count'],
+            ago=format_minutes_ago(age),
+            funnel=funnel,
+            emoji=get_funnel_emoji(funnel) if funnel > 0 else "⚪"
+        )
+        self.lines[(view, chat_id)] = (signature, line)
+        return line
+    
+    def get_ordered(self, funnel: int, target: Optional[int] = None) -> List[int]:
+        if target is not None:
+            order = self.target_ordered.get((target, funnel))
+            if order is None:
+                order = sorted(self.target_members.get((target, funnel), {}), key=self.oldest_key)
+                self.target_ordered[(target, funnel)] = order
+            return order
+        
+        order = self.ordered.get(funnel)
+        if order is None:
+            members = self.members.get(funnel, {})
+            order = sorted(members, key=self.oldest_key)
+            self.ordered[funnel] = order
+        return order
+    
+    def get_ordered_all(self) -> List[int]:
+        if self.ordered_all is None:
+            self.ordered_all = sorted(self.chats, key=self.oldest_key)
+        return self.ordered_all
+    
+    def render_section(self, view: str, funnel: int, now_minute: int, target: Optional[int] = None) -> str:
+        """Возвращает склеенные строки чатов воронки (из кэша, если ничего не менялось)"""
+        stamp = (now_minute, self.section_gen.get((target, funnel), 0), funnels_config.version)
+        cached = self.sections.get((view, funnel, target))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        
+        text = "".join([self.get_line(view, chat_id, now_minute) for chat_id in self.get_ordered(funnel, target)])
+        self.sections[(view, funnel, target)] = (stamp, text)
+        return text
+    
+    def total_messages(self) -> int:
+        """Количество сообщений с учётом склеенных серий"""
+        self.sync()
+        return self.message_total
+    
+    def funnel_counts(self) -> Dict[int, int]:
+        """Количество чатов в каждой воронке"""
+        self.sync()
+        return {funnel: len(members) for funnel, members in self.members.items()}
+    
+    def render_master(self, target: Optional[int] = None) -> str:
+        """Уведомление по всем чатам или только по чатам рабочего чата target"""
+        self.sync()
+        FUNNELS = funnels_config.get_funnels()
+        now = datetime.now(MOSCOW_TZ)
+        now_minute = int(now.timestamp()) // 60
+        
+        parts = ["📊 **ОБЗОР НЕОТВЕЧЕННЫХ СООБЩЕНИЙ**\n\n"]
+        last_funnel = funnels_config.stage_count()
+        for funnel in range(1, last_funnel + 1):
+            prefix = "БОЛЕЕ " if funnel == last_funnel else ""
+            parts.append(f"{funnels_config.get_emoji(funnel)} {prefix}{minutes_to_hours_text(FUNNELS[funnel])} без ответа\n")
+            parts.append(self.render_section('master', funnel, now_minute, target) or "  Таких нет\n")
+            if funnel < last_funnel:
+                parts.append("\n")
+        
+        if target is None:
+            message_total, chat_total = self.message_total, len(self.chats)
+        else:
+            message_total, chat_total = self.target_stats.get(target, (0, 0))
+        parts.append(f"\n📈 **ИТОГО:** {message_total} сообщений в {chat_total} чатах")
+        parts.append(f"\n⏰ Обновлено: {now.strftime('%H:%M:%S')}")
+        return "".join(parts)
+    
+    def render_debug(self) -> str:
+        self.sync()
+        FUNNELS = funnels_config.get_funnels()
+        now_minute = int(datetime.now(MOSCOW_TZ).timestamp()) // 60
+        
+        parts = ["🐛 **ОТЛАДКА ВОРОНОК**\n"]
+        for funnel in range(1, funnels_config.stage_count() + 1):
+            parts.append(f"\n{funnels_config.get_emoji(funnel)} Воронка {funnel} ({FUNNELS[funnel]} мин): {len(self.members.get(funnel, {}))} чатов\n")
+            parts.append(self.render_section('debug', funnel, now_minute))
+        return "".join(parts)
+    
+    def get_ordered_by_funnel(self) -> List[int]:
+        """Чаты по убыванию воронки, внутри воронки - от самых старых"""
+        if self.ordered_by_funnel is None:
+            order = []
+            for funnel in sorted(self.members, reverse=True):
+                order.extend(self.get_ordered(funnel))
+            self.ordered_by_funnel = order
+        return self.ordered_by_funnel
+    
+    def select_pending(self, pending_filters: Dict[str, Any]) -> tuple:
+        """Подбирает отсортированный индекс и диапазон под фильтры.
+        
+        Фильтры по воронке и возрасту сужают диапазон индекса (bisect), остальные
+        проверяются предикатом только для просматриваемых позиций.
+        Возвращает (индекс, начало, конец, предикат или None).
+        """
+        self.sync()
+        funnel = pending_filters.get('funnel')
+        if funnel is not None:
+            order = self.get_ordered(funnel)
+        elif pending_filters.get('sort') == 'funnel':
+            order = self.get_ordered_by_funnel()
+        else:
+            order = self.get_ordered_all()
+        
+        hi = len(order)
+        checks = []
+        min_age = pending_filters.get('age')
+        if min_age:
+            cutoff = datetime.now(MOSCOW_TZ).timestamp() - min_age * 60
+            if order is not self.ordered_by_funnel:
+                # Индекс отсортирован по времени: подходящие чаты - префикс
+                hi = bisect.bisect_right(order, cutoff, key=self.oldest_key)
+            else:
+                checks.append(lambda chat: chat['oldest_epoch'] <= cutoff)
+        
+        title = pending_filters.get('title')
+        if title:
+            title = title.casefold()
+            checks.append(lambda chat: title in chat['name'].casefold())
+        user = pending_filters.get('user')
+        if isinstance(user, int):
+            checks.append(lambda chat: user in chat['user_ids'])
+        elif user:
+            checks.append(lambda chat: user in chat['usernames'])
+        
+        predicate = None
+        if checks:
+            predicate = lambda chat_id: all(check(self.chats[chat_id]) for check in checks)
+        return order, 0, hi, predicate
+    
+    def render_pending_page(self, pending_filters: Dict[str, Any], cursor: int, forward: bool, page: int) -> tuple:
+        """Одна страница /pending: просматривает индекс только до заполнения страницы.
+        
+        forward=True - страница начинается с позиции cursor, иначе заканчивается перед ней.
+        Возвращает (текст, позиция начала страницы, позиция для следующей страницы или None).
+        """
+        order, lo, hi, predicate = self.select_pending(pending_filters)
+        positions = []
+        
+        if forward:
+            pos = max(cursor, lo)
+            while pos < hi and len(positions) <= PENDING_PAGE_SIZE:
+                if predicate is None or predicate(order[pos]):
+                    positions.append(pos)
+                pos += 1
+        else:
+            pos = min(cursor, hi) - 1
+            while pos >= lo and len(positions) < PENDING_PAGE_SIZE:
+                if predicate is None or predicate(order[pos]):
+                    positions.append(pos)
+                pos -= 1
+            positions.reverse()
+            # Проверяем, есть ли что-то после страницы (для кнопки "далее")
+            pos = min(cursor, hi)
+            while pos < hi:
+                if predicate is None or predicate(order[pos]):
+                    positions.append(pos)
+                    break
+                pos += 1
+        
+        # Лишняя позиция в конце означает, что есть следующая страница
+        next_cursor = None
+        if len(positions) > PENDING_PAGE_SIZE:
+            next_cursor = positions[PENDING_PAGE_SIZE]
+            positions = positions[:PENDING_PAGE_SIZE]
+        
+        now_minute = int(datetime.now(MOSCOW_TZ).timestamp()) // 60
+        matched = f"{hi - lo}" if predicate is None else "?"
+        parts = [
+            f"📋 **НЕПРОЧИТАННЫЕ СООБЩЕНИЯ**\n\nВсего сообщений: {self.message_total}\n"
+            f"Чатов: {len(self.chats)} (по фильтру: {matched})\nСтраница {page}\n\n"
+        ]
+        first_number = (page - 1) * PENDING_PAGE_SIZE + 1
+        for number, pos in enumerate(positions, first_number):
+            parts.append(f"{number}. {self.get_line('pending', order[pos], now_minute)}")
+        if not positions:
+            parts.append("Нет чатов по заданным фильтрам")
+        
+        start_cursor = positions[0] if positions else cursor
+        return "".join(parts), start_cursor, next_cursor
+
+# ========== ОЧЕРЕДЬ ИСХОДЯЩИХ СООБЩЕНИЙ ==========
+
+class TokenBucket:
+    """Ограничитель частоты: rate вызовов в секунду, до burst подряд.
+    
+    Жетон берётся сразу, даже в долг: баланс уходит в минус, и вызывающий
+    ждёт, пока долг не погасится. Так ожидающие обслуживаются по очереди
+    без блокировок.
+    """
+    
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time_module.monotonic()
+        self.waits_count = 0
+        self.waited_seconds = 0.0
+    
+    async def acquire(self):
+        now = time_module.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            delay = -self.tokens / self.rate
+            self.waits_count += 1
+            self.waited_seconds += delay
+            await asyncio.sleep(delay)
+
+class Outbox:
+    """Надёжная очередь исходящих сообщений.
+    
+    Обработчики только записывают сообщение в очередь (с сохранением в файл)
+    и сразу возвращаются; отправкой занимаются воркеры с повторами и
+    экспоненциальной задержкой. Ключ идемпотентности не даёт поставить одно
+    и то же сообщение дважды, в том числе после перезапуска.
+    
+    Очередь одна на процесс: её воркеры, файл и ограничитель частоты
+    outbound_limiter общие для всех ботов, каждое сообщение помнит своего
+    бота, метрики ведутся по ботам раздельно.
+    """
+    
+    SENT_KEYS_LIMIT = 1000
+    
+    def __init__(self):
+        self.callbacks: Dict[str, Callable] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.bots: Dict[str, tuple] = {}
+        self.workers: List[asyncio.Task] = []
+        self.stats: Dict[str, Dict[str, Any]] = {}
+        self.reload()
+    
+    def reload(self):
+        data = self.load_outbox()
+        self.items: Dict[str, Dict[str, Any]] = data.get("items", {})
+        self.sent_keys = collections.deque(data.get("sent_keys", []), maxlen=self.SENT_KEYS_LIMIT)
+        self.sent_keys_set = set(self.sent_keys)
+    
+    def get_stats(self, bot_name: str) -> Dict[str, Any]:
+        if bot_name not in self.stats:
+            self.stats[bot_name] = {'sent': 0, 'failed': 0, 'retries': 0, 'lags': collections.deque(maxlen=200)}
+        return self.stats[bot_name]
+    
+    def load_outbox(self) -> Dict[str, Any]:
+        try:
+            if os.path.exists(OUTBOX_FILE):
+                with open(OUTBOX_FILE, 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки очереди исходящих: {e}")
+        return {}
+    
+    def save_outbox(self):
+        persistence.write_json(OUTBOX_FILE, {"items": self.items, "sent_keys": list(self.sent_keys)}, "очереди исходящих", ensure_ascii=False)
+    
+    def register_callback(self, purpose: str, callback: Callable):
+        """Обработчик успешной отправки для сообщений с указанным назначением"""
+        self.callbacks[purpose] = callback
+    
+    def enqueue(self, key: str, kind: str, chat_id: int, purpose: str = "", **payload) -> bool:
+        """Ставит сообщение в очередь; False - такой ключ уже в очереди или отправлен"""
+        bot_name = get_runtime().name
+        # Ключи разных ботов не должны пересекаться (у бота по умолчанию - без префикса)
+        if bot_name != DEFAULT_BOT_NAME:
+            key = f"{bot_name}/{key}"
+        if key in self.items or key in self.sent_keys_set:
+            return False
+        now = time_module.time()
+        self.items[key] = {
+            'key': key,
+            'bot': bot_name,
+            'kind': kind,
+            'chat_id': chat_id,
+            'purpose': purpose,
+            'payload': payload,
+            'attempts': 0,
+            'created_at': now,
+            'next_attempt': now
+        }
+        self.save_outbox()
+        if self.queue is not None:
+            self.queue.put_nowait(key)
+        return True
+    
+    def send_message(self, key: str, chat_id: int, text: str, purpose: str = "", **kwargs) -> bool:
+        return self.enqueue(key, 'send', chat_id, purpose, text=text, **kwargs)
+    
+    def delete_message(self, key: str, chat_id: int, message_id: int, purpose: str = "") -> bool:
+        return self.enqueue(key, 'delete', chat_id, purpose, message_id=message_id)
+    
+    async def start(self, bot):
+        """Подключает бота текущего BotRuntime; воркеры запускаются при первом подключении"""
+        bot_name = get_runtime().name
+        # Обработчики доставки выполняются в контексте бота, отправившего сообщение
+        self.bots[bot_name] = (bot, contextvars.copy_context())
+        loop = asyncio.get_running_loop()
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(OUTBOX_WORKERS)]
+        now = time_module.time()
+        # Сообщения, оставшиеся с прошлого запуска, досылаются по их расписанию
+        leftovers = [item for item in self.items.values() if item.get('bot', DEFAULT_BOT_NAME) == bot_name]
+        for item in leftovers:
+            loop.call_later(max(0.0, item['next_attempt'] - now), self.queue.put_nowait, item['key'])
+        logger.info(f"📤 Очередь исходящих: подключён бот {bot_name}, его сообщений в очереди {len(leftovers)}")
+    
+    async def stop(self):
+        """Отключает бота текущего BotRuntime; воркеры останавливаются вместе с последним"""
+        self.bots.pop(get_runtime().name, None)
+        if not self.bots:
+            for task in self.workers:
+                task.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            self.workers = []
+            self.queue = None
+        self.save_outbox()
+    
+    async def worker(self):
+        while True:
+            key = await self.queue.get()
+            item = self.items.get(key)
+            # Сообщения отключённого бота ждут его следующего запуска
+            if item is not None and item.get('bot', DEFAULT_BOT_NAME) in self.bots:
+                await self.deliver(item)
+    
+    async def perform(self, item: Dict[str, Any]):
+        payload = item['payload']
+        bot = self.bots[item.get('bot', DEFAULT_BOT_NAME)][0]
+        await outbound_limiter.acquire()
+        if item['kind'] == 'send':
+            return await bot.send_message(chat_id=item['chat_id'], allow_sending_without_reply=True, **payload)
+        if item['kind'] == 'delete':
+            try:
+                return await bot.delete_message(chat_id=item['chat_id'], message_id=payload['message_id'])
+            except BadRequest as e:
+                if "not found" in str(e).lower():
+                    return None  # уже удалено - считаем выполненным
+                raise
+        raise ValueError(f"Неизвестный тип исходящего сообщения: {item['kind']}")
+    
+    async def deliver(self, item: Dict[str, Any]):
+        key = item['key']
+        try:
+            result = await self.perform(item)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            self.schedule_retry(item, float(retry_after), e)
+            return
+        except (Forbidden, BadRequest) as e:
+            # Повтор не поможет: чат недоступен или запрос некорректен
+            self.get_stats(item.get('bot', DEFAULT_BOT_NAME))['failed'] += 1
+            self.items.pop(key, None)
+            self.save_outbox()
+            logger.error(f"❌ Исходящее {key} отброшено: {e}")
+            return
+        except Exception as e:
+            delay = min(OUTBOX_BACKOFF_MAX, OUTBOX_BACKOFF_BASE * 2 ** item['attempts'])
+            self.schedule_retry(item, delay * random.uniform(0.8, 1.2), e)
+            return
+        
+        self.items.pop(key, None)
+        if len(self.sent_keys) == self.sent_keys.maxlen:
+            self.sent_keys_set.discard(self.sent_keys[0])
+        self.sent_keys.append(key)
+        self.sent_keys_set.add(key)
+        bot_name = item.get('bot', DEFAULT_BOT_NAME)
+        stats = self.get_stats(bot_name)
+        stats['sent'] += 1
+        stats['lags'].append(time_module.time() - item['created_at'])
+        self.save_outbox()
+        
+        callback = self.callbacks.get(item['purpose'])
+        if callback is not None and bot_name in self.bots:
+            try:
+                self.bots[bot_name][1].run(callback, item, result)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика отправки {key}: {e}")
+    
+    def schedule_retry(self, item: Dict[str, Any], delay: float, error: Exception):
+        item['attempts'] += 1
+        stats = self.get_stats(item.get('bot', DEFAULT_BOT_NAME))
+        if item['attempts'] >= OUTBOX_MAX_ATTEMPTS:
+            stats['failed'] += 1
+            self.items.pop(item['key'], None)
+            self.save_outbox()
+            logger.error(f"❌ Исходящее {item['key']} не отправлено за {item['attempts']} попыток: {error}")
+            return
+        stats['retries'] += 1
+        item['next_attempt'] = time_module.time() + delay
+        self.save_outbox()
+        logger.warning(f"⚠️ Исходящее {item['key']}: попытка {item['attempts']} не удалась ({error}), повтор через {delay:.1f} с")
+        asyncio.get_running_loop().call_later(delay, self.queue.put_nowait, item['key'])
+    
+    def get_metrics(self, bot_name: str = None) -> Dict[str, Any]:
+        """Метрики очереди бота (по умолчанию текущего): размер, возраст самого старого сообщения, задержка доставки"""
+        if bot_name is None:
+            bot_name = get_runtime().name
+        now = time_module.time()
+        created = [item['created_at'] for item in self.items.values() if item.get('bot', DEFAULT_BOT_NAME) == bot_name]
+        oldest = min(created, default=None)
+        stats = self.get_stats(bot_name)
+        lags = sorted(stats['lags'])
+        return {
+            'queued': len(created),
+            'queued_total': len(self.items),
+            'oldest_age': now - oldest if oldest is not None else 0.0,
+            'sent': stats['sent'],
+            'failed': stats['failed'],
+            'retries': stats['retries'],
+            'lag_p50': lags[len(lags) // 2] if lags else 0.0,
+            'lag_max': lags[-1] if lags else 0.0
+        }
+
+class UpdateDeduplicator:
+    """Отсекает повторно доставленные обновления.
+    
+    Хранит в файле максимальный обработанный update_id и окно последних ID.
+    Окно нужно на случай, когда Telegram начинает новую последовательность
+    update_id (после недели без обновлений) и сравнение с максимумом неверно.
+    """
+    
+    def __init__(self):
+        data = self.load_state()
+        self.high_water_mark: int = data.get("high_water_mark", 0)
+        self.recent = collections.deque(data.get("recent_ids", []), maxlen=UPDATE_DEDUP_WINDOW)
+        self.recent_set = set(self.recent)
+        self.batching = False
+        self.dirty = False
+        self.catch_up_started: Optional[float] = None
+        self.duplicates_count = 0
+        self.catch_up_count = 0
+    
+    def load_state(self) -> Dict[str, Any]:
+        try:
+            if os.path.exists(state_path(UPDATE_DEDUP_FILE)):
+                with open(state_path(UPDATE_DEDUP_FILE), 'r') as f:
+                    return json.load(f)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки обработанных обновлений: {e}")
+        return {}
+    
+    def save_state(self):
+        if self.batching:
+            self.dirty = True
+            return
+        self.dirty = False
+        persistence.write_json(state_path(UPDATE_DEDUP_FILE), {"high_water_mark": self.high_water_mark, "recent_ids": list(self.recent)}, "обработанных обновлений")
+    
+    def is_duplicate(self, update_id: int) -> bool:
+        if update_id in self.recent_set:
+            return True
+        return 0 <= self.high_water_mark - update_id < UPDATE_ID_RESET_GAP
+    
+    def record(self, update_id: int):
+        if len(self.recent) == self.recent.maxlen:
+            self.recent_set.discard(self.recent[0])
+        self.recent.append(update_id)
+        self.recent_set.add(update_id)
+        if update_id > self.high_water_mark or self.high_water_mark - update_id >= UPDATE_ID_RESET_GAP:
+            self.high_water_mark = update_id
+        if self.batching:
+            self.catch_up_count += 1
+        # Файл пишется не на каждое обновление, а в flush (раз в UPDATE_DEDUP_FLUSH_SECONDS)
+        self.dirty = True
+    
+    def flush(self):
+        if self.dirty:
+            self.save_state()
+    
+    def begin_batch(self):
+        self.batching = True
+        self.catch_up_started = time_module.time()
+    
+    def end_batch(self):
+        self.batching = False
+        self.catch_up_started = None
+        if self.dirty:
+            self.save_state()
+
+# ========== ВЫБОР ЛИДЕРА ==========
+
+class LeaderLease:
+    """Аренда лидерства в общей SQLite-базе.
+    
+    Лидер продлевает аренду каждую треть срока. Если он завис или упал,
+    аренда истекает и её забирает один из ожидающих процессов - не позже
+    чем через LEADER_LEASE_SECONDS. Номер срока (term) растёт при каждой
+    смене владельца.
+    """
+    
+    def __init__(self, path: str, holder: str, ttl: int):
+        self.path = path
+        self.holder = holder
+        self.ttl = ttl
+        self.expires_at = 0.0
+        self.term = 0
+    
+    def connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL, term INTEGER NOT NULL)")
+        return conn
+    
+    def try_acquire(self) -> bool:
+        """Получает или продлевает аренду; False - аренда у другого процесса"""
+        now = time_module.time()
+        conn = None
+        try:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires_at, term FROM lease WHERE name = 'leader'").fetchone()
+            if row and row[0] != self.holder and row[1] > now:
+                conn.execute("ROLLBACK")
+                self.expires_at = 0.0
+                return False
+            if row is None:
+                term = 1
+            else:
+                term = row[2] if row[0] == self.holder else row[2] + 1
+            conn.execute(
+                "INSERT OR REPLACE INTO lease (name, holder, expires_at, term) VALUES ('leader', ?, ?, ?)",
+                (self.holder, now + self.ttl, term)
+            )
+            conn.execute("COMMIT")
+            self.expires_at = now + self.ttl
+            self.term = term
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка аренды лидерства: {e}")
+            return False
+        finally:
+            if conn is not None:
+                conn.close()
+    
+    def release(self):
+        """Отдаёт аренду сразу, чтобы резервный процесс не ждал истечения срока"""
+        conn = None
+        try:
+            conn = self.connect()
+            conn.execute("UPDATE lease SET expires_at = 0 WHERE name = 'leader' AND holder = ?", (self.holder,))
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка освобождения аренды лидерства: {e}")
+        finally:
+            if conn is not None:
+                conn.close()
+        self.expires_at = 0.0
+    
+    def is_held(self) -> bool:
+        """Аренда действует (с запасом на задержку продления)"""
+        return self.expires_at - self.ttl / 6 > time_module.time()
+    
+    def wait_for_leadership(self):
+        """Блокирует запуск, пока процесс не станет лидером"""
+        while not self.try_acquire():
+            time_module.sleep(self.ttl / 3)
+
+# ========== КОНТРОЛЬ ЦИКЛА СОБЫТИЙ ==========
+
+class LoopWatchdog:
+    """Измеряет задержку цикла событий и ловит его блокировки.
+    
+    Задача в цикле просыпается каждые WATCHDOG_INTERVAL секунд и записывает
+    опоздание в гистограмму. Вспомогательный поток следит за отметками задачи:
+    если их нет дольше порога, он снимает стек потока цикла - это и есть
+    блокирующий код. Пока цикл жив, обновляется файл HEALTH_FILE.
+    
+    Контроль один на процесс (цикл событий общий для всех ботов): его запускает
+    и останавливает тот, кто владеет циклом, а о блокировках узнают
+    администраторы всех ботов.
+    """
+    
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10)
+    STACK_DEPTH = 12
+    
+    def __init__(self, interval: float, threshold: float):
+        self.interval = interval
+        self.threshold = threshold
+        self.histogram = [0] * (len(self.BUCKETS) + 1)
+        self.stalls = collections.deque(maxlen=20)
+        self.stall_count = 0
+        self.max_lag = 0.0
+        self.last_beat = time_module.monotonic()
+        self.captured_beat = None
+        self.pending_stack: Optional[str] = None
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        self.last_alert = 0.0
+        self.runtimes: List['BotRuntime'] = []
+    
+    async def start(self, runtimes: List['BotRuntime']):
+        if self.task is not None:
+            return
+        self.runtimes = list(runtimes)
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time_module.monotonic()
+        self.stopping.clear()
+        self.task = asyncio.create_task(self.monitor())
+        self.thread = threading.Thread(target=self.sampler, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        logger.info(f"🐢 Контроль цикла событий запущен (порог {self.threshold} с)")
+    
+    async def stop(self):
+        if self.task is None:
+            return
+        self.stopping.set()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+    
+    async def monitor(self):
+        last_health = 0.0
+        while True:
+            expected = time_module.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time_module.monotonic()
+            self.last_beat = now
+            self.record(max(0.0, now - expected))
+            if now - last_health >= HEALTH_WRITE_INTERVAL:
+                last_health = now
+                self.write_health()
+    
+    def sampler(self):
+        """Поток: снимает стек цикла, пока тот заблокирован"""
+        while not self.stopping.wait(self.interval / 2):
+            beat = self.last_beat
+            if time_module.monotonic() - beat > self.threshold and self.captured_beat != beat:
+                self.captured_beat = beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                if frame is not None:
+                    self.pending_stack = "".join(traceback.format_stack(frame)[-self.STACK_DEPTH:])
+    
+    def record(self, lag: float):
+        self.histogram[bisect.bisect_left(self.BUCKETS, lag)] += 1
+        self.max_lag = max(self.max_lag, lag)
+        stack, self.pending_stack = self.pending_stack, None
+        if lag < self.threshold:
+            return
+        
+        self.stall_count += 1
+        event = {
+            'at': datetime.now(MOSCOW_TZ),
+            'duration': lag,
+            'stack': stack or "стек не снят (блокировка короче интервала выборки)"
+        }
+        self.stalls.append(event)
+        logger.warning(f"🐢 Цикл событий был заблокирован на {lag:.2f} с\n{event['stack']}")
+        if STALL_ALERTS and time_module.time() - self.last_alert >= STALL_ALERT_INTERVAL:
+            self.last_alert = time_module.time()
+            self.alert(event)
+    
+    def alert(self, event: Dict[str, Any]):
+        """Сообщает администраторам каждого бота процесса - через его же бота"""
+        text = f"🐢 Цикл событий был заблокирован на {event['duration']:.2f} с\n\n{event['stack'][-3000:]}"
+        stamp = int(event['at'].timestamp())
+        for runtime in self.runtimes:
+            for admin_id in runtime.admin_ids:
+                runtime.context.run(outbox.send_message, f"stall:{admin_id}:{stamp}", admin_id, text, purpose='stall_alert')
+    
+    def write_health(self):
+        health = {
+            'status': 'ok',
+            'updated_at': datetime.now(MOSCOW_TZ).isoformat(),
+            'pid': os.getpid(),
+            'instance': INSTANCE_ID,
+            'max_lag': round(self.max_lag, 3),
+            'stalls': self.stall_count
+        }
+        persistence.write_json(HEALTH_FILE, health, "файла живости")
+    
+    def format_histogram(self) -> str:
+        labels = [f"< {bound} с" for bound in self.BUCKETS] + [f"≥ {self.BUCKETS[-1]} с"]
+        total = sum(self.histogram) or 1
+        return "\n".join(
+            f"{label}: {count} ({count * 100 / total:.1f}%)"
+            for label, count in zip(labels, self.histogram) if count
+        )
+
+# ========== ГОРЯЧАЯ ПЕРЕЗАГРУЗКА НАСТРОЕК ==========
+
+class ConfigWatcher:
+    """Подхватывает правку файлов настроек бота без перезапуска.
+    
+    Раз в CONFIG_WATCH_INTERVAL секунд сравнивает (mtime, размер) файлов.
+    Изменённый файл разбирается и проверяется целиком; при ошибке остаются
+    прежние настройки. Новое значение подменяется одним присваиванием, затем
+    перестраивается только то, что от него зависит, а в лог пишется разница.
+    Файл, записанный самим ботом, совпадает с текущими настройками и ничего не меняет.
+    """
+    
+    def __init__(self):
+        self.appliers = {
+            FUNNELS_CONFIG_FILE: self.apply_funnels,
+            EXCLUDED_USERS_FILE: self.apply_excluded_users,
+            BUSINESS_CALENDAR_FILE: self.apply_calendar,
+            WORK_CHAT_FILE: self.apply_work_chat,
+            AUTO_REPLY_FILE: self.apply_auto_reply,
+        }
+        self.signatures = {filename: self.signature(filename) for filename in self.appliers}
+        self.reload_count = 0
+        self.error_count = 0
+        # Остальные файлы менеджеры уже прочитали, текст автоответа берём сразу
+        try:
+            self.apply_auto_reply()
+        except Exception as e:
+            logger.error(f"Ошибка загрузки текста автоответа: {e}")
+    
+    @staticmethod
+    def signature(filename: str) -> Optional[tuple]:
+        try:
+            stat = os.stat(state_path(filename))
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+    
+    @staticmethod
+    def read_json(filename: str) -> Optional[Dict[str, Any]]:
+        """Содержимое файла или None, если файла нет; JSON обязан быть объектом"""
+        if not os.path.exists(state_path(filename)):
+            return None
+        with open(state_path(filename), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if not isinstance(data, dict):
+            raise ValueError("ожидается JSON-объект")
+        return data
+    
+    def poll(self) -> List[str]:
+        """Применяет изменившиеся файлы; возвращает имена тех, что что-то поменяли"""
+        applied = []
+        for filename, applier in self.appliers.items():
+            signature = self.signature(filename)
+            if signature == self.signatures[filename]:
+                continue
+            self.signatures[filename] = signature
+            try:
+                diff = applier()
+            except Exception as e:
+                self.error_count += 1
+                logger.error(f"Ошибка перезагрузки {filename}, оставлены прежние настройки: {e}")
+                continue
+            if diff:
+                self.reload_count += 1
+                applied.append(filename)
+                logger.info(f"🔁 {filename} перечитан: {diff}")
+        return applied
+    
+    def apply_funnels(self) -> str:
+        data = self.read_json(FUNNELS_CONFIG_FILE)
+        if data is None:
+            return ""
+        stages = FunnelsConfig.parse_stages(data)
+        if stages == funnels_config.stages:
+            return ""
+        old_thresholds = funnels_config.thresholds
+        funnels_config.stages = stages
+        funnels_config.rebuild_thresholds()
+        updated = pending_messages_manager.update_funnel_statuses()
+        return f"пороги {old_thresholds} → {funnels_config.thresholds} мин, пересчитано сообщений: {updated}"
+    
+    def apply_excluded_users(self) -> str:
+        data = self.read_json(EXCLUDED_USERS_FILE)
+        if data is None:
+            return ""
+        user_ids, usernames = data.get("user_ids", []), data.get("usernames", [])
+        if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+            raise ValueError("user_ids должны быть числами")
+        if not all(isinstance(username, str) and username for username in usernames):
+            raise ValueError("usernames должны быть непустыми строками")
+        old_ids, old_usernames = excluded_users_manager.lookup
+        new_ids, new_usernames = set(user_ids), {username.lower() for username in usernames}
+        if new_ids == old_ids and new_usernames == old_usernames:
+            return ""
+        excluded_users_manager.excluded_users = {**data, "user_ids": list(user_ids), "usernames": list(usernames)}
+        excluded_users_manager.rebuild_lookup()
+        changes = [f"+{user_id}" for user_id in sorted(new_ids - old_ids)]
+        changes += [f"-{user_id}" for user_id in sorted(old_ids - new_ids)]
+        changes += [f"+@{username}" for username in sorted(new_usernames - old_usernames)]
+        changes += [f"-@{username}" for username in sorted(old_usernames - new_usernames)]
+        return "менеджеры " + ", ".join(changes)
+    
+    def apply_calendar(self) -> str:
+        data = self.read_json(BUSINESS_CALENDAR_FILE)
+        if data is None:
+            return ""
+        config = json.loads(json.dumps(DEFAULT_BUSINESS_CALENDAR))
+        config.update(data)
+        parse_hhmm(config["start"]), parse_hhmm(config["end"])
+        if not all(isinstance(day, int) and 0 <= day <= 6 for day in config["weekdays"]):
+            raise ValueError("weekdays - числа от 0 до 6")
+        for day in config.get("holidays", []):
+            date.fromisoformat(day)
+        for day, hours in config.get("overrides", {}).items():
+            date.fromisoformat(day)
+            if hours:
+                parse_hhmm(hours[0]), parse_hhmm(hours[1])
+        if config == business_calendar.config:
+            return ""
+        changed = sorted(key for key in config.keys() | business_calendar.config.keys()
+                         if config.get(key) != business_calendar.config.get(key))
+        business_calendar.config = config
+        business_calendar.compile()
+        updated = pending_messages_manager.update_funnel_statuses()
+        return f"изменены {', '.join(changed)}, пересчитано сообщений: {updated}"
+    
+    def apply_work_chat(self) -> str:
+        data = self.read_json(WORK_CHAT_FILE)
+        if data is None:
+            return ""
+        work_chat_id = data.get("work_chat_id")
+        if work_chat_id is not None and (not isinstance(work_chat_id, int) or isinstance(work_chat_id, bool)):
+            raise ValueError("work_chat_id должен быть числом")
+        routes = data.get("routes", {})
+        if not isinstance(routes, dict) or not all(isinstance(chat_id, int) and not isinstance(chat_id, bool) for chat_id in routes.values()):
+            raise ValueError("routes: тег -> id рабочего чата")
+        for section in ("chat_tags", "title_patterns"):
+            values = data.get(section, {})
+            if not isinstance(values, dict) or not all(isinstance(value, str) for value in values.values()):
+                raise ValueError(f"{section}: значения должны быть строками")
+        current = {
+            'work_chat_id': work_chat_manager.work_chat_id,
+            'routes': work_chat_manager.routes,
+            'chat_tags': work_chat_manager.chat_tags,
+            'title_patterns': work_chat_manager.title_patterns
+        }
+        defaults = {'work_chat_id': None, 'routes': {}, 'chat_tags': {}, 'title_patterns': {}}
+        changed = sorted(key for key in current if data.get(key, defaults[key]) != current[key])
+        if not changed:
+            return ""
+        # Новый менеджер из уже проверенных данных - заодно сбрасывается кэш тегов чатов
+        runtime = get_runtime()
+        runtime.work_chat_manager = WorkChatManager(data)
+        runtime.notification_renderer.router = runtime.work_chat_manager.route
+        runtime.pending_messages_manager.notify_chat_changed(None)
+        return f"изменены {', '.join(changed)}"
+    
+    def apply_auto_reply(self) -> str:
+        runtime = get_runtime()
+        if os.path.exists(state_path(AUTO_REPLY_FILE)):
+            with open(state_path(AUTO_REPLY_FILE), 'r', encoding='utf-8') as f:
+                text = f.read().strip()
+            if not text:
+                raise ValueError("пустой текст автоответа")
+        else:
+            text = runtime.default_auto_reply_message
+        if text == runtime.auto_reply_message:
+            return ""
+        runtime.auto_reply_message = text
+        source = "из файла" if text != runtime.default_auto_reply_message else "по умолчанию"
+        return f"текст автоответа {source} ({len(text)} символов)"
+
+async def config_watch_job(context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет файлы настроек; после смены порогов или календаря переносит проверку уведомлений"""
+    applied = config_watcher.poll()
+    if FUNNELS_CONFIG_FILE in applied or BUSINESS_CALENDAR_FILE in applied:
+        advance_notification_job(context.job_queue)
+
+# ========== ЛОКАЛЬНЫЙ JSON API ==========
+
+class JsonApiServer:
+    """HTTP API только для чтения: очередь, списки воронок и настройки в JSON.
+    
+    Работает в цикле событий бота (asyncio.start_server), одно соединение -
+    один запрос. ETag очереди и воронок - номер версии состояния бота, который
+    растёт при каждом изменении сообщений, и версия порогов. Совпавший
+    If-None-Match получает 304 без пересчёта, а тело кэшируется до смены версии.
+    """
+    
+    MAX_HEAD_BYTES = 8192
+    READ_TIMEOUT = 10
+    REASONS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed"}
+    
+    def __init__(self, host: str, port: int, token: str):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.runtimes: Dict[str, Any] = {}
+        self.cache: Dict[tuple, tuple] = {}
+        # Версии начинаются с нуля при каждом запуске - метка запуска не даёт ETag совпасть со старым
+        self.started_label = format(int(time_module.time()), 'x')
+        self.requests_count = 0
+        self.not_modified_count = 0
+    
+    async def start(self, runtime):
+        self.runtimes[runtime.name] = runtime
+        if self.server is not None or not self.port:
+            return
+        if not self.token:
+            logger.warning("🌐 API_TOKEN не задан - JSON API не запускается")
+            return
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, self.host, self.port, limit=self.MAX_HEAD_BYTES)
+            logger.info(f"🌐 JSON API: http://{self.host}:{self.port}/api/")
+        except OSError as e:
+            logger.error(f"Ошибка запуска JSON API: {e}")
+    
+    async def stop(self, runtime):
+        self.runtimes.pop(runtime.name, None)
+        if self.runtimes or self.server is None:
+            return
+        self.server.close()
+        await self.server.wait_closed()
+        self.server = None
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.READ_TIMEOUT)
+            status, headers, body = self.respond(head.decode('latin-1'))
+            lines = [f"HTTP/1.1 {status} {self.REASONS[status]}", "Connection: close"]
+            lines += [f"{name}: {value}" for name, value in headers.items()]
+            if status != 304:
+                lines += ["Content-Type: application/json; charset=utf-8", f"Content-Length: {len(body)}"]
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+            if status != 304 and not head.startswith(b"HEAD "):
+                writer.write(body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка JSON API: {e}")
+        finally:
+            writer.close()
+    
+    def error(self, status: int, message: str) -> tuple:
+        return status, {}, json.dumps({"error": message}, ensure_ascii=False).encode('utf-8')
+    
+    def respond(self, head: str) -> tuple:
+        """(статус, заголовки, тело) для одного запроса"""
+        self.requests_count += 1
+        request_line, *header_lines = head.split("\r\n")
+        parts = request_line.split(" ")
+        if len(parts) != 3:
+            return self.error(400, "bad request line")
+        method, target, _ = parts
+        if method not in ("GET", "HEAD"):
+            return self.error(405, "read-only API")
+        headers = {}
+        for line in header_lines:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        
+        url = urlsplit(target)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        token = query.get("token") or headers.get("authorization", "").removeprefix("Bearer ").strip()
+        if not hmac.compare_digest(token.encode(), self.token.encode()):
+            return self.error(401, "token required")
+        
+        if url.path == "/api/bots":
+            return 200, {}, json.dumps({"bots": sorted(self.runtimes)}).encode('utf-8')
+        runtime = self.runtimes.get(query.get("bot", DEFAULT_BOT_NAME)) or next(iter(self.runtimes.values()), None)
+        if runtime is None:
+            return self.error(404, "no bots")
+        
+        path = url.path.rstrip("/")
+        if path == "/api/config":
+            body = json.dumps(runtime.context.run(self.build_config), ensure_ascii=False).encode('utf-8')
+            etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+            if headers.get("if-none-match") == etag:
+                self.not_modified_count += 1
+                return 304, {"ETag": etag}, b""
+            return 200, {"ETag": etag, "Cache-Control": "no-cache"}, body
+        
+        if path == "/api/backlog":
+            builder = self.build_backlog
+        elif path.startswith("/api/funnels/") and path.rsplit("/", 1)[1].isdigit():
+            funnel = int(path.rsplit("/", 1)[1])
+            builder = lambda: self.build_funnel(funnel)
+        else:
+            return self.error(404, "unknown path")
+        
+        version = (runtime.state_version, runtime.funnels_config.version)
+        etag = f'"{self.started_label}.{version[0]}.{version[1]}"'
+        if headers.get("if-none-match") == etag:
+            self.not_modified_count += 1
+            return 304, {"ETag": etag}, b""
+        cached = self.cache.get((runtime.name, path))
+        if cached is None or cached[0] != version:
+            cached = (version, json.dumps(runtime.context.run(builder), ensure_ascii=False).encode('utf-8'))
+            self.cache[(runtime.name, path)] = cached
+        return 200, {"ETag": etag, "Cache-Control": "no-cache"}, cached[1]
+    
+    @staticmethod
+    def build_backlog() -> Dict[str, Any]:
+        """Сводка очереди (время - моменты, а не возраст, чтобы ответ не устаревал сам по себе)"""
+        counts = notification_renderer.funnel_counts()
+        ordered = notification_renderer.get_ordered_all()
+        funnels = funnels_config.get_funnels()
+        return {
+            "bot": get_runtime().name,
+            "version": get_runtime().state_version,
+            "total_messages": notification_renderer.total_messages(),
+            "total_chats": len(notification_renderer.chats),
+            "oldest_message_at": notification_renderer.chats[ordered[0]]['oldest_time'] if ordered else None,
+            "funnels": [
+                {"funnel": funnel, "minutes": funnels.get(funnel, 0), "emoji": funnels_config.get_emoji(funnel) if funnel else "",
+                 "label": funnels_config.get_label(funnel) if funnel else "", "chats": counts.get(funnel, 0)}
+                for funnel in range(funnels_config.stage_count() + 1)
+            ],
+            "work_chats": {str(target): {"messages": stats[0], "chats": stats[1]} for target, stats in notification_renderer.target_stats.items()},
+        }
+    
+    @staticmethod
+    def build_funnel(funnel: int) -> Dict[str, Any]:
+        notification_renderer.sync()
+        chats = []
+        for chat_id in notification_renderer.get_ordered(funnel):
+            chat = notification_renderer.chats[chat_id]
+            chats.append({"chat_id": chat_id, "name": chat['name'], "messages": chat['count'],
+                          "oldest_message_at": chat['oldest_time'], "work_chat": chat['target']})
+        return {"funnel": funnel, "chats": chats}
+    
+    @staticmethod
+    def build_config() -> Dict[str, Any]:
+        return {
+            "funnels": funnels_config.get_stages(),
+            "calendar": business_calendar.config,
+            "work_chat_id": work_chat_manager.work_chat_id,
+            "routes": work_chat_manager.routes,
+            "chat_tags": work_chat_manager.chat_tags,
+            "title_patterns": work_chat_manager.title_patterns,
+            "cadence": {"min_seconds": CADENCE_MIN_SECONDS, "max_seconds": CADENCE_MAX_SECONDS, "base_seconds": NOTIFICATION_INTERVAL},
+        }
+
+# ========== НЕСКОЛЬКО БОТОВ В ОДНОМ ПРОЦЕССЕ ==========
+
+# Бот, обновление которого сейчас обрабатывается. Задачи и задания PTB
+# наследуют контекст, поэтому значение устанавливается один раз при запуске бота
+current_runtime: contextvars.ContextVar = contextvars.ContextVar('current_runtime', default=None)
+default_runtime = None
+
+class BotRuntime:
+    """Один бот: токен, настройки и менеджеры, чьи файлы лежат в каталоге data_dir"""
+    
+    def __init__(self, name: str = DEFAULT_BOT_NAME, token: str = BOT_TOKEN, data_dir: str = ".", admin_ids: List[int] = None, auto_reply_message: str = None):
+        self.name = name
+        self.token = token
+        self.data_dir = data_dir
+        self.admin_ids = set(admin_ids) if admin_ids else ADMIN_IDS
+        self.default_auto_reply_message = auto_reply_message or AUTO_REPLY_MESSAGE
+        self.auto_reply_message = self.default_auto_reply_message
+        os.makedirs(data_dir, exist_ok=True)
+        self.context = contextvars.copy_context()
+        self.context.run(current_runtime.set, self)
+        self.context.run(self.create_managers)
+    
+    def create_managers(self):
+        self.funnels_config = FunnelsConfig()
+        self.business_calendar = BusinessCalendar()
+        self.flags_manager = AutoReplyFlags()
+        self.work_chat_manager = WorkChatManager()
+        self.message_history = MessageHistoryArchive(state_path(MESSAGE_HISTORY_FILE))
+        self.search_index = MessageSearchIndex(SEARCH_INDEX_BUDGET_MB * 1024 * 1024)
+        self.search_index.index_archive(self.message_history)
+        self.pending_messages_manager = PendingMessagesManager(self.funnels_config, self.business_calendar, self.message_history, self.search_index)
+        self.excluded_users_manager = ExcludedUsersManager()
+        self.arrival_stats = ArrivalStats()
+        self.funnels_state_manager = FunnelsStateManager()
+        self.master_notification_manager = MasterNotificationManager()
+        self.notification_renderer = NotificationRenderer(self.pending_messages_manager, self.work_chat_manager.route)
+        self.update_dedup = UpdateDeduplicator()
+        self.refresh_debouncer = RefreshDebouncer()
+        self.config_watcher = ConfigWatcher()
+        # Версия состояния для ETag JSON API: растёт при любом изменении сообщений
+        self.state_version = 0
+        self.pending_messages_manager.add_listener(self.bump_state_version)
+    
+    def bump_state_version(self, chat_id: Optional[int]):
+        self.state_version += 1
+    
+    def reload_state(self):
+        """Перечитывает состояние из файлов - их мог изменить предыдущий лидер"""
+        self.context.run(self.reload_managers)
+    
+    def reload_managers(self):
+        self.funnels_config.stages = self.funnels_config.load_funnels()
+        self.funnels_config.rebuild_thresholds()
+        self.business_calendar.config = self.business_calendar.load_calendar()
+        self.business_calendar.compile()
+        self.flags_manager.flags = self.flags_manager.load_flags()
+        self.work_chat_manager = WorkChatManager()
+        self.notification_renderer.router = self.work_chat_manager.route
+        self.excluded_users_manager.reload()
+        self.arrival_stats = ArrivalStats()
+        self.funnels_state_manager.state = self.funnels_state_manager.load_state()
+        self.master_notification_manager = MasterNotificationManager()
+        self.pending_messages_manager.pending_messages = self.pending_messages_manager.load_pending_messages()
+        self.pending_messages_manager.rebuild_chat_index()
+        self.pending_messages_manager.notify_chat_changed(None)
+        self.update_dedup = UpdateDeduplicator()
+        self.config_watcher = ConfigWatcher()
+
+def get_runtime() -> BotRuntime:
+    """Текущий бот; вне контекста бота - бот по умолчанию из BOT_TOKEN"""
+    global default_runtime
+    runtime = current_runtime.get()
+    if runtime is not None:
+        return runtime
+    if default_runtime is None:
+        default_runtime = BotRuntime()
+    return default_runtime
+
+def state_path(filename: str) -> str:
+    """Путь к файлу состояния в каталоге текущего бота"""
+    runtime = current_runtime.get()
+    if runtime is None or runtime.data_dir == ".":
+        return filename
+    return os.path.join(runtime.data_dir, filename)
+
+class RuntimeAttribute:
+    """Модульное имя, за которым стоит объект текущего бота"""
+    
+    __slots__ = ('attribute',)
+    
+    def __init__(self, attribute: str):
+        object.__setattr__(self, 'attribute', attribute)
+    
+    def __getattr__(self, name: str):
+        return getattr(getattr(get_runtime(), self.attribute), name)
+    
+    def __setattr__(self, name: str, value):
+        setattr(getattr(get_runtime(), self.attribute), name, value)
+
+def load_bot_configs() -> List[Dict[str, Any]]:
+    """Список ботов из BOTS_CONFIG_FILE (пустой - один бот из BOT_TOKEN)"""
+    try:
+        if os.path.exists(BOTS_CONFIG_FILE):
+            with open(BOTS_CONFIG_FILE, 'r') as f:
+                return json.load(f).get("bots", [])
+    except Exception as e:
+        logger.error(f"Ошибка загрузки списка ботов: {e}")
+    return []
+
+# ========== ГЛОБАЛЬНЫЕ ЭКЗЕМПЛЯРЫ ==========
+
+# Объекты конкретного бота (берутся из текущего BotRuntime)
+funnels_config = RuntimeAttribute('funnels_config')
+business_calendar = RuntimeAttribute('business_calendar')
+flags_manager = RuntimeAttribute('flags_manager')
+work_chat_manager = RuntimeAttribute('work_chat_manager')
+message_history = RuntimeAttribute('message_history')
+search_index = RuntimeAttribute('search_index')
+arrival_stats = RuntimeAttribute('arrival_stats')
+pending_messages_manager = RuntimeAttribute('pending_messages_manager')
+excluded_users_manager = RuntimeAttribute('excluded_users_manager')
+funnels_state_manager = RuntimeAttribute('funnels_state_manager')
+master_notification_manager = RuntimeAttribute('master_notification_manager')
+notification_renderer = RuntimeAttribute('notification_renderer')
+update_dedup = RuntimeAttribute('update_dedup')
+refresh_debouncer = RuntimeAttribute('refresh_debouncer')
+config_watcher = RuntimeAttribute('config_watcher')
+
+# Общие для всех ботов процесса
+outbound_limiter = TokenBucket(OUTBOX_RATE, OUTBOX_BURST)
+outbox = Outbox()
+leader_lease = LeaderLease(LEADER_LEASE_FILE, INSTANCE_ID, LEADER_LEASE_SECONDS)
+loop_watchdog = LoopWatchdog(WATCHDOG_INTERVAL, STALL_THRESHOLD)
+json_api = JsonApiServer(API_HOST, API_PORT, API_TOKEN)
+
+# ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+
+def is_leader() -> bool:
+    """Может ли процесс рассылать уведомления (без выбора лидера - всегда)"""
+    return not LEADER_ELECTION or leader_lease.is_held()
+
+def is_admin(user_id: int) -> bool:
+    return user_id in get_runtime().admin_ids
+
+def is_manager(user_id: int, username: str = None) -> bool:
+    return excluded_users_manager.is_user_excluded(user_id, username)
+
+def is_excluded_user(user_id: int) -> bool:
+    return excluded_users_manager.is_user_excluded(user_id)
+
+def is_working_hours():
+    return business_calendar.is_working_time()
+
+def should_respond_to_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    if not update or not update.message:
+        return False
+    
+    if update.message.from_user.id == context.bot.id:
+        return False
+        
+    if is_excluded_user(update.message.from_user.id):
+        return False
+        
+    if update.message.new_chat_members or update.message.left_chat_member:
+        return False
+        
+    if update.message.pinned_message:
+        return False
+        
+    if update.edited_message:
+        return False
+        
+    if update.message.text and update.message.text.startswith('/'):
+        return False
+        
+    if update.message.text and len(update.message.text.strip()) < 1:
+        return False
+        
+    return True
+
+def get_chat_display_name(chat_data: Dict[str, Any]) -> str:
+    chat_title = chat_data.get('chat_title')
+    if chat_title:
+        return chat_title
+    else:
+        return f"Чат {chat_data['chat_id']}"
+
+def get_funnel_emoji(funnel_number: int) -> str:
+    return funnels_config.get_emoji(funnel_number)
+
+def format_time_ago(timestamp: str) -> str:
+    message_time = datetime.fromisoformat(timestamp)
+    now = datetime.now(MOSCOW_TZ)
+    time_diff = now - message_time
+    
+    return format_minutes_ago(int(time_diff.total_seconds() / 60))
+
+def format_minutes_ago(total_minutes: int) -> str:
+    hours = total_minutes // 60
+    minutes = total_minutes % 60
+    
+    if hours > 0:
+        return f"{hours}ч {minutes}м"
+    else:
+        return f"{minutes}м"
+
+def minutes_to_hours_text(minutes: int) -> str:
+    hours = minutes // 60
+    if hours == 1:
+        return "1 ЧАС"
+    elif hours == 3:
+        return "3 ЧАСА"
+    elif hours == 5:
+        return "5 ЧАСОВ"
+    else:
+        return f"{hours} ЧАСОВ"
+
+# ========== ФУНКЦИИ АВТОМАТИЧЕСКОГО ОБНОВЛЕНИЯ ВОРОНОК ==========
+
+async def update_message_funnel_statuses():
+    """Автоматически обновляет статусы воронок для всех сообщений"""
+    logger.info("🔄 Автоматическое обновление статусов воронок...")
+    return pending_messages_manager.update_funnel_statuses()
+
+# ========== СИСТЕМА ЕДИНОГО УВЕДОМЛЕНИЯ ==========
+
+def create_master_notification_text(work_chat_id: int = None) -> str:
+    """Создает текст единого уведомления со всеми воронками (без дублирования чатов).
+    
+    С work_chat_id - только по клиентским чатам, направленным в этот рабочий чат.
+    """
+    return notification_renderer.render_master(work_chat_id)
+
+def delete_old_notifications(work_chat_id: int):
+    """Ставит удаление старых уведомлений рабочего чата в очередь исходящих"""
+    # Список старого формата (до нескольких рабочих чатов) относится к чату по умолчанию
+    include_legacy = work_chat_id == work_chat_manager.get_work_chat_id()
+    # Очищаем список сообщений - удалением занимается очередь
+    message_ids = master_notification_manager.take_message_ids(work_chat_id, include_legacy)
+    for message_id in message_ids:
+        outbox.delete_message(f"delete:{work_chat_id}:{message_id}", work_chat_id, message_id, purpose='old_notification')
+
+def on_master_notification_sent(item: Dict[str, Any], sent_message):
+    """Вызывается очередью после доставки уведомления: запоминаем его ID"""
+    work_chat_id = item['chat_id']
+    master_notification_manager.add_message_id(sent_message.message_id, work_chat_id)
+    # Очищаем старые сообщения (оставляем только последние 3)
+    master_notification_manager.clear_old_messages(work_chat_id, keep_last=3)
+    logger.info(f"✅ Отправлено новое единое уведомление в чат {work_chat_id}")
+
+outbox.register_callback('master_notification', on_master_notification_sent)
+
+async def send_new_master_notification(context: ContextTypes.DEFAULT_TYPE, force: bool = False, work_chat_id: int = None):
+    """Обновляет уведомления: удаление старых и отправка новых ставятся в очередь исходящих.
+    
+    Без work_chat_id обновляются все рабочие чаты, иначе - только указанный.
+    """
+    work_chat_ids = [work_chat_id] if work_chat_id is not None else work_chat_manager.get_all_work_chats()
+    if not work_chat_ids:
+        logger.error("❌ Не могу отправить уведомление: рабочий чат не установлен")
+        return False
+    
+    if not is_leader():
+        logger.warning("👑 Процесс не лидер: уведомление не отправляется")
+        return False
+    
+    sent = False
+    for target in work_chat_ids:
+        # Проверяем cooldown, если не форсированная отправка
+        if not force and not master_notification_manager.should_update(target):
+            logger.info(f"⏳ Cooldown: уведомление в чат {target} не отправляется (еще не прошло {master_notification_manager.notification_cooldown // 60} минут)")
+            continue
+        
+        try:
+            # Сначала удаляем старые уведомления
+            delete_old_notifications(target)
+            
+            # Затем отправляем новое; ID сообщения сохранит on_master_notification_sent
+            notification_text = create_master_notification_text(target)
+            outbox.send_message(
+                f"notification:{target}:{int(time_module.time() * 1000)}",
+                target,
+                notification_text,
+                purpose='master_notification',
+                parse_mode='Markdown'
+            )
+            
+            # УБРАНА АВТОМАТИЧЕСКАЯ ПОМЕТКА СООБЩЕНИЙ КАК ОБРАБОТАННЫХ
+            # Сообщения будут продолжать показываться пока на них не ответят
+            
+            # Обновляем время последней отправки
+            master_notification_manager.update_notification_time(target)
+            
+            logger.info(f"📤 Новое единое уведомление для чата {target} поставлено в очередь")
+            sent = True
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки нового уведомления в чат {target}: {e}")
+    
+    return sent
+
+async def check_and_send_new_notification(context: ContextTypes.DEFAULT_TYPE):
+    """Проверяет и отправляет новое уведомление с автоматическим обновлением статусов"""
+    logger.info("🔄 Проверка необходимости отправки уведомления...")
+    
+    if not is_leader():
+        logger.warning("👑 Процесс не лидер: проверка пропущена")
+        return
+    
+    # Вне рабочего времени возраст сообщений не растёт - пересчитывать нечего
+    if not business_calendar.is_working_time():
+        logger.info("🌙 Нерабочее время: проверка пропущена")
+        return
+    
+    # СНАЧАЛА ОБНОВЛЯЕМ СТАТУСЫ ВСЕХ СООБЩЕНИЙ
+    updated_count = await update_message_funnel_statuses()
+    if updated_count > 0:
+        logger.info(f"🔄 Обновлено {updated_count} статусов воронок перед отправкой уведомления")
+    
+    # ПОТОМ ОТПРАВЛЯЕМ УВЕДОМЛЕНИЕ
+    await send_new_master_notification(context)
+
+# ========== ПЛАНИРОВЩИК ПРОВЕРОК ==========
+
+def choose_notification_interval(now_epoch: float) -> tuple:
+    """Интервал до следующей проверки по состоянию очереди: (секунд, причина).
+    
+    Пустая очередь - верхняя граница. Есть сообщения в последней воронке - базовый
+    интервал сокращается с их числом. Только свежие сообщения - ждём, пока самое
+    старое дойдёт до первой воронки. Число сообщений по стадиям берётся из
+    диапазонов колонки времени (bisect), без обхода сообщений.
+    """
+    counts = {stage: end - start for start, end, stage in pending_messages_manager.stage_ranges(now_epoch)}
+    top_stage = funnels_config.stage_count()
+    if not sum(counts.values()):
+        interval, reason = CADENCE_MAX_SECONDS, "очередь пуста"
+    elif counts.get(top_stage):
+        interval = NOTIFICATION_INTERVAL / (1 + counts[top_stage] / CADENCE_TOP_STEP)
+        reason = f"в последней воронке {counts[top_stage]}"
+    elif any(counts.get(stage) for stage in range(1, top_stage)):
+        interval, reason = NOTIFICATION_INTERVAL, "есть сообщения в воронках"
+    else:
+        # Все сообщения моложе первого порога: рабочее время идёт не быстрее обычного
+        stage_zero_start = len(pending_messages_manager.epoch_column) - counts[0]
+        oldest = datetime.fromtimestamp(pending_messages_manager.epoch_column[stage_zero_start], MOSCOW_TZ)
+        passed = business_calendar.business_minutes_between(oldest, datetime.fromtimestamp(now_epoch, MOSCOW_TZ))
+        interval = (funnels_config.thresholds[0] - passed) * 60 + NOTIFICATION_STARTUP_DELAY
+        reason = "только свежие сообщения"
+    return int(min(CADENCE_MAX_SECONDS, max(CADENCE_MIN_SECONDS, interval))), reason
+
+def compute_next_run(after: datetime) -> tuple:
+    """Следующий запуск: через адаптивный интервал, но только в рабочее время, со случайным сдвигом.
+    
+    Возвращает (момент, описание интервала для лога).
+    """
+    interval, reason = choose_notification_interval(after.timestamp())
+    epoch = business_calendar.next_working_time(after + timedelta(seconds=interval))
+    when = datetime.fromtimestamp(epoch + random.uniform(0, NOTIFICATION_JITTER), MOSCOW_TZ)
+    return when, f"{interval // 60} мин ({reason})"
+
+def compute_startup_run(now: datetime) -> datetime:
+    """Первый запуск после старта.
+    
+    Если сохранённый запуск ещё впереди - ждём его. Если он пропущен во время
+    простоя, все пропущенные запуски сводятся к одному в ближайшее рабочее время.
+    """
+    earliest = now + timedelta(seconds=NOTIFICATION_STARTUP_DELAY)
+    next_run = master_notification_manager.get_next_run()
+    if next_run and next_run > earliest:
+        return next_run
+    
+    epoch = business_calendar.next_working_time(earliest)
+    return datetime.fromtimestamp(epoch + random.uniform(0, NOTIFICATION_JITTER), MOSCOW_TZ)
+
+def schedule_notification_job(job_queue, when: datetime, interval_text: str = None):
+    """Планирует проверку на указанное время и сохраняет его"""
+    master_notification_manager.set_next_run(when)
+    job_queue.run_once(notification_job, when=when, name=NOTIFICATION_JOB_NAME)
+    interval_info = f", интервал {interval_text}" if interval_text else ""
+    logger.info(f"⏭ Следующая проверка уведомлений: {when.strftime('%d.%m %H:%M:%S')}{interval_info}")
+
+def advance_notification_job(job_queue):
+    """Переносит проверку ближе, если по новому состоянию очереди она нужна раньше"""
+    if job_queue is None:
+        return
+    now = datetime.now(MOSCOW_TZ)
+    next_run = master_notification_manager.get_next_run()
+    # Ближе нижней границы переносить некуда - политику не пересчитываем
+    if next_run is not None and (next_run - now).total_seconds() <= CADENCE_MIN_SECONDS + NOTIFICATION_JITTER:
+        return
+    when, interval_text = compute_next_run(now)
+    # Разница в пределах случайного сдвига - не повод переносить (иначе перенос на каждое сообщение)
+    if next_run is not None and when >= next_run - timedelta(seconds=NOTIFICATION_JITTER):
+        return
+    for job in job_queue.get_jobs_by_name(NOTIFICATION_JOB_NAME):
+        job.schedule_removal()
+    schedule_notification_job(job_queue, when, interval_text)
+
+async def notification_job(context: ContextTypes.DEFAULT_TYPE):
+    """Выполняет проверку и планирует следующую"""
+    try:
+        pending_messages_manager.flush()
+        await check_and_send_new_notification(context)
+    finally:
+        schedule_notification_job(context.job_queue, *compute_next_run(datetime.now(MOSCOW_TZ)))
+
+async def renew_leader_lease_job(context: ContextTypes.DEFAULT_TYPE):
+    """Продлевает аренду; потеряв её, процесс останавливается и уступает лидеру"""
+    if await asyncio.to_thread(leader_lease.try_acquire):
+        return
+    logger.error(f"👑 Аренда лидерства потеряна ({INSTANCE_ID}), останавливаемся")
+    request_stop(context.application)
+
+# ========== ОТЛОЖЕННОЕ ОБНОВЛЕНИЕ УВЕДОМЛЕНИЯ ==========
+
+class RefreshDebouncer:
+    """Сводит серию принудительных обновлений в одно.
+    
+    Каждый запрос откладывает обновление на REFRESH_DEBOUNCE_SECONDS, но не дальше
+    REFRESH_MAX_WAIT_SECONDS от первого запроса серии. Обновляются только
+    рабочие чаты, затронутые запросами серии (None - все).
+    """
+    
+    def __init__(self):
+        self.job = None
+        self.targets: set = set()
+        self.first_request_time: Optional[datetime] = None
+        self.requested_count = 0
+        self.coalesced_count = 0
+        self.executed_count = 0
+    
+    def request(self, context: ContextTypes.DEFAULT_TYPE, work_chat_id: int = None):
+        self.requested_count += 1
+        self.targets.add(work_chat_id)
+        now = datetime.now(MOSCOW_TZ)
+        if self.job is not None:
+            self.job.schedule_removal()
+            self.coalesced_count += 1
+        else:
+            self.first_request_time = now
+        
+        deadline = self.first_request_time + timedelta(seconds=REFRESH_MAX_WAIT_SECONDS)
+        when = min(now + timedelta(seconds=REFRESH_DEBOUNCE_SECONDS), deadline)
+        self.job = context.job_queue.run_once(self.run, when=when, name="notification_refresh")
+    
+    async def run(self, context: ContextTypes.DEFAULT_TYPE):
+        self.job = None
+        self.first_request_time = None
+        self.executed_count += 1
+        targets, self.targets = self.targets, set()
+        if None in targets:
+            await send_new_master_notification(context, force=True)
+            return
+        for work_chat_id in targets:
+            await send_new_master_notification(context, force=True, work_chat_id=work_chat_id)
+
+async def request_notification_refresh(context: ContextTypes.DEFAULT_TYPE, work_chat_id: int = None):
+    """Запрашивает обновление уведомления (с задержкой, если доступен планировщик)"""
+    if context.job_queue is None:
+        await send_new_master_notification(context, force=True, work_chat_id=work_chat_id)
+        return
+    refresh_debouncer.request(context, work_chat_id)
+
+# ========== ОБРАБОТЧИК ОТВЕТОВ МЕНЕДЖЕРА ==========
+
+async def handle_manager_reply(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обрабатывает ответы менеджеров и обновляет уведомление"""
+    if not update or not update.message:
+        return
+        
+    username = update.message.from_user.username
+    if not is_manager(update.message.from_user.id, username):
+        return
+        
+    if update.message.text and update.message.text.startswith('/'):
+        return
+    
+    chat_id = update.message.chat.id
+    message_logger.info("🔍 Менеджер ответил в чате %s", chat_id)
+    
+    # Удаляем сообщения из pending для этого чата
+    removed_count = pending_messages_manager.remove_all_chat_messages(chat_id)
+    
+    if removed_count > 0:
+        logger.info("✅ Удалено %s сообщений из чата %s после ответа менеджера", removed_count, chat_id)
+        
+        # Обновляем уведомление только своего рабочего чата; серия ответов сводится в одно обновление
+        work_chat_id = work_chat_manager.route(chat_id, update.message.chat.title)
+        if work_chat_id is not None:
+            await request_notification_refresh(context, work_chat_id)
+
+# ========== КОМАНДЫ БОТА ==========
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    await update.message.reply_text(
+        "🤖 Бот-автоответчик запущен!\n\n"
+        "📋 Доступные команды:\n"
+        "/status - статус системы\n"
+        "/funnels - настройки воронок\n"
+        "/pending - список непрочитанных\n"
+        "/managers - список менеджеров\n"
+        "/stats - статистика\n"
+        "/help - помощь\n"
+        "/update_notification - обновить уведомление\n"
+        "/force_update_funnels - принудительно обновить воронки\n"
+        "/debug_funnels - отладка воронок\n"
+        "/fix_funnels - исправить статусы воронок\n\n"
+        "👥 **Управление исключениями:**\n"
+        "/add_exception - добавить исключение\n"
+        "/remove_exception - удалить исключение\n"
+        "/list_exceptions - список исключений\n"
+        "/clear_exceptions - очистить все исключения"
+    )
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    help_text = """
+📖 **СПРАВКА ПО КОМАНДАМ БОТА**
+
+**Основные команды:**
+/start - запуск бота
+/status - статус системы
+/help - эта справка
+
+**Управление воронками:**
+/funnels - текущие настройки воронок
+/set_funnel <номер> <минуты> - установить интервал воронки
+/add_funnel <минуты> [эмодзи] [подпись] - добавить стадию
+/remove_funnel <номер> - удалить стадию
+/reset_funnels - сбросить настройки воронок
+/force_update_funnels - принудительно обновить статусы воронок
+/debug_funnels - отладка воронок
+/fix_funnels - исправить статусы воронок
+
+**Рабочее время:**
+/calendar - рабочие дни, праздники и особые дни
+/add_holiday <дата> - добавить праздник
+/remove_holiday <дата> - удалить праздник
+/set_day_hours <дата> <с> <до> - особые часы дня (или off)
+/clear_day_hours <дата> - вернуть обычное расписание дня
+
+**Рабочий чат:**
+/set_work_chat - установить этот чат как рабочий (для уведомлений)
+/route <тег> - направлять чаты с тегом в этот рабочий чат
+/unroute <тег> - убрать направление тега
+/tag_chat <ID чата> [тег] - назначить тег клиентскому чату (без тега - снять)
+/tag_title <тег> <текст> - тег для чатов, в названии которых есть текст
+/untag_title <текст> - убрать правило по названию
+/routes - рабочие чаты, теги и правила
+
+**Управление сообщениями:**
+/pending [funnel=N] [age=мин] [title=текст] [user=@name] [sort=age|funnel] - непрочитанные по страницам
+/find <слова> - чаты, где писали об этом (ожидающие и архив)
+/clear_chat - очистить сообщения из текущего чата
+/clear_all - очистить все сообщения
+/export [csv|jsonl] [source=pending|history|all] [from=дата] [to=дата] [chat=ID] - выгрузка файлом
+
+**Управление исключениями:**
+/add_exception <ID/@username> [...] - добавить менеджеров
+/remove_exception <ID/@username> [...] - удалить менеджеров
+/import_exceptions [remove] - ответом на .csv/.txt: добавить (удалить) менеджеров из файла
+/list_exceptions - список всех менеджеров
+/clear_exceptions - очистить все исключения
+
+**Обновление уведомления:**
+/update_notification - обновить единое уведомление
+
+**Статистика:**
+/stats - статистика системы
+/load - нагрузка по часам недели и самые активные чаты
+/outbox - очередь исходящих сообщений
+/stalls - блокировки цикла событий
+/memstats [start|stop|snapshot] - память процесса и снимки tracemalloc
+/profile [обновлений] [секунд] - профиль следующих обновлений (/profile stop - досрочно)
+/managers - список менеджеров
+
+📝 **Логика работы воронок:**
+Стадии и их интервалы смотрите в /funnels (по умолчанию 🟡 1 час, 🟠 3 часа, 🔴 5 часов)
+Время без ответа считается только в рабочие часы (см. /calendar)
+**БЕЗ ДУБЛИРОВАНИЯ** - каждый чат показывается только в одной воронке
+    """
+    await update.message.reply_text(help_text, parse_mode='Markdown')
+
+async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    FUNNELS = funnels_config.get_funnels()
+    now = datetime.now(MOSCOW_TZ)
+    excluded_users = excluded_users_manager.get_all_excluded()
+    total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
+    
+    # Получаем статистику по воронкам (без дублирования)
+    all_messages = pending_messages_manager.get_all_pending_messages()
+    funnel_counts = notification_renderer.funnel_counts()
+    funnels_lines = "\n".join(
+        f"{funnels_config.get_emoji(n)} Воронка {n}: {minutes} мин ({minutes_to_hours_text(minutes)}) - {funnel_counts.get(n, 0)} чатов"
+        for n, minutes in FUNNELS.items()
+    )
+    
+    # Время последнего уведомления
+    last_notification = master_notification_manager.last_notification_time
+    last_notification_str = last_notification.strftime('%H:%M:%S') if last_notification else "Никогда"
+    next_run = master_notification_manager.get_next_run()
+    next_run_str = next_run.strftime('%d.%m %H:%M:%S') if next_run else "Не запланирована"
+    outbox_metrics = outbox.get_metrics()
+    leader_info = f" (лидер, срок {leader_lease.term})" if LEADER_ELECTION else ""
+    cadence_interval, cadence_reason = choose_notification_interval(now.timestamp())
+    api_info = f"{API_HOST}:{API_PORT}, запросов {json_api.requests_count} (304: {json_api.not_modified_count})" if json_api.server else "выключен"
+    
+    status_text = f"""
+📊 **СТАТУС СИСТЕМЫ**
+
+⏰ **Время:** {now.strftime('%d.%m.%Y %H:%M:%S')}
+🕐 **Рабочие часы:** {'✅ ДА' if is_working_hours() else '❌ НЕТ'}
+
+📋 **Непрочитанные сообщения:** {notification_renderer.total_messages()} (записей: {len(all_messages)})
+🚩 **Флаги автоответов:** {flags_manager.count_flags()}
+💬 **Рабочий чат:** {'✅ Установлен' if work_chat_manager.is_work_chat_set() else '❌ Не установлен'}
+📢 **Последнее уведомление:** {last_notification_str}
+⏭ **Следующая проверка:** {next_run_str}
+🔁 **Обновления после ответов:** {refresh_debouncer.executed_count} выполнено, {refresh_debouncer.coalesced_count} сведено
+📤 **Очередь исходящих:** {outbox_metrics['queued']} (старейшее {outbox_metrics['oldest_age']:.0f} с, ожиданий лимита {outbound_limiter.waits_count})
+💾 **Запись файлов:** {persistence.writes_count} (сведено {persistence.coalesced_count}, в очереди {persistence.queued()}, ошибок {persistence.errors_count})
+♻️ **Повторных обновлений отброшено:** {update_dedup.duplicates_count}
+🐢 **Блокировок цикла:** {loop_watchdog.stall_count} (макс. задержка {loop_watchdog.max_lag:.2f} с)
+🌐 **JSON API:** {api_info}
+🔁 **Перезагрузок настроек:** {config_watcher.reload_count} (ошибок {config_watcher.error_count})
+👑 **Процесс:** {INSTANCE_ID}{leader_info}
+
+⚙️ **НАСТРОЙКИ ВОРОНОК:**
+{funnels_lines}
+
+👥 **Менеджеров в системе:** {total_excluded} ({len(excluded_users["user_ids"])} ID + {len(excluded_users["usernames"])} username)
+
+🔄 **Логика уведомлений:** Удаление старого + отправка нового в рабочее время
+⏱ **Интервал проверок:** {cadence_interval // 60} мин ({cadence_reason}), границы {CADENCE_MIN_SECONDS // 60}-{CADENCE_MAX_SECONDS // 60} мин
+⏳ **Cooldown:** {'✅ Активен' if not master_notification_manager.should_update() else '❌ Можно отправлять'}
+🔧 **Логика воронок:** ✅ Без дублирования (1 чат = 1 воронка)
+    """
+    
+    await update.message.reply_text(status_text, parse_mode='Markdown')
+
+async def funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    FUNNELS = funnels_config.get_funnels()
+    stages_text = "".join(
+        f"""{funnels_config.get_emoji(n)} **Воронка {n} ({funnels_config.get_label(n)}):**
+   - Интервал: {minutes} минут ({minutes_to_hours_text(minutes)})
+   - Команда: `/set_funnel {n} <минуты>`
+
+"""
+        for n, minutes in FUNNELS.items()
+    )
+    
+    funnels_text = f"""
+⚙️ **ТЕКУЩИЕ НАСТРОЙКИ ВОРОНОК**
+
+{stages_text}➕ Добавить стадию: `/add_funnel <минуты> [эмодзи] [подпись]`
+➖ Удалить стадию: `/remove_funnel <номер>`
+🔄 Сбросить настройки: `/reset_funnels`
+🚀 Принудительное обновление: `/force_update_funnels`
+🐛 Отладка: `/debug_funnels`
+🔧 Исправить статусы: `/fix_funnels`
+
+📝 **Логика работы:**
+Единое уведомление обновляется раз в {CADENCE_MIN_SECONDS // 60}-{CADENCE_MAX_SECONDS // 60} минут: чем старше и больше очередь, тем чаще
+**СТАРОЕ УДАЛЯЕТСЯ, ОТПРАВЛЯЕТСЯ НОВОЕ**
+**COOLDOWN {CADENCE_MIN_SECONDS // 60} МИНУТ** - защита от частых отправок (нижняя граница интервала)
+**БЕЗ ДУБЛИРОВАНИЯ** - каждый чат показывается только в одной воронке
+    """
+    
+    await update.message.reply_text(funnels_text, parse_mode='Markdown')
+
+async def set_funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if len(context.args) != 2 or not context.args[0].isdigit() or not context.args[1].isdigit():
+        await update.message.reply_text("❌ Использование: /set_funnel <номер> <минуты>")
+        return
+    
+    funnel_number = int(context.args[0])
+    minutes = int(context.args[1])
+    if minutes <= 0:
+        await update.message.reply_text("❌ Количество минут должно быть положительным числом")
+        return
+    
+    if not 1 <= funnel_number <= funnels_config.stage_count():
+        await update.message.reply_text(f"❌ Воронки {funnel_number} нет (всего стадий: {funnels_config.stage_count()})")
+        return
+    
+    if funnels_config.set_funnel_interval(funnel_number, minutes):
+        await update.message.reply_text(f"✅ Воронка {funnel_number} установлена на {minutes} минут ({minutes_to_hours_text(minutes)})")
+        logger.info(f"✅ Настройки воронки {funnel_number} обновлены")
+        pending_messages_manager.update_funnel_statuses()
+    else:
+        await update.message.reply_text("❌ Ошибка установки интервала воронки: интервалы стадий должны строго возрастать")
+
+async def add_funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("❌ Использование: /add_funnel <минуты> [эмодзи] [подпись]")
+        return
+    
+    minutes = int(context.args[0])
+    emoji = context.args[1] if len(context.args) > 1 else "⚪"
+    label = " ".join(context.args[2:])
+    
+    funnel_number = funnels_config.add_stage(minutes, emoji, label)
+    if funnel_number:
+        await update.message.reply_text(f"✅ Добавлена воронка {funnel_number}: {minutes} минут ({minutes_to_hours_text(minutes)})")
+        pending_messages_manager.update_funnel_statuses()
+    else:
+        await update.message.reply_text("❌ Интервал должен быть положительным и не совпадать с существующей стадией")
+
+async def remove_funnel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("❌ Использование: /remove_funnel <номер>")
+        return
+    
+    funnel_number = int(context.args[0])
+    if funnels_config.remove_stage(funnel_number):
+        await update.message.reply_text(f"✅ Воронка {funnel_number} удалена")
+        pending_messages_manager.update_funnel_statuses()
+    else:
+        await update.message.reply_text("❌ Нельзя удалить эту воронку (нет такой стадии или она последняя)")
+
+async def reset_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    funnels_config.reset_to_default()
+    pending_messages_manager.update_funnel_statuses()
+    await update.message.reply_text("✅ Настройки воронок сброшены к значениям по умолчанию")
+    logger.info("✅ Настройки воронок сброшены")
+
+async def force_update_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Принудительно обновляет статусы воронок для всех сообщений"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    await update.message.reply_text("🔄 Принудительное обновление статусов воронок...")
+    
+    updated_count = await update_message_funnel_statuses()
+    
+    if updated_count > 0:
+        await update.message.reply_text(f"✅ Обновлено статусов воронок: {updated_count} сообщений")
+        # Сразу отправляем обновленное уведомление
+        await send_new_master_notification(context, force=True)
+    else:
+        await update.message.reply_text("ℹ️ Не требуется обновление статусов воронок")
+
+async def debug_funnels_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для отладки воронок"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    debug_text = notification_renderer.render_debug()
+    
+    await update.message.reply_text(debug_text, parse_mode='Markdown')
+
+async def fix_funnel_statuses_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Исправляет статусы воронок для всех сообщений"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    await update.message.reply_text("🔧 Исправляю статусы воронок...")
+    
+    fixed_count = pending_messages_manager.update_funnel_statuses()
+    
+    if fixed_count > 0:
+        await update.message.reply_text(f"✅ Исправлено статусов воронок: {fixed_count} сообщений")
+        # Сразу отправляем обновленное уведомление
+        await send_new_master_notification(context, force=True)
+    else:
+        await update.message.reply_text("ℹ️ Не требуется исправление статусов воронок")
+
+async def update_notification_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда для ручного обновления уведомления"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    await update.message.reply_text("🔄 Обновляю единое уведомление...")
+    success = await send_new_master_notification(context, force=True)
+    
+    if success:
+        await update.message.reply_text("✅ Единое уведомление обновлено")
+    else:
+        await update.message.reply_text("❌ Ошибка обновления уведомления")
+
+async def outbox_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Метрики очереди исходящих сообщений"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    metrics = outbox.get_metrics()
+    outbox_text = f"""
+📤 **ОЧЕРЕДЬ ИСХОДЯЩИХ**
+
+🤖 Бот: {get_runtime().name}
+📋 В очереди: {metrics['queued']} (всего в процессе: {metrics['queued_total']})
+⏳ Старейшее ожидает: {metrics['oldest_age']:.1f} с
+✅ Отправлено: {metrics['sent']}
+🔁 Повторов: {metrics['retries']}
+❌ Не доставлено: {metrics['failed']}
+⏱ Задержка доставки: медиана {metrics['lag_p50']:.2f} с, максимум {metrics['lag_max']:.2f} с
+    """
+    await update.message.reply_text(outbox_text, parse_mode='Markdown')
+
+async def stalls_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Блокировки цикла событий: гистограмма задержек и последние события"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    parts = [
+        f"🐢 БЛОКИРОВКИ ЦИКЛА СОБЫТИЙ\n\n"
+        f"Порог: {loop_watchdog.threshold} с, блокировок: {loop_watchdog.stall_count}, "
+        f"максимальная задержка: {loop_watchdog.max_lag:.2f} с\n\n"
+        f"Задержка планирования:\n{loop_watchdog.format_histogram() or 'нет замеров'}\n"
+    ]
+    for event in list(loop_watchdog.stalls)[-3:]:
+        parts.append(f"\n⏱ {event['at'].strftime('%d.%m %H:%M:%S')} - {event['duration']:.2f} с\n{event['stack'][-800:]}")
+    # Без Markdown: в стеке встречаются символы разметки
+    await update.message.reply_text("".join(parts)[-4000:])
+
+async def set_work_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    chat_id = update.message.chat.id
+    if work_chat_manager.save_work_chat(chat_id):
+        # Чаты без своего тега теперь направляются сюда
+        pending_messages_manager.notify_chat_changed(None)
+        await update.message.reply_text(f"✅ Этот чат установлен как рабочий (ID: {chat_id})")
+        # Сразу отправляем уведомление в новый рабочий чат (форсированно)
+        await send_new_master_notification(context, force=True, work_chat_id=chat_id)
+    else:
+        await update.message.reply_text("❌ Ошибка сохранения рабочего чата")
+
+def apply_routing_change():
+    """Маршруты изменились: перераспределяем чаты по рабочим чатам"""
+    pending_messages_manager.notify_chat_changed(None)
+
+async def route_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if len(context.args) != 1:
+        await update.message.reply_text("❌ Использование: /route <тег> (в рабочем чате)")
+        return
+    
+    tag = context.args[0].lower()
+    chat_id = update.message.chat.id
+    if not work_chat_manager.set_route(tag, chat_id):
+        await update.message.reply_text("❌ Ошибка сохранения маршрута")
+        return
+    apply_routing_change()
+    await update.message.reply_text(f"✅ Чаты с тегом «{tag}» направляются в этот чат (ID: {chat_id})")
+    await send_new_master_notification(context, force=True)
+
+async def unroute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if len(context.args) != 1:
+        await update.message.reply_text("❌ Использование: /unroute <тег>")
+        return
+    
+    tag = context.args[0].lower()
+    if work_chat_manager.remove_route(tag):
+        apply_routing_change()
+        await update.message.reply_text(f"✅ Маршрут тега «{tag}» удалён, его чаты идут в рабочий чат по умолчанию")
+        await send_new_master_notification(context, force=True)
+    else:
+        await update.message.reply_text(f"ℹ️ Для тега «{tag}» маршрута нет")
+
+async def tag_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if len(context.args) not in (1, 2) or not context.args[0].lstrip('-').isdigit():
+        await update.message.reply_text("❌ Использование: /tag_chat <ID чата> [тег]")
+        return
+    
+    chat_id = int(context.args[0])
+    tag = context.args[1].lower() if len(context.args) == 2 else None
+    if not work_chat_manager.set_chat_tag(chat_id, tag):
+        await update.message.reply_text("❌ Ошибка сохранения тега")
+        return
+    pending_messages_manager.notify_chat_changed(chat_id)
+    if tag:
+        await update.message.reply_text(f"✅ Чату {chat_id} назначен тег «{tag}»")
+    else:
+        await update.message.reply_text(f"✅ Тег чата {chat_id} снят")
+    await send_new_master_notification(context, force=True)
+
+async def tag_title_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if len(context.args) < 2:
+        await update.message.reply_text("❌ Использование: /tag_title <тег> <текст в названии>")
+        return
+    
+    tag = context.args[0].lower()
+    pattern = " ".join(context.args[1:])
+    if not work_chat_manager.add_title_pattern(pattern, tag):
+        await update.message.reply_text("❌ Ошибка сохранения правила")
+        return
+    apply_routing_change()
+    await update.message.reply_text(f"✅ Чаты с «{pattern}» в названии получают тег «{tag}»")
+    await send_new_master_notification(context, force=True)
+
+async def untag_title_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /untag_title <текст в названии>")
+        return
+    
+    pattern = " ".join(context.args)
+    if work_chat_manager.remove_title_pattern(pattern):
+        apply_routing_change()
+        await update.message.reply_text(f"✅ Правило «{pattern}» удалено")
+        await send_new_master_notification(context, force=True)
+    else:
+        await update.message.reply_text(f"ℹ️ Правила «{pattern}» нет")
+
+async def routes_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    default_chat = work_chat_manager.get_work_chat_id()
+    lines = ["🧭 **МАРШРУТЫ УВЕДОМЛЕНИЙ**\n", f"💬 Рабочий чат по умолчанию: {default_chat if default_chat is not None else 'не установлен'}"]
+    
+    lines.append("\n🏷 **Теги → рабочие чаты:**")
+    lines.extend(f"  • {tag} → {chat_id}" for tag, chat_id in sorted(work_chat_manager.routes.items()))
+    if not work_chat_manager.routes:
+        lines.append("  Нет")
+    
+    lines.append("\n📌 **Теги чатов:**")
+    lines.extend(f"  • {chat_id}: {tag}" for chat_id, tag in sorted(work_chat_manager.chat_tags.items()))
+    if not work_chat_manager.chat_tags:
+        lines.append("  Нет")
+    
+    lines.append("\n🔤 **Правила по названию:**")
+    lines.extend(f"  • «{pattern}» → {tag}" for pattern, tag in sorted(work_chat_manager.title_patterns.items()))
+    if not work_chat_manager.title_patterns:
+        lines.append("  Нет")
+    
+    # Чатов в уведомлении каждого рабочего чата
+    notification_renderer.sync()
+    lines.append("\n📊 **Чатов в уведомлениях:**")
+    for work_chat_id in work_chat_manager.get_all_work_chats():
+        messages, chats = notification_renderer.target_stats.get(work_chat_id, (0, 0))
+        lines.append(f"  • {work_chat_id}: {chats} чатов, {messages} сообщений")
+    
+    await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+async def managers_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    excluded_users = excluded_users_manager.get_all_excluded()
+    
+    if not excluded_users["user_ids"] and not excluded_users["usernames"]:
+        await update.message.reply_text("📝 Список менеджеров пуст")
+        return
+    
+    text = "👥 **СПИСОК МЕНЕДЖЕРОВ**\n\n"
+    
+    if excluded_users["user_ids"]:
+        text += "🆔 **По ID:**\n"
+        for i, user_id in enumerate(excluded_users["user_ids"], 1):
+            text += f"{i}. `{user_id}`\n"
+        text += "\n"
+    
+    if excluded_users["usernames"]:
+        text += "👤 **По username:**\n"
+        for i, username in enumerate(excluded_users["usernames"], 1):
+            text += f"{i}. `@{username}`\n"
+    
+    text += f"\n📊 Всего: {len(excluded_users['user_ids'])} ID + {len(excluded_users['usernames'])} username"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    all_pending = pending_messages_manager.get_all_pending_messages()
+    excluded_users = excluded_users_manager.get_all_excluded()
+    total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
+    
+    # Статистика воронок по чатам (из кэша рендера)
+    funnel_counts = notification_renderer.funnel_counts()
+    funnels_lines = "\n".join(
+        f"   - {funnels_config.get_emoji(n)} Воронка {n}: {funnel_counts.get(n, 0)} чатов"
+        for n in range(1, funnels_config.stage_count() + 1)
+    )
+    
+    now = datetime.now(MOSCOW_TZ)
+    time_stats = {"менее 1 часа": 0, "1-3 часа": 0, "3-6 часов": 0, "более 6 часов": 0}
+    
+    for message in all_pending:
+        timestamp = datetime.fromisoformat(message['timestamp'])
+        time_diff = now - timestamp
+        hours_passed = time_diff.total_seconds() / 3600
+        
+        if hours_passed < 1:
+            time_stats["менее 1 часа"] += 1
+        elif hours_passed < 3:
+            time_stats["1-3 часа"] += 1
+        elif hours_passed < 6:
+            time_stats["3-6 часов"] += 1
+        else:
+            time_stats["более 6 часов"] += 1
+    
+    # Время последнего уведомления
+    last_notification = master_notification_manager.last_notification_time
+    last_notification_str = last_notification.strftime('%H:%M:%S') if last_notification else "Никогда"
+    
+    stats_text = f"""
+📈 **СТАТИСТИКА СИСТЕМЫ**
+
+📊 **Общая статистика:**
+   - Непрочитанных сообщений: {notification_renderer.total_messages()} (записей: {len(all_pending)})
+   - Чатов с сообщениями: {len(pending_messages_manager.chat_index)}
+   - Флагов автоответов: {flags_manager.count_flags()}
+   - Менеджеров в системе: {total_excluded} ({len(excluded_users["user_ids"])} ID + {len(excluded_users["usernames"])} username)
+   - Последнее уведомление: {last_notification_str}
+
+⚙️ **Статистика воронок:**
+{funnels_lines}
+
+⏱ **Время ожидания ответа:**
+   - Менее 1 часа: {time_stats['менее 1 часа']}
+   - 1-3 часа: {time_stats['1-3 часа']}
+   - 3-6 часов: {time_stats['3-6 часов']}
+   - Более 6 часов: {time_stats['более 6 часов']}
+
+💬 **Рабочий чат:** {'✅ Установлен' if work_chat_manager.is_work_chat_set() else '❌ Не установлен'}
+🔄 **Логика уведомлений:** Удаление старого + отправка нового в рабочее время (интервал по состоянию очереди)
+⏳ **Cooldown:** {'✅ Активен' if not master_notification_manager.should_update() else '❌ Можно отправлять'}
+🔧 **Логика воронок:** ✅ Без дублирования (1 чат = 1 воронка)
+🕐 **Текущее время:** {now.strftime('%H:%M:%S')}
+    """
+    
+    await update.message.reply_text(stats_text, parse_mode='Markdown')
+
+PENDING_FILTER_KEYS = ('funnel', 'age', 'title', 'user', 'sort')
+
+def parse_pending_filters(args: List[str]) -> Optional[Dict[str, Any]]:
+    """Разбирает аргументы вида funnel=3 age=60 title=текст user=@name sort=funnel"""
+    pending_filters: Dict[str, Any] = {'sort': 'age'}
+    for arg in args:
+        key, sep, value = arg.partition('=')
+        if not sep or key not in PENDING_FILTER_KEYS or not value:
+            return None
+        if key in ('funnel', 'age'):
+            if not value.isdigit():
+                return None
+            pending_filters[key] = int(value)
+        elif key == 'sort':
+            if value not in ('age', 'funnel'):
+                return None
+            pending_filters[key] = value
+        elif key == 'user':
+            # Только ID или допустимый username - в каноническом виде, без '|' и лишних символов
+            user = parse_user_identifier(value)
+            if user is None or (isinstance(user, int) and user >= 2 ** 63):
+                return None
+            pending_filters[key] = user
+        else:
+            pending_filters[key] = value
+    return pending_filters
+
+def encode_pending_callback(pending_filters: Dict[str, Any], page: int, cursor: int, forward: bool) -> Optional[str]:
+    """Состояние страницы целиком в callback_data (лимит Telegram - 64 байта).
+    
+    Подстрока названия укорачивается под лимит; None - фильтры не помещаются даже без неё.
+    """
+    head = f"pg|{'n' if forward else 'p'}|{page}|{cursor}|{pending_filters.get('sort', 'age')[0]}|{pending_filters.get('funnel', '')}|{pending_filters.get('age', '')}|{pending_filters.get('user', '')}|"
+    if len(head.encode()) > 64:
+        return None
+    title = pending_filters.get('title', '')
+    while len((head + title).encode()) > 64:
+        title = title[:-1]
+    return head + title
+
+def decode_pending_callback(data: str) -> tuple:
+    _, direction, page, cursor, sort, funnel, age, user, title = data.split('|', 8)
+    pending_filters: Dict[str, Any] = {'sort': 'funnel' if sort == 'f' else 'age'}
+    if funnel:
+        pending_filters['funnel'] = int(funnel)
+    if age:
+        pending_filters['age'] = int(age)
+    if user:
+        pending_filters['user'] = parse_user_identifier(user)
+    if title:
+        pending_filters['title'] = title
+    return pending_filters, int(page), int(cursor), direction == 'n'
+
+def build_pending_page(pending_filters: Dict[str, Any], page: int, cursor: int, forward: bool) -> tuple:
+    text, start_cursor, next_cursor = notification_renderer.render_pending_page(pending_filters, cursor, forward, page)
+    buttons = []
+    if page > 1:
+        callback_data = encode_pending_callback(pending_filters, page - 1, start_cursor, False)
+        if callback_data:
+            buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=callback_data))
+    if next_cursor is not None:
+        callback_data = encode_pending_callback(pending_filters, page + 1, next_cursor, True)
+        if callback_data:
+            buttons.append(InlineKeyboardButton("Далее ➡️", callback_data=callback_data))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+async def pending_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not pending_messages_manager.pending_messages:
+        await update.message.reply_text("✅ Нет непрочитанных сообщений")
+        return
+    
+    pending_filters = parse_pending_filters(context.args or [])
+    if pending_filters is None:
+        await update.message.reply_text("❌ Использование: /pending [funnel=N] [age=минуты] [title=текст] [user=ID|@username] [sort=age|funnel]")
+        return
+    
+    pending_text, keyboard = build_pending_page(pending_filters, 1, 0, True)
+    await update.message.reply_text(pending_text, parse_mode='Markdown', reply_markup=keyboard)
+
+async def pending_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание /pending кнопками; всё состояние страницы приходит в callback_data"""
+    query = update.callback_query
+    if not is_admin(query.from_user.id):
+        await query.answer("❌ Нет прав", show_alert=True)
+        return
+    
+    pending_filters, page, cursor, forward = decode_pending_callback(query.data)
+    pending_text, keyboard = build_pending_page(pending_filters, page, cursor, forward)
+    await query.answer()
+    await query.edit_message_text(pending_text, parse_mode='Markdown', reply_markup=keyboard)
+
+async def load_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Тепловая карта входящих по часам недели и самые активные чаты"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    heatmap, weeks, peak, peaks = arrival_stats.render_heatmap()
+    text = f"📈 **Входящие по часам недели** (среднее за {weeks} нед., пик {peak:.1f}/час)\n"
+    text += f"```\n{heatmap}\n```\n"
+    text += f"`{HEATMAP_SHADES[1]}{HEATMAP_SHADES[2]}{HEATMAP_SHADES[3]}{HEATMAP_SHADES[4]}` - от малого к пику\n"
+    if peaks:
+        text += f"🔥 Пики: {peaks}\n"
+    
+    busiest = arrival_stats.busiest_chats()
+    if busiest:
+        text += f"\n💬 **Самые активные чаты за {CHAT_RATE_HOURS} ч:**\n"
+        for i, (chat_id, title, count) in enumerate(busiest, 1):
+            text += f"{i}. {escape_markdown(title or f'Чат {chat_id}')} - {count}\n"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Поиск чатов по словам из текста ожидающих и архивных сообщений"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    query = " ".join(context.args or [])
+    if not tokenize_text(query):
+        await update.message.reply_text("❌ Использование: /find <слова>")
+        return
+    
+    started = time_module.perf_counter()
+    results = search_index.search(query)
+    elapsed_ms = (time_module.perf_counter() - started) * 1000
+    if not results:
+        await update.message.reply_text(f"🔎 По запросу «{query}» ничего не найдено")
+        return
+    
+    lines = [f"🔎 «{query}»: {len(results)} чатов ({elapsed_ms:.2f} мс)\n"]
+    for i, result in enumerate(results, 1):
+        when = datetime.fromtimestamp(result['epoch'], MOSCOW_TZ).strftime('%d.%m %H:%M')
+        status = "⏳" if result['pending'] else "📁"
+        title = result['chat_title'] or f"Чат {result['chat_id']}"
+        lines.append(f"{i}. {status} {title} ({when})\n   {result['author']}: {result['snippet']}")
+    lines.append("\n⏳ - ждёт ответа, 📁 - из архива")
+    await update.message.reply_text("\n".join(lines))
+
+async def clear_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    chat_id = update.message.chat.id
+    removed_count = pending_messages_manager.remove_all_chat_messages(chat_id, reason='cleared')
+    
+    if removed_count > 0:
+        await update.message.reply_text(f"✅ Удалено {removed_count} сообщений из этого чата")
+        logger.info(f"✅ Удалены сообщения из чата {chat_id}")
+    else:
+        await update.message.reply_text("✅ В этом чате нет непрочитанных сообщений")
+
+async def clear_all_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    removed_count = pending_messages_manager.clear_all()
+    await update.message.reply_text(f"✅ Удалены все непрочитанные сообщения ({removed_count} шт.)")
+    logger.info("✅ Все сообщения очищены")
+
+# ========== ЭКСПОРТ ДАННЫХ ==========
+
+EXPORT_FIELDS = [
+    'source', 'message_key', 'chat_id', 'chat_title', 'user_id', 'username', 'first_name',
+    'timestamp', 'last_timestamp', 'count', 'current_funnel', 'message_text', 'closed_at', 'close_reason'
+]
+
+def iter_export_sources(source: str, pending_snapshot: List[Dict[str, Any]]):
+    """Источники экспорта: снимок непрочитанных и/или архив (читается потоково).
+    
+    Снимок - список ссылок на записи; копия каждой делается по одной в filter_export_records.
+    """
+    if source in ('pending', 'all'):
+        for message in pending_snapshot:
+            yield 'pending', message
+    if source in ('history', 'all'):
+        for message in message_history.iter_records():
+            yield 'history', message
+
+def filter_export_records(records, date_from: Optional[date], date_to: Optional[date], chat_id: Optional[int]):
+    """Фильтр по дате первого сообщения (МСК) и по чату"""
+    date_from_str = date_from.isoformat() if date_from else None
+    date_to_str = date_to.isoformat() if date_to else None
+    for source, message in records:
+        day = message.get('timestamp', '')[:10]
+        if date_from_str and day < date_from_str:
+            continue
+        if date_to_str and day > date_to_str:
+            continue
+        if chat_id is not None and message.get('chat_id') != chat_id:
+            continue
+        yield dict(message, source=source)
+
+def write_export(records, export_format: str, path: str) -> int:
+    """Пишет записи в gzip-файл CSV или JSONL; возвращает количество записей"""
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+        if export_format == 'csv':
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for record in records:
+                writer.writerow(record)
+                count += 1
+        else:
+            for record in records:
+                f.write(json.dumps({field: record.get(field) for field in EXPORT_FIELDS}, ensure_ascii=False) + "\n")
+                count += 1
+    return count
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    usage = "❌ Использование: /export [csv|jsonl] [source=pending|history|all] [from=ГГГГ-ММ-ДД] [to=ГГГГ-ММ-ДД] [chat=ID]"
+    export_format, source = 'csv', 'all'
+    date_from = date_to = chat_id = None
+    for arg in context.args or []:
+        key, sep, value = arg.partition('=')
+        if not sep and key in ('csv', 'jsonl'):
+            export_format = key
+        elif key == 'source' and value in ('pending', 'history', 'all'):
+            source = value
+        elif key in ('from', 'to') and parse_date_arg(value):
+            if key == 'from':
+                date_from = parse_date_arg(value)
+            else:
+                date_to = parse_date_arg(value)
+        elif key == 'chat' and value.lstrip('-').isdigit():
+            chat_id = int(value)
+        else:
+            await update.message.reply_text(usage)
+            return
+    
+    await update.message.reply_text("📦 Готовлю выгрузку...")
+    
+    # Состав снимка фиксируется в потоке событий (только ссылки, без копий записей);
+    # дальше конвейер генераторов работает в отдельном потоке
+    pending_snapshot = list(pending_messages_manager.pending_messages.values())
+    fd, path = tempfile.mkstemp(suffix=f".{export_format}.gz")
+    os.close(fd)
+    try:
+        records = filter_export_records(iter_export_sources(source, pending_snapshot), date_from, date_to, chat_id)
+        count = await asyncio.to_thread(write_export, records, export_format, path)
+        filename = f"export_{source}_{datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M')}.{export_format}.gz"
+        with open(path, 'rb') as f:
+            await update.message.reply_document(document=f, filename=filename, caption=f"✅ Записей: {count}")
+    except Exception as e:
+        logger.error(f"Ошибка экспорта: {e}")
+        await update.message.reply_text("❌ Ошибка при подготовке выгрузки")
+    finally:
+        os.remove(path)
+
+# ========== ДИАГНОСТИКА ПАМЯТИ ==========
+
+def deep_sizeof(obj) -> int:
+    """Размер объекта вместе со всем, на что он ссылается (общие объекты считаются один раз)"""
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        item = stack.pop()
+        if id(item) in seen:
+            continue
+        seen.add(id(item))
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset, collections.deque)):
+            stack.extend(item)
+        elif hasattr(item, '__dict__') and not isinstance(item, type):
+            stack.append(item.__dict__)
+    return total
+
+def format_bytes(size: float) -> str:
+    for unit in ("Б", "КБ", "МБ"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} ГБ"
+
+def get_rss_bytes() -> Optional[int]:
+    """Текущий RSS процесса (Linux), иначе пиковый из getrusage"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (ImportError, OSError):
+        return None
+
+def collect_memory_usage() -> List[tuple]:
+    """(название, элементов, размер) для структур текущего бота и общих очередей"""
+    structures = [
+        ("pending_messages", pending_messages_manager.pending_messages),
+        ("индексы сообщений", (pending_messages_manager.chat_index, pending_messages_manager.chat_last_key,
+                               pending_messages_manager.media_group_index, pending_messages_manager.column_keys,
+                               pending_messages_manager.epoch_column, pending_messages_manager.funnel_column)),
+        ("флаги автоответов", flags_manager.flags),
+        ("состояние воронок", funnels_state_manager.state),
+        ("исключения", excluded_users_manager.excluded_users),
+        ("поток сообщений", (arrival_stats.chat_rates, arrival_stats.chat_titles, arrival_stats.hour_counts, arrival_stats.hour_stamps)),
+        ("поисковый индекс", (search_index.docs, search_index.postings, search_index.pending_ids,
+                              search_index.pending_docs, search_index.archived_ids)),
+        ("кэш уведомлений", (notification_renderer.chats, notification_renderer.lines, notification_renderer.sections,
+                             notification_renderer.members, notification_renderer.ordered, notification_renderer.target_members,
+                             notification_renderer.target_ordered)),
+        ("повторы обновлений", update_dedup.recent),
+        ("очередь исходящих", (outbox.items, outbox.sent_keys)),
+    ]
+    usage = []
+    for name, structure in structures:
+        count = len(structure[0]) if isinstance(structure, tuple) else len(structure)
+        usage.append((name, count, deep_sizeof(structure)))
+    return usage
+
+class MemoryTracer:
+    """Управление tracemalloc: топ мест выделения и разница с прошлым снимком"""
+    
+    TOP_LIMIT = 30
+    
+    def __init__(self):
+        self.previous: Optional[tracemalloc.Snapshot] = None
+    
+    def start(self, frames: int = 1):
+        tracemalloc.start(frames)
+        self.previous = None
+    
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+    
+    def snapshot_report(self) -> str:
+        """Снимок и отчёт; разница считается относительно предыдущего снимка"""
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"tracemalloc: {format_bytes(current)} сейчас, {format_bytes(peak)} пик",
+            "",
+            f"Топ-{self.TOP_LIMIT} мест выделения памяти:"
+        ]
+        for stat in snapshot.statistics('lineno')[:self.TOP_LIMIT]:
+            lines.append(f"{format_bytes(stat.size):>10}  {stat.count:>8}  {stat.traceback}")
+        if self.previous is not None:
+            lines += ["", f"Разница с предыдущим снимком (топ-{self.TOP_LIMIT}):"]
+            for stat in snapshot.compare_to(self.previous, 'lineno')[:self.TOP_LIMIT]:
+                lines.append(f"{stat.size_diff:>+12}  {stat.count_diff:>+8}  {stat.traceback}")
+        self.previous = snapshot
+        return "\n".join(lines) + "\n"
+
+memory_tracer = MemoryTracer()
+
+async def memstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    args = context.args or []
+    action = args[0] if args else None
+    if action == 'start':
+        frames = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+        memory_tracer.start(frames)
+        await update.message.reply_text(f"✅ tracemalloc включён (глубина стека: {frames})")
+        return
+    if action == 'stop':
+        memory_tracer.stop()
+        await update.message.reply_text("✅ tracemalloc выключен")
+        return
+    if action == 'snapshot':
+        if not tracemalloc.is_tracing():
+            await update.message.reply_text("❌ tracemalloc не включён: /memstats start")
+            return
+        report = await asyncio.to_thread(memory_tracer.snapshot_report)
+        filename = f"memstats_{datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M%S')}.txt"
+        await update.message.reply_document(document=report.encode('utf-8'), filename=filename, caption="📸 Снимок tracemalloc")
+        return
+    if action is not None:
+        await update.message.reply_text("❌ Использование: /memstats [start [кадров]|stop|snapshot]")
+        return
+    
+    rss = get_rss_bytes()
+    lines = ["🧠 ПАМЯТЬ", "", f"RSS процесса: {format_bytes(rss) if rss is not None else 'недоступно'}", ""]
+    for name, count, size in collect_memory_usage():
+        lines.append(f"• {name}: {count} элем., {format_bytes(size)}")
+    lines += [
+        "",
+        f"GC (счётчики поколений): {gc.get_count()}",
+        "GC (сборок по поколениям): " + ", ".join(str(stats['collections']) for stats in gc.get_stats()),
+        f"Объектов под GC: {len(gc.get_objects())}",
+        f"tracemalloc: {'включён' if tracemalloc.is_tracing() else 'выключен'}"
+    ]
+    await update.message.reply_text("\n".join(lines))
+
+# ========== ПРОФИЛИРОВАНИЕ ПО ЗАПРОСУ ==========
+
+class UpdateProfiler:
+    """cProfile на следующие N обновлений или T секунд.
+    
+    Профилировщик включается для всего потока цикла событий, поэтому в отчёт
+    попадают обработчики, задания планировщика и запись файлов. Пока
+    профилирование не запрошено, профилировщик не установлен вовсе.
+    """
+    
+    def __init__(self):
+        self.profile: Optional[cProfile.Profile] = None
+        self.remaining = 0
+        self.updates_seen = 0
+        self.started_at = 0.0
+        self.chat_id: Optional[int] = None
+        self.bot = None
+        self.timer_job = None
+    
+    @property
+    def active(self) -> bool:
+        return self.profile is not None
+    
+    def start(self, bot, chat_id: int, updates: int):
+        self.profile = cProfile.Profile()
+        self.remaining = updates
+        self.updates_seen = 0
+        self.started_at = time_module.monotonic()
+        self.chat_id = chat_id
+        self.bot = bot
+        self.profile.enable()
+    
+    def count_update(self):
+        """Учитывает обновление, пришедшее во время профилирования"""
+        self.updates_seen += 1
+    
+    @property
+    def exhausted(self) -> bool:
+        return self.updates_seen >= self.remaining
+    
+    def stop(self) -> Optional[tuple]:
+        """Выключает профилировщик; возвращает (профиль, бот, чат, обновлений, секунд)"""
+        if self.profile is None:
+            return None
+        self.profile.disable()
+        if self.timer_job is not None:
+            self.timer_job.schedule_removal()
+        result = (self.profile, self.bot, self.chat_id, self.updates_seen, time_module.monotonic() - self.started_at)
+        self.profile = self.bot = self.chat_id = self.timer_job = None
+        return result
+
+update_profiler = UpdateProfiler()
+
+def build_profile_report(profile: cProfile.Profile, updates: int, seconds: float) -> tuple:
+    """Текстовый отчёт (сортировка по cumulative и tottime) и содержимое .prof"""
+    stream = io.StringIO()
+    stream.write(f"Профиль: {updates} обновлений за {seconds:.1f} с\n\n")
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_REPORT_LINES)
+    stats.sort_stats(pstats.SortKey.TIME).print_stats(PROFILE_REPORT_LINES)
+    fd, path = tempfile.mkstemp(suffix=".prof")
+    os.close(fd)
+    try:
+        profile.dump_stats(path)
+        with open(path, 'rb') as f:
+            prof_data = f.read()
+    finally:
+        os.remove(path)
+    return stream.getvalue(), prof_data
+
+async def finish_profiling():
+    """Останавливает профилирование и отправляет отчёт запросившему"""
+    result = update_profiler.stop()
+    if result is None:
+        return
+    profile, bot, chat_id, updates, seconds = result
+    try:
+        report, prof_data = await asyncio.to_thread(build_profile_report, profile, updates, seconds)
+        stamp = datetime.now(MOSCOW_TZ).strftime('%Y%m%d_%H%M%S')
+        await bot.send_document(chat_id=chat_id, document=report.encode('utf-8'), filename=f"profile_{stamp}.txt",
+                                caption=f"⏱ Профиль: {updates} обновлений за {seconds:.0f} с")
+        await bot.send_document(chat_id=chat_id, document=prof_data, filename=f"profile_{stamp}.prof")
+    except Exception as e:
+        logger.error(f"Ошибка отправки профиля: {e}")
+
+async def profile_timeout_job(context: ContextTypes.DEFAULT_TYPE):
+    update_profiler.timer_job = None
+    await finish_profiling()
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    args = context.args or []
+    if args == ['stop']:
+        if not update_profiler.active:
+            await update.message.reply_text("ℹ️ Профилирование не запущено")
+            return
+        await finish_profiling()
+        return
+    
+    if len(args) > 2 or not all(arg.isdigit() and int(arg) > 0 for arg in args):
+        await update.message.reply_text("❌ Использование: /profile [обновлений] [секунд] или /profile stop")
+        return
+    if update_profiler.active:
+        await update.message.reply_text("ℹ️ Профилирование уже идёт: /profile stop")
+        return
+    if context.job_queue is None:
+        await update.message.reply_text("❌ Планировщик недоступен - профилирование не остановится само")
+        return
+    
+    updates = int(args[0]) if args else PROFILE_DEFAULT_UPDATES
+    seconds = min(int(args[1]) if len(args) > 1 else PROFILE_DEFAULT_SECONDS, PROFILE_MAX_SECONDS)
+    await update.message.reply_text(f"⏱ Профилирую следующие {updates} обновлений, не дольше {seconds} с")
+    update_profiler.start(context.bot, update.message.chat.id, updates)
+    update_profiler.timer_job = context.job_queue.run_once(profile_timeout_job, seconds, name="profile_timeout")
+
+# ========== КОМАНДЫ БИЗНЕС-КАЛЕНДАРЯ ==========
+
+def parse_date_arg(value: str) -> Optional[date]:
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        return None
+
+async def calendar_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    config = business_calendar.config
+    weekdays = ", ".join(WEEKDAY_NAMES[d] for d in sorted(config.get("weekdays", [])))
+    today = datetime.now(MOSCOW_TZ).date()
+    
+    days_lines = []
+    for offset in range(7):
+        day = today + timedelta(days=offset)
+        intervals = business_calendar.day_intervals(day)
+        if intervals:
+            start, end = intervals[0]
+            hours = f"{datetime.fromtimestamp(start, MOSCOW_TZ).strftime('%H:%M')}-{datetime.fromtimestamp(end, MOSCOW_TZ).strftime('%H:%M')}"
+        else:
+            hours = "выходной"
+        days_lines.append(f"   - {day.isoformat()} ({WEEKDAY_NAMES[day.weekday()]}): {hours}")
+    
+    overrides = config.get("overrides", {})
+    overrides_lines = [f"   - {day}: {'-'.join(hours) if hours else 'выходной'}" for day, hours in sorted(overrides.items())]
+    
+    calendar_text = f"""
+📅 **БИЗНЕС-КАЛЕНДАРЬ**
+
+🕐 **Рабочие дни:** {weekdays}
+⏰ **Часы:** {config['start']}-{config['end']} МСК
+🎉 **Праздники:** {', '.join(config.get('holidays', [])) or 'нет'}
+✏️ **Особые дни:**
+{chr(10).join(overrides_lines) or '   нет'}
+
+📆 **Ближайшие 7 дней:**
+{chr(10).join(days_lines)}
+
+Команды: `/add_holiday <ГГГГ-ММ-ДД>`, `/remove_holiday <ГГГГ-ММ-ДД>`,
+`/set_day_hours <ГГГГ-ММ-ДД> <ЧЧ:ММ> <ЧЧ:ММ>` или `off`, `/clear_day_hours <ГГГГ-ММ-ДД>`
+    """
+    
+    await update.message.reply_text(calendar_text, parse_mode='Markdown')
+
+async def add_holiday_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    day = parse_date_arg(context.args[0]) if context.args else None
+    if not day:
+        await update.message.reply_text("❌ Использование: /add_holiday <ГГГГ-ММ-ДД>")
+        return
+    
+    if business_calendar.set_holiday(day, True):
+        pending_messages_manager.update_funnel_statuses()
+        await update.message.reply_text(f"✅ {day.isoformat()} добавлен в праздники")
+    else:
+        await update.message.reply_text(f"ℹ️ {day.isoformat()} уже в праздниках")
+
+async def remove_holiday_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    day = parse_date_arg(context.args[0]) if context.args else None
+    if not day:
+        await update.message.reply_text("❌ Использование: /remove_holiday <ГГГГ-ММ-ДД>")
+        return
+    
+    if business_calendar.set_holiday(day, False):
+        pending_messages_manager.update_funnel_statuses()
+        await update.message.reply_text(f"✅ {day.isoformat()} удален из праздников")
+    else:
+        await update.message.reply_text(f"❌ {day.isoformat()} не найден в праздниках")
+
+async def set_day_hours_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    usage = "❌ Использование: /set_day_hours <ГГГГ-ММ-ДД> <ЧЧ:ММ> <ЧЧ:ММ> или /set_day_hours <ГГГГ-ММ-ДД> off"
+    day = parse_date_arg(context.args[0]) if context.args else None
+    if not day or len(context.args) not in (2, 3):
+        await update.message.reply_text(usage)
+        return
+    
+    if len(context.args) == 2:
+        if context.args[1].lower() != "off":
+            await update.message.reply_text(usage)
+            return
+        hours = None
+    else:
+        try:
+            start, end = parse_hhmm(context.args[1]), parse_hhmm(context.args[2])
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        if end <= start:
+            await update.message.reply_text("❌ Время окончания должно быть позже начала")
+            return
+        hours = [context.args[1], context.args[2]]
+    
+    business_calendar.set_day_override(day, hours)
+    pending_messages_manager.update_funnel_statuses()
+    await update.message.reply_text(f"✅ {day.isoformat()}: {'-'.join(hours) if hours else 'выходной'}")
+
+async def clear_day_hours_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    day = parse_date_arg(context.args[0]) if context.args else None
+    if not day:
+        await update.message.reply_text("❌ Использование: /clear_day_hours <ГГГГ-ММ-ДД>")
+        return
+    
+    if business_calendar.clear_day_override(day):
+        pending_messages_manager.update_funnel_statuses()
+        await update.message.reply_text(f"✅ Для {day.isoformat()} восстановлено обычное расписание")
+    else:
+        await update.message.reply_text(f"ℹ️ Для {day.isoformat()} нет особого расписания")
+
+# ========== КОМАНДЫ УПРАВЛЕНИЯ ИСКЛЮЧЕНИЯМИ ==========
+
+def format_exceptions_batch(result: Dict[str, List[str]], applied_title: str, skipped_title: str) -> str:
+    """Сводка пакетного изменения исключений"""
+    def listing(items: List[str]) -> str:
+        shown = ", ".join(f"`{item}`" for item in items[:30])
+        return shown + (f" и ещё {len(items) - 30}" if len(items) > 30 else "")
+    
+    lines = []
+    for title, key in ((applied_title, "applied"), (skipped_title, "skipped"), ("⚠️ Не распознаны", "invalid")):
+        if result[key]:
+            lines.append(f"{title} ({len(result[key])}): {listing(result[key])}")
+    return "\n".join(lines) or "ℹ️ Нечего изменять"
+
+async def add_exception_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /add_exception <ID или @username> [...]")
+        return
+    
+    result = excluded_users_manager.apply_batch(context.args)
+    await update.message.reply_text(format_exceptions_batch(result, "✅ Добавлены", "ℹ️ Уже в исключениях"))
+
+async def remove_exception_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ Использование: /remove_exception <ID или @username> [...]")
+        return
+    
+    result = excluded_users_manager.apply_batch(context.args, remove=True)
+    await update.message.reply_text(format_exceptions_batch(result, "✅ Удалены", "❌ Не найдены в исключениях"))
+
+async def import_exceptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Импорт исключений из CSV/текстового файла: ответ на сообщение с документом"""
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    replied = update.message.reply_to_message
+    document = replied.document if replied else None
+    remove = context.args == ['remove']
+    if document is None or (context.args and not remove):
+        await update.message.reply_text("❌ Использование: ответьте на файл .csv/.txt командой /import_exceptions [remove]")
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_SIZE:
+        await update.message.reply_text(f"❌ Файл больше {IMPORT_MAX_FILE_SIZE // 1024} КБ")
+        return
+    
+    try:
+        telegram_file = await document.get_file()
+        raw = bytes(await telegram_file.download_as_bytearray())
+    except Exception as e:
+        logger.error(f"Ошибка загрузки файла исключений: {e}")
+        await update.message.reply_text("❌ Не удалось скачать файл")
+        return
+    
+    try:
+        content = raw.decode('utf-8')
+    except UnicodeDecodeError:
+        content = raw.decode('cp1251', errors='replace')
+    
+    tokens = parse_identifiers_document(content)
+    if not tokens:
+        await update.message.reply_text("ℹ️ В файле нет идентификаторов")
+        return
+    
+    if remove:
+        result = excluded_users_manager.apply_batch(tokens, remove=True)
+        text = format_exceptions_batch(result, "✅ Удалены", "❌ Не найдены в исключениях")
+    else:
+        result = excluded_users_manager.apply_batch(tokens)
+        text = format_exceptions_batch(result, "✅ Добавлены", "ℹ️ Уже в исключениях")
+    await update.message.reply_text(f"📥 {document.file_name or 'файл'}: {len(tokens)} записей\n\n{text}")
+
+async def list_exceptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    excluded_users = excluded_users_manager.get_all_excluded()
+    
+    if not excluded_users["user_ids"] and not excluded_users["usernames"]:
+        await update.message.reply_text("📝 Список исключений пуст")
+        return
+    
+    text = "👥 **СПИСОК ИСКЛЮЧЕННЫХ ПОЛЬЗОВАТЕЛЕЙ**\n\n"
+    
+    if excluded_users["user_ids"]:
+        text += "🆔 **По ID:**\n"
+        for i, user_id in enumerate(excluded_users["user_ids"], 1):
+            text += f"{i}. `{user_id}`\n"
+        text += "\n"
+    
+    if excluded_users["usernames"]:
+        text += "👤 **По username:**\n"
+        for i, username in enumerate(excluded_users["usernames"], 1):
+            text += f"{i}. `@{username}`\n"
+    
+    text += f"\n📊 Всего: {len(excluded_users['user_ids'])} ID + {len(excluded_users['usernames'])} username"
+    
+    await update.message.reply_text(text, parse_mode='Markdown')
+
+async def clear_exceptions_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    if not is_admin(update.message.from_user.id):
+        await update.message.reply_text("❌ У вас нет прав для выполнения этой команды")
+        return
+    
+    excluded_users_manager.clear_all()
+    await update.message.reply_text("✅ Все исключения очищены")
+
+# ========== ОБРАБОТЧИКИ СООБЩЕНИЙ ==========
+
+def begin_catch_up():
+    """Начало догонки: обновления, накопленные за простой, применяются одной пачкой"""
+    update_dedup.begin_batch()
+    pending_messages_manager.begin_batch()
+    flags_manager.begin_batch()
+
+def end_catch_up():
+    """Конец догонки: одна запись файлов вместо записи на каждое обновление"""
+    if not update_dedup.batching:
+        return
+    pending_messages_manager.end_batch()
+    flags_manager.end_batch()
+    # Отметка обработанных обновлений пишется последней: при сбое до этого
+    # момента пачка будет доставлена заново, а не потеряна
+    update_dedup.end_batch()
+    logger.info("✅ Догонка завершена: применено обновлений - %s", update_dedup.catch_up_count)
+
+async def flush_update_dedup_job(context: ContextTypes.DEFAULT_TYPE):
+    """Периодическая запись отметки обработанных обновлений.
+    
+    Как и в end_catch_up, она пишется после непрочитанных: при сбое между
+    записями обновления будут доставлены заново, а не потеряны.
+    """
+    pending_messages_manager.flush()
+    update_dedup.flush()
+
+def is_live_update(update: Update) -> bool:
+    """Обновление отправлено после запуска бота (а не накоплено за простой)"""
+    message = update.effective_message
+    if message is None or message.date is None:
+        return True
+    sent_at = message.edit_date or message.date
+    return sent_at.timestamp() >= update_dedup.catch_up_started
+
+async def deduplicate_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Выполняется раньше всех обработчиков: отбрасывает уже обработанные обновления"""
+    if not isinstance(update, Update):
+        return
+    if update_dedup.is_duplicate(update.update_id):
+        update_dedup.duplicates_count += 1
+        message_logger.info("♻️ Обновление %s уже обработано, пропускаем", update.update_id)
+        raise ApplicationHandlerStop
+    if update_dedup.batching and is_live_update(update):
+        end_catch_up()
+    update_dedup.record(update.update_id)
+    if update_profiler.active:
+        update_profiler.count_update()
+
+async def finish_profiled_update(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Выполняется после обработчиков обновления: на N-м обновлении останавливает профилирование"""
+    if update_profiler.active and update_profiler.exhausted:
+        await finish_profiling()
+
+async def catch_up_timeout_job(context: ContextTypes.DEFAULT_TYPE):
+    end_catch_up()
+
+def enqueue_auto_reply(replied_key: str, chat_id: int, reply_to_message_id: int = None):
+    """Ставит автоответ в очередь исходящих.
+    
+    Ключ идемпотентности привязан к текущему нерабочему периоду (моменту
+    ближайшего начала рабочего времени), поэтому повторная обработка того же
+    сообщения или сбой между отправкой и установкой флага не дают дубля.
+    """
+    period = int(business_calendar.next_working_time())
+    kwargs = {'reply_to_message_id': reply_to_message_id} if reply_to_message_id else {}
+    outbox.send_message(f"auto_reply:{replied_key}:{period}", chat_id, get_runtime().auto_reply_message, purpose='auto_reply', **kwargs)
+
+async def handle_group_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    message_logger.info("📨 Получено групповое сообщение: %s - %.50s...", update.message.chat.title, update.message.text or '[медиа]')
+    
+    username = update.message.from_user.username
+    if is_manager(update.message.from_user.id, username):
+        await handle_manager_reply(update, context)
+        return
+    
+    if not should_respond_to_message(update, context):
+        message_logger.debug("❌ Сообщение не требует обработки")
+        return
+    
+    if update.message.chat.type in ['group', 'supergroup']:
+        chat_id = update.message.chat.id
+        replied_key = f'chat_{chat_id}'
+        arrival_stats.record(chat_id, update.message.date.timestamp(), update.message.chat.title)
+        
+        if not is_working_hours():
+            # Проверяем, не отправляли ли уже автоответ в этот чат
+            if not flags_manager.has_replied(replied_key):
+                enqueue_auto_reply(replied_key, chat_id, reply_to_message_id=update.message.message_id)
+                flags_manager.set_replied(replied_key)
+                logger.info("✅ Автоответ поставлен в очередь для чата %s", chat_id)
+            else:
+                message_logger.info("ℹ️ Автоответ уже был отправлен в чат %s, пропускаем", chat_id)
+        else:
+            # В рабочее время сбрасываем флаг автоответа для этого чата
+            if flags_manager.has_replied(replied_key):
+                flags_manager.clear_replied(replied_key)
+                logger.info("🔄 Флаг автоответа сброшен для чата %s (рабочее время)", chat_id)
+            
+            # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
+            if not is_manager(update.message.from_user.id, username):
+                chat_title = update.message.chat.title
+                username = update.message.from_user.username
+                first_name = update.message.from_user.first_name
+                message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
+                
+                _, merged = pending_messages_manager.add_message(
+                    chat_id=update.message.chat.id,
+                    user_id=update.message.from_user.id,
+                    message_text=message_text,
+                    message_id=update.message.message_id,
+                    chat_title=chat_title,
+                    username=username,
+                    first_name=first_name,
+                    media_group_id=update.message.media_group_id
+                )
+                # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
+                if not merged:
+                    message_logger.info("✅ Добавлено в непрочитанные: чат '%s', пользователь %s", chat_title, update.message.from_user.id)
+                    advance_notification_job(context.job_queue)
+
+async def handle_private_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update or not update.message:
+        return
+        
+    message_logger.info("📨 Получено личное сообщение от %s: %.50s...", update.message.from_user.id, update.message.text or '[медиа]')
+    
+    username = update.message.from_user.username
+    if is_manager(update.message.from_user.id, username):
+        await handle_manager_reply(update, context)
+        return
+    
+    if not should_respond_to_message(update, context):
+        message_logger.debug("❌ Сообщение не требует обработки")
+        return
+    
+    user_id = update.message.from_user.id
+    replied_key = f'user_{user_id}'
+    
+    if not is_working_hours():
+        # Проверяем, не отправляли ли уже автоответ этому пользователю
+        if not flags_manager.has_replied(replied_key):
+            enqueue_auto_reply(replied_key, update.message.chat.id)
+            flags_manager.set_replied(replied_key)
+            logger.info("✅ Автоответ поставлен в очередь для пользователя %s", user_id)
+        else:
+            message_logger.info("ℹ️ Автоответ уже был отправлен пользователю %s, пропускаем", user_id)
+    else:
+        # В рабочее время сбрасываем флаг автоответа для этого пользователя
+        if flags_manager.has_replied(replied_key):
+            flags_manager.clear_replied(replied_key)
+            logger.info("🔄 Флаг автоответа сброшен для пользователя %s (рабочее время)", user_id)
+        
+        # Добавляем сообщение в непрочитанные только если оно от клиента (не менеджера)
+        if not is_manager(update.message.from_user.id, username):
+            username = update.message.from_user.username
+            first_name = update.message.from_user.first_name
+            message_text = update.message.text or update.message.caption or "[Сообщение без текста]"
+            
+            _, merged = pending_messages_manager.add_message(
+                chat_id=update.message.chat.id,
+                user_id=update.message.from_user.id,
+                message_text=message_text,
+                message_id=update.message.message_id,
+                username=username,
+                first_name=first_name,
+                media_group_id=update.message.media_group_id
+            )
+            # НЕ отправляем уведомление автоматически при новом сообщении - только по расписанию
+            if not merged:
+                message_logger.info("✅ Добавлено в непрочитанные: пользователь %s", first_name or username or user_id)
+                advance_notification_job(context.job_queue)
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик ошибок - логирует в консоль, но не отправляет уведомления в Telegram"""
+    details = {}
+    if isinstance(update, Update):
+        details['update_id'] = update.update_id
+        if update.effective_chat:
+            details['chat_id'] = update.effective_chat.id
+        if update.effective_user:
+            details['user_id'] = update.effective_user.id
+    
+    # Без repr всего Update: только идентификаторы и трейсбек
+    logger.error(
+        "💥 Ошибка при обработке обновления %s: %s",
+        details or '-', context.error,
+        exc_info=(type(context.error), context.error, context.error.__traceback__) if context.error else None,
+        extra=details
+    )
+    
+    # УБРАНА ОТПРАВКА УВЕДОМЛЕНИЙ АДМИНИСТРАТОРАМ
+    # Ошибки будут только в консоли/логах, но не в Telegram
+
+# ========== ЗАПУСК БОТА ==========
+
+async def on_startup(application: Application):
+    begin_catch_up()
+    if application.job_queue:
+        application.job_queue.run_once(catch_up_timeout_job, CATCH_UP_MAX_SECONDS)
+    await outbox.start(application.bot)
+    # Контроль цикла общий на процесс: при нескольких ботах им управляет run_bots
+    if shutdown_event is None:
+        await loop_watchdog.start([get_runtime()])
+    await json_api.start(get_runtime())
+
+async def on_shutdown(application: Application):
+    end_catch_up()
+    pending_messages_manager.flush()
+    update_dedup.flush()
+    arrival_stats.flush()
+    update_profiler.stop()
+    await json_api.stop(get_runtime())
+    await outbox.stop()
+    if shutdown_event is None:
+        await loop_watchdog.stop()
+    if LEADER_ELECTION:
+        leader_lease.release()
+
+def build_application(runtime: BotRuntime) -> Application:
+    """Создаёт Application бота со всеми обработчиками (вызывается в контексте бота)"""
+    builder = Application.builder().token(runtime.token).post_init(on_startup).post_shutdown(on_shutdown)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL).base_file_url(TELEGRAM_FILE_URL or '/file/bot'.join(TELEGRAM_API_URL.rsplit('/bot', 1)))
+    application = builder.build()
+    
+    # Команды для управления воронками
+    application.add_handler(CommandHandler("funnels", funnels_command))
+    application.add_handler(CommandHandler("set_funnel", set_funnel_command))
+    application.add_handler(CommandHandler("add_funnel", add_funnel_command))
+    application.add_handler(CommandHandler("remove_funnel", remove_funnel_command))
+    application.add_handler(CommandHandler("reset_funnels", reset_funnels_command))
+    application.add_handler(CommandHandler("force_update_funnels", force_update_funnels_command))
+    application.add_handler(CommandHandler("debug_funnels", debug_funnels_command))
+    application.add_handler(CommandHandler("fix_funnels", fix_funnel_statuses_command))
+    
+    # Команды бизнес-календаря
+    application.add_handler(CommandHandler("calendar", calendar_command))
+    application.add_handler(CommandHandler("add_holiday", add_holiday_command))
+    application.add_handler(CommandHandler("remove_holiday", remove_holiday_command))
+    application.add_handler(CommandHandler("set_day_hours", set_day_hours_command))
+    application.add_handler(CommandHandler("clear_day_hours", clear_day_hours_command))
+    
+    # Команды для обновления уведомления
+    application.add_handler(CommandHandler("update_notification", update_notification_command))
+    
+    # Команды для управления исключениями
+    application.add_handler(CommandHandler("add_exception", add_exception_command))
+    application.add_handler(CommandHandler("remove_exception", remove_exception_command))
+    application.add_handler(CommandHandler("import_exceptions", import_exceptions_command))
+    application.add_handler(CommandHandler("list_exceptions", list_exceptions_command))
+    application.add_handler(CommandHandler("clear_exceptions", clear_exceptions_command))
+    
+    # Команды для ручного управления сообщениями
+    application.add_handler(CommandHandler("clear_chat", clear_chat_command))
+    application.add_handler(CommandHandler("clear_all", clear_all_command))
+    application.add_handler(CommandHandler("pending", pending_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CallbackQueryHandler(pending_page_callback, pattern=r"^pg\|"))
+    
+    # Основные команды
+    application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("set_work_chat", set_work_chat_command))
+    application.add_handler(CommandHandler("route", route_command))
+    application.add_handler(CommandHandler("unroute", unroute_command))
+    application.add_handler(CommandHandler("tag_chat", tag_chat_command))
+    application.add_handler(CommandHandler("tag_title", tag_title_command))
+    application.add_handler(CommandHandler("untag_title", untag_title_command))
+    application.add_handler(CommandHandler("routes", routes_command))
+    application.add_handler(CommandHandler("managers", managers_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("outbox", outbox_command))
+    application.add_handler(CommandHandler("stalls", stalls_command))
+    application.add_handler(CommandHandler("memstats", memstats_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("load", load_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    
+    # Отсев повторно доставленных обновлений (раньше всех остальных обработчиков)
+    application.add_handler(TypeHandler(Update, deduplicate_update), group=-1)
+    # Остановка /profile после обработчиков N-го обновления (позже всех остальных)
+    application.add_handler(TypeHandler(Update, finish_profiled_update), group=1)
+    
+    # Обработчики сообщений
+    application.add_handler(MessageHandler(
+        filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL, 
+        handle_group_message,
+        block=False
+    ))
+    application.add_handler(MessageHandler(
+        filters.TEXT | filters.CAPTION | filters.PHOTO | filters.Document.ALL,
+        handle_private_message, 
+        block=False
+    ))
+    
+    # Обработчик ошибок
+    application.add_error_handler(error_handler)
+    
+    # Проверка и отправка нового уведомления в рабочее время (следующий запуск сохраняется в файл)
+    job_queue = application.job_queue
+    if job_queue:
+        first_run = compute_startup_run(datetime.now(MOSCOW_TZ))
+        schedule_notification_job(job_queue, first_run)
+        if LEADER_ELECTION:
+            job_queue.run_repeating(renew_leader_lease_job, interval=LEADER_LEASE_SECONDS / 3, first=LEADER_LEASE_SECONDS / 3)
+        job_queue.run_repeating(config_watch_job, interval=CONFIG_WATCH_INTERVAL, first=CONFIG_WATCH_INTERVAL)
+        job_queue.run_repeating(flush_update_dedup_job, interval=UPDATE_DEDUP_FLUSH_SECONDS, first=UPDATE_DEDUP_FLUSH_SECONDS)
+        print(f"✅ Планировщик задач запущен (проверка каждые {CADENCE_MIN_SECONDS // 60}-{CADENCE_MAX_SECONDS // 60} минут в рабочее время по состоянию очереди)")
+        print(f"⏭ Первая проверка: {first_run.strftime('%d.%m %H:%M:%S')}")
+        print("🛡️  COOLDOWN АКТИВИРОВАН - защита от частых отправок")
+        print("🔧 ЛОГИКА ВОРОНОК: Без дублирования (1 чат = 1 воронка)")
+        print("✅ СООБЩЕНИЯ ПОКАЗЫВАЮТСЯ ПОКА НЕ ОТВЕТЯТ")
+    else:
+        print("❌ Планировщик задач недоступен")
+    return application
+
+def print_startup_summary():
+    FUNNELS = funnels_config.get_funnels()
+    excluded_users = excluded_users_manager.get_all_excluded()
+    total_excluded = len(excluded_users["user_ids"]) + len(excluded_users["usernames"])
+    
+    print(f"🚀 Бот {get_runtime().name} запускается...")
+    print(f"📊 Загружено флагов: {flags_manager.count_flags()}")
+    print(f"📋 Непрочитанных сообщений: {len(pending_messages_manager.get_all_pending_messages())}")
+    print(f"👥 Менеджеров в системе: {total_excluded}")
+    print(f"⚙️ Воронки уведомлений: {FUNNELS}")
+    
+    if work_chat_manager.is_work_chat_set():
+        print(f"💬 Рабочий чат установлен: {work_chat_manager.get_work_chat_id()}")
+    else:
+        print("⚠️ Рабочий чат не установлен! Используйте /set_work_chat")
+    
+    print(f"🔄 Логика уведомлений: УДАЛЕНИЕ СТАРОГО + ОТПРАВКА НОВОГО каждые {CADENCE_MIN_SECONDS // 60}-{CADENCE_MAX_SECONDS // 60} минут в рабочее время")
+    print(f"⏳ COOLDOWN: {CADENCE_MIN_SECONDS // 60} минут между отправками (сохраняется между перезапусками)")
+    print("🔧 ЛОГИКА ВОРОНОК: без дублирования (1 чат = 1 воронка)")
+    print("✅ СООБЩЕНИЯ: показываются пока не ответят")
+    print("⏰ Ожидание сообщений...")
+    print("=" * 50)
+
+shutdown_event: Optional[asyncio.Event] = None
+
+def request_stop(application: Application):
+    """Останавливает процесс: все боты при совместном запуске, иначе единственный"""
+    if shutdown_event is not None:
+        shutdown_event.set()
+    else:
+        application.stop_running()
+
+async def run_bot(runtime: BotRuntime):
+    """Жизненный цикл одного бота при совместном запуске (аналог run_polling)"""
+    application = build_application(runtime)
+    print_startup_summary()
+    await application.initialize()
+    try:
+        await on_startup(application)
+        await application.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=False)
+        await application.start()
+        await shutdown_event.wait()
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+async def run_bots(runtimes: List[BotRuntime]):
+    """Все боты в одном цикле событий; каждый работает в контексте своего BotRuntime"""
+    global shutdown_event
+    shutdown_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, shutdown_event.set)
+        except NotImplementedError:
+            pass
+    await loop_watchdog.start(runtimes)
+    try:
+        tasks = [asyncio.create_task(run_bot(runtime), context=runtime.context) for runtime in runtimes]
+        await asyncio.gather(*tasks)
+    finally:
+        await loop_watchdog.stop()
+
+def main():
+    try:
+        print("=" * 50)
+        print("🤖 ЗАПУСК БОТА-АВТООТВЕТЧИКА")
+        print("=" * 50)
+        
+        bot_configs = load_bot_configs()
+        runtimes = [BotRuntime(**config) for config in bot_configs] if bot_configs else [get_runtime()]
+        
+        if LEADER_ELECTION:
+            # Telegram отдаёт обновления только одному getUpdates на токен,
+            # поэтому резервные процессы ждут здесь, не опрашивая бота
+            print(f"🗳 Процесс {INSTANCE_ID} ожидает аренду лидерства ({LEADER_LEASE_FILE})...")
+            leader_lease.wait_for_leadership()
+            for runtime in runtimes:
+                runtime.reload_state()
+            outbox.reload()
+            print(f"👑 Процесс {INSTANCE_ID} стал лидером (срок {leader_lease.term})")
+        
+        if bot_configs:
+            print(f"🤖 Ботов в процессе: {len(runtimes)} ({', '.join(runtime.name for runtime in runtimes)})")
+            asyncio.run(run_bots(runtimes))
+            return
+        
+        application = build_application(runtimes[0])
+        print_startup_summary()
+        application.run_polling(
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=False,
+            close_loop=False
+        )
+        
+    except Exception as e:
+        print(f"💥 КРИТИЧЕСКАЯ ОШИБКА: {e}")
+        logger.error(f"💥 Критическая ошибка при запуске бота: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""Локальная замена Telegram Bot API для интеграционных и нагрузочных тестов.
+
+Реализует то, чем пользуется бот: getMe, getUpdates (long polling), sendMessage,
+editMessageText, deleteMessage, deleteWebhook, sendDocument, answerCallbackQuery,
+getFile и скачивание файлов. Умеет:
+- подкладывать обновления (скриптом, через управляющий API или генератором нагрузки),
+  в том числе документы и нажатия inline-кнопок;
+- задерживать ответы;
+- отвечать ошибками и 429 с заданной вероятностью;
+- записывать каждый исходящий вызов бота.
+
+Запуск:
+    python fake_telegram.py --port 8081 --latency 0.05 --retry-after-rate 0.02 --record calls.jsonl
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot BOT_TOKEN=123:fake python bot.py
+
+Управляющий API (JSON):
+    POST /control/updates  - обновление, список обновлений или краткая запись
+                             {"chat_id": -100, "text": "...", "user_id": 5, "username": "...", "title": "...", "reply_to": 12}
+                             документ: {"chat_id": 5, "document": {"file_name": "ids.csv", "content": "id\\n42"}}
+                             кнопка: {"chat_id": 5, "user_id": 5, "message_id": 3, "callback_data": "pg|n|..."}
+    POST /control/load     - {"rate": 20, "seconds": 60, "chats": 50} - поток сообщений клиентов
+    POST /control/config   - {"latency": 0.1, "jitter": 0, "error_rate": 0, "retry_after_rate": 0, "retry_after": 3}
+    GET  /control/calls    - записанные вызовы (?method=sendMessage&since=N)
+    GET  /control/stats    - счётчики по методам и очередь обновлений
+"""
+
+import argparse
+import asyncio
+import collections
+import email.parser
+import itertools
+import json
+import random
+import sys
+import time
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlsplit, parse_qs
+
+BOT_USER = {
+    "id": 1000001,
+    "is_bot": True,
+    "first_name": "FakeBot",
+    "username": "fake_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": True,
+    "supports_inline_queries": False,
+}
+
+# Методы, которые не портятся инъекцией ошибок: без них бот не стартует и не получает обновления
+NEVER_FAIL = {"getMe", "getUpdates", "deleteWebhook"}
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 retry_after_rate: float = 0.0, retry_after: int = 3, error_status: int = 500, record_path: str = None):
+        self.config = {
+            "latency": latency,
+            "jitter": jitter,
+            "error_rate": error_rate,
+            "retry_after_rate": retry_after_rate,
+            "retry_after": retry_after,
+            "error_status": error_status,
+        }
+        self.updates: collections.deque = collections.deque()
+        self.update_ids = itertools.count(1)
+        self.message_ids: Dict[int, itertools.count] = {}
+        self.messages: Dict[tuple, Dict[str, Any]] = {}
+        self.files: Dict[str, bytes] = {}
+        self.callback_ids = itertools.count(1)
+        self.new_updates = asyncio.Condition()
+        self.calls: List[Dict[str, Any]] = []
+        self.stats: collections.Counter = collections.Counter()
+        self.record_file = open(record_path, 'a', encoding='utf-8') if record_path else None
+
+    # ---------- обновления ----------
+
+    def next_message_id(self, chat_id: int) -> int:
+        return next(self.message_ids.setdefault(chat_id, itertools.count(1)))
+
+    def make_message(self, chat_id: int, text: str, user: Dict[str, Any], title: str = None, reply_to: int = None) -> Dict[str, Any]:
+        chat = {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+        if chat_id < 0:
+            chat["title"] = title or f"Клиент {chat_id}"
+        else:
+            chat["first_name"] = user.get("first_name", "")
+        message = {"message_id": self.next_message_id(chat_id), "date": int(time.time()), "chat": chat, "from": user, "text": text}
+        if text.startswith("/"):
+            # CommandHandler узнаёт команду по сущности bot_command
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if reply_to is not None:
+            replied = self.messages.get((chat_id, reply_to)) or {"message_id": reply_to, "date": int(time.time()), "chat": chat}
+            message["reply_to_message"] = replied
+        self.messages[(chat_id, message["message_id"])] = message
+        return message
+
+    async def inject(self, item: Dict[str, Any]):
+        """Полное обновление (update_id проставится сам) или краткая запись сообщения клиента"""
+        if "chat_id" in item:
+            user_id = item.get("user_id", 5000 + abs(item["chat_id"]) % 1000)
+            user = {"id": user_id, "is_bot": False, "first_name": item.get("first_name", f"Client{user_id}")}
+            if item.get("username"):
+                user["username"] = item["username"]
+            if "callback_data" in item:
+                message = self.messages.get((item["chat_id"], item["message_id"]))
+                if message is None:
+                    raise LookupError(f"message {item['message_id']} not found in chat {item['chat_id']}")
+                update = {"callback_query": {"id": str(next(self.callback_ids)), "from": user, "message": message,
+                                             "chat_instance": str(item["chat_id"]), "data": item["callback_data"]}}
+            else:
+                message = self.make_message(item["chat_id"], item.get("text", ""), user, item.get("title"), item.get("reply_to"))
+                if "document" in item:
+                    del message["text"]
+                    message["document"] = self.store_file(message["message_id"], item["document"].get("file_name", "document"),
+                                                          item["document"].get("content", "").encode("utf-8"))
+                update = {"message": message}
+        else:
+            update = dict(item)
+        update["update_id"] = next(self.update_ids)
+        async with self.new_updates:
+            self.updates.append(update)
+            self.new_updates.notify_all()
+        self.stats["injected_updates"] += 1
+
+    async def generate_load(self, rate: float, seconds: float, chats: int):
+        """Поток сообщений клиентов: rate сообщений в секунду по chats чатам"""
+        deadline = time.monotonic() + seconds
+        sequence = 0
+        while time.monotonic() < deadline:
+            chat_number = random.randrange(chats)
+            sequence += 1
+            await self.inject({"chat_id": -1000000000 - chat_number, "title": f"Нагрузка {chat_number}",
+                               "user_id": 700000 + chat_number, "text": f"Сообщение {sequence} контейнер LOAD{chat_number:04d}"})
+            await asyncio.sleep(random.expovariate(rate))
+
+    async def run_script(self, path: str):
+        """JSONL: {"delay": секунды, ...обновление или краткая запись}"""
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                await asyncio.sleep(item.pop("delay", 0))
+                await self.inject(item)
+
+    def store_file(self, number: int, file_name: str, content: bytes) -> Dict[str, Any]:
+        """Документ для сообщения; содержимое отдаётся через getFile и /file/bot<токен>/<путь>"""
+        file_id = f"doc{number}_{len(self.files)}"
+        self.files[file_id] = content
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_name": file_name, "file_size": len(content)}
+
+    # ---------- методы Bot API ----------
+
+    async def get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        async with self.new_updates:
+            while self.updates and self.updates[0]["update_id"] < offset:
+                self.updates.popleft()
+            if not self.updates and timeout > 0:
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return list(itertools.islice(self.updates, limit))
+
+    def send_message(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params["chat_id"])
+        message = self.make_message(chat_id, params.get("text", ""), BOT_USER, reply_to=None)
+        if params.get("reply_to_message_id"):
+            message["reply_to_message"] = {"message_id": int(params["reply_to_message_id"]), "date": message["date"], "chat": message["chat"]}
+        return message
+
+    def edit_message_text(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        key = (int(params["chat_id"]), int(params["message_id"]))
+        if key not in self.messages:
+            raise LookupError("Bad Request: message to edit not found")
+        message = dict(self.messages[key], text=params.get("text", ""), edit_date=int(time.time()))
+        self.messages[key] = message
+        return message
+
+    def delete_message(self, params: Dict[str, Any]) -> bool:
+        if self.messages.pop((int(params["chat_id"]), int(params["message_id"])), None) is None:
+            raise LookupError("Bad Request: message to delete not found")
+        return True
+
+    def send_document(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        message = self.make_message(int(params["chat_id"]), "", BOT_USER)
+        del message["text"]
+        message["document"] = {"file_id": f"doc{message['message_id']}", "file_unique_id": f"u{message['message_id']}",
+                               "file_name": params.get("document_name", "document")}
+        if params.get("caption"):
+            message["caption"] = params["caption"]
+        return message
+
+    def get_file(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        file_id = params["file_id"]
+        if file_id not in self.files:
+            raise LookupError("Bad Request: invalid file_id")
+        return {"file_id": file_id, "file_unique_id": f"u{file_id}", "file_size": len(self.files[file_id]), "file_path": f"documents/{file_id}"}
+
+    async def call(self, method: str, params: Dict[str, Any]) -> tuple:
+        """(HTTP-статус, ответ Bot API) с задержкой и инъекцией ошибок"""
+        config = self.config
+        delay = config["latency"] + random.uniform(0, config["jitter"])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self.stats[method] += 1
+        if method not in NEVER_FAIL:
+            if random.random() < config["retry_after_rate"]:
+                self.stats["injected_429"] += 1
+                return 429, {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {config['retry_after']}",
+                             "parameters": {"retry_after": config["retry_after"]}}
+            if random.random() < config["error_rate"]:
+                self.stats["injected_errors"] += 1
+                return config["error_status"], {"ok": False, "error_code": config["error_status"], "description": "Injected error"}
+
+        try:
+            if method == "getMe":
+                result = BOT_USER
+            elif method == "getUpdates":
+                result = await self.get_updates(params)
+            elif method == "deleteWebhook":
+                result = True
+            elif method == "sendMessage":
+                result = self.send_message(params)
+            elif method == "editMessageText":
+                result = self.edit_message_text(params)
+            elif method == "deleteMessage":
+                result = self.delete_message(params)
+            elif method == "sendDocument":
+                result = self.send_document(params)
+            elif method == "answerCallbackQuery":
+                result = True
+            elif method == "getFile":
+                result = self.get_file(params)
+            else:
+                return 404, {"ok": False, "error_code": 404, "description": f"Not Found: {method} is not implemented by the fake server"}
+        except LookupError as e:
+            return 400, {"ok": False, "error_code": 400, "description": str(e).strip("'\"")}
+        except (KeyError, ValueError) as e:
+            return 400, {"ok": False, "error_code": 400, "description": f"Bad Request: {e}"}
+        return 200, {"ok": True, "result": result}
+
+    def record(self, method: str, params: Dict[str, Any], status: int, started: float):
+        if method == "getUpdates":
+            return
+        entry = {"seq": len(self.calls), "t": started, "duration": time.time() - started, "method": method, "params": params, "status": status}
+        self.calls.append(entry)
+        if self.record_file:
+            self.record_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.record_file.flush()
+
+    # ---------- HTTP ----------
+
+    @staticmethod
+    def parse_body(headers: Dict[str, str], body: bytes) -> Dict[str, Any]:
+        content_type = headers.get("content-type", "")
+        if not body:
+            return {}
+        if content_type.startswith("application/json"):
+            return json.loads(body)
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+            params = {}
+            for part in message.walk():
+                name = part.get_param("name", header="content-disposition")
+                if not name:
+                    continue
+                filename = part.get_filename()
+                payload = part.get_payload(decode=True) or b""
+                if filename:
+                    params[f"{name}_name"] = filename
+                    params[f"{name}_size"] = len(payload)
+                else:
+                    params[name] = payload.decode("utf-8", errors="replace")
+            return params
+        return {name: values[-1] for name, values in parse_qs(body.decode("utf-8"), keep_blank_values=True).items()}
+
+    async def handle_control(self, method: str, path: str, query: Dict[str, str], params: Any) -> tuple:
+        if path == "/control/updates" and method == "POST":
+            try:
+                for item in params if isinstance(params, list) else [params]:
+                    await self.inject(item)
+            except LookupError as e:
+                return 400, {"ok": False, "description": str(e).strip("'\"")}
+            return 200, {"ok": True, "queued": len(self.updates)}
+        if path == "/control/load" and method == "POST":
+            asyncio.get_running_loop().create_task(self.generate_load(float(params.get("rate", 10)), float(params.get("seconds", 60)), int(params.get("chats", 20))))
+            return 200, {"ok": True}
+        if path == "/control/config" and method == "POST":
+            unknown = set(params) - set(self.config)
+            if unknown:
+                return 400, {"ok": False, "description": f"unknown settings: {sorted(unknown)}"}
+            self.config.update(params)
+            return 200, {"ok": True, "config": self.config}
+        if path == "/control/calls":
+            since = int(query.get("since", 0))
+            calls = [call for call in self.calls[since:] if "method" not in query or call["method"] == query["method"]]
+            return 200, {"ok": True, "calls": calls, "next": len(self.calls)}
+        if path == "/control/stats":
+            return 200, {"ok": True, "stats": dict(self.stats), "queued_updates": len(self.updates), "config": self.config}
+        return 404, {"ok": False, "description": "unknown control path"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                request_line, *header_lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    if name:
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0) or 0))
+                url = urlsplit(target)
+                query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                params = self.parse_body(headers, body)
+
+                started = time.time()
+                content_type = "application/json"
+                if url.path.startswith("/file/bot") and url.path.count("/") >= 3:
+                    # Скачивание файла после getFile: /file/bot<токен>/documents/<file_id>
+                    file_id = url.path.rsplit("/", 1)[1]
+                    if file_id in self.files:
+                        status, payload, content_type = 200, self.files[file_id], "application/octet-stream"
+                    else:
+                        status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+                elif url.path.startswith("/control/"):
+                    status, payload = await self.handle_control(method, url.path, query, params)
+                elif url.path.startswith("/bot") and url.path.count("/") == 2:
+                    api_method = url.path.rsplit("/", 1)[1]
+                    params = {**query, **params}
+                    status, payload = await self.call(api_method, params)
+                    self.record(api_method, params, status, started)
+                else:
+                    status, payload = 404, {"ok": False, "error_code": 404, "description": "Not Found"}
+
+                data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                writer.write((f"HTTP/1.1 {status} {REASONS.get(status, 'Error')}\r\n"
+                              f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, ValueError) as e:
+            print(f"⚠️ Соединение закрыто: {e}", file=sys.stderr)
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    fake = FakeTelegram(args.latency, args.jitter, args.error_rate, args.retry_after_rate, args.retry_after, args.error_status, args.record)
+    server = await asyncio.start_server(fake.handle_connection, args.host, args.port)
+    print(f"🧪 Фальшивый Bot API: http://{args.host}:{args.port}/bot (TELEGRAM_API_URL)")
+    if args.script:
+        asyncio.get_running_loop().create_task(fake.run_script(args.script))
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа, секунд")
+    parser.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, секунд")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов с ошибкой")
+    parser.add_argument("--error-status", type=int, default=500, help="HTTP-статус инъецированной ошибки")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=int, default=3, help="retry_after в ответах 429, секунд")
+    parser.add_argument("--script", help="JSONL с обновлениями и задержками")
+    parser.add_argument("--record", help="дописывать вызовы бота в JSONL")
+    args = parser.parse_args(argv)
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
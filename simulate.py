@@ -0,0 +1,189 @@
+"""Офлайн-симулятор «что если» для порогов воронок и рабочего времени.
+
+Берёт ожидающие сообщения и архив бота (или записанный поток в том же
+формате JSONL), прогоняет их через классификатор воронок с другими порогами
+и часами работы и показывает:
+- сколько чатов дошло бы до каждой воронки;
+- сколько проверок отправило бы уведомление и сколько из них что-то изменили.
+
+Пример:
+    python simulate.py --data-dir . --days 30 --funnels 60,180,300 --funnels 45,120,240 --hours 09:00-18:00
+
+Каждый вариант --funnels, --hours и --weekdays комбинируется с остальными;
+не указанные параметры берутся из текущих файлов бота.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time as time_module
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+import bot
+from bot import BusinessCalendar, FunnelsConfig, MOSCOW_TZ, NOTIFICATION_INTERVAL
+
+
+def load_records(paths: List[str], since: float, until: float) -> List[tuple]:
+    """(chat_id, открыто, закрыто) для сообщений, живших в окне [since, until)"""
+    records = []
+    for path in paths:
+        if not os.path.exists(path):
+            print(f"⚠️ Файл не найден: {path}")
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            if path.endswith('.jsonl'):
+                messages = (json.loads(line) for line in f if line.strip())
+            else:
+                messages = json.load(f).values()
+            for message in messages:
+                opened = datetime.fromisoformat(message['timestamp']).timestamp()
+                closed = datetime.fromisoformat(message['closed_at']).timestamp() if message.get('closed_at') else until
+                if opened < until and closed > since:
+                    records.append((message['chat_id'], opened, min(closed, until)))
+    records.sort(key=lambda record: record[1])
+    return records
+
+
+def parse_hours(value: str) -> tuple:
+    start, end = value.split('-')
+    bot.parse_hhmm(start), bot.parse_hhmm(end)
+    return start, end
+
+
+def parse_weekdays(value: str) -> List[int]:
+    """'0-4' или '0,1,2,3,4,5' (0 - понедельник)"""
+    if '-' in value:
+        first, last = value.split('-')
+        return list(range(int(first), int(last) + 1))
+    return [int(day) for day in value.split(',')]
+
+
+def build_calendar(base: Dict[str, Any], hours: Optional[tuple], weekdays: Optional[List[int]], since: float, until: float) -> BusinessCalendar:
+    calendar = BusinessCalendar()
+    calendar.config = dict(base)
+    if hours:
+        calendar.config["start"], calendar.config["end"] = hours
+    if weekdays is not None:
+        calendar.config["weekdays"] = weekdays
+    first_day = datetime.fromtimestamp(since, MOSCOW_TZ).date() - timedelta(days=1)
+    last_day = datetime.fromtimestamp(until, MOSCOW_TZ).date() + timedelta(days=BusinessCalendar.HORIZON_FORWARD_DAYS)
+    calendar.compile(first_day, last_day)
+    return calendar
+
+
+def build_funnels(thresholds: Optional[List[int]]) -> FunnelsConfig:
+    funnels = FunnelsConfig()
+    if thresholds:
+        stages = []
+        for i, minutes in enumerate(sorted(thresholds)):
+            stage = dict(bot.DEFAULT_FUNNEL_STAGES[i]) if i < len(bot.DEFAULT_FUNNEL_STAGES) else {"emoji": "⚪", "label": ""}
+            stage["interval"] = minutes
+            stages.append(stage)
+        funnels.stages = stages
+        funnels.rebuild_thresholds()
+    return funnels
+
+
+def check_times(calendar: BusinessCalendar, since: float, until: float, interval: float) -> List[float]:
+    """Моменты проверок: через интервал, только в рабочее время (как compute_next_run без сдвига)"""
+    ticks = []
+    moment = calendar.next_working_time(since)
+    while moment < until:
+        ticks.append(moment)
+        moment = calendar.next_working_time(moment + interval)
+    return ticks
+
+
+def simulate(records: List[tuple], funnels: FunnelsConfig, calendar: BusinessCalendar, ticks: List[float]) -> Dict[str, Any]:
+    """Прогон одного сценария; возраст всех сообщений считается колонками"""
+    stage_count = funnels.stage_count()
+    chat_ids = [record[0] for record in records]
+    opened = calendar.business_seconds_batch([record[1] for record in records])
+    closed = calendar.business_seconds_batch([record[2] for record in records])
+
+    # Максимальная воронка сообщения - в момент закрытия
+    final_stages = funnels.classify_batch([(end - start) / 60 for start, end in zip(opened, closed)])
+    chat_max: Dict[int, int] = {}
+    for chat_id, stage in zip(chat_ids, final_stages):
+        if stage > chat_max.get(chat_id, 0):
+            chat_max[chat_id] = int(stage)
+    reached = [sum(1 for stage in chat_max.values() if stage >= funnel) for funnel in range(1, stage_count + 1)]
+
+    # Уведомления: на каждой проверке - воронка каждого чата (по самому старому сообщению)
+    tick_seconds = calendar.business_seconds_batch(ticks)
+    active: List[int] = []
+    next_record = 0
+    previous: Dict[int, int] = {}
+    sent = changed = 0
+    for tick, now_seconds in zip(ticks, tick_seconds):
+        while next_record < len(records) and records[next_record][1] <= tick:
+            active.append(next_record)
+            next_record += 1
+        active = [i for i in active if records[i][2] > tick]
+        stages = funnels.classify_batch([(now_seconds - opened[i]) / 60 for i in active])
+        shown: Dict[int, int] = {}
+        for i, stage in zip(active, stages):
+            if stage and stage > shown.get(chat_ids[i], 0):
+                shown[chat_ids[i]] = int(stage)
+        sent += 1
+        if shown != previous:
+            changed += 1
+        previous = shown
+
+    return {"chats": len(chat_max), "reached": reached, "sent": sent, "changed": changed}
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Офлайн-симуляция порогов воронок и рабочего времени")
+    parser.add_argument("--data-dir", default=".", help="каталог с файлами бота")
+    parser.add_argument("--records", action="append", help="JSON/JSONL с сообщениями (по умолчанию - ожидающие и архив бота)")
+    parser.add_argument("--days", type=float, default=30, help="сколько последних дней симулировать")
+    parser.add_argument("--until", help="конец окна, ISO-дата (по умолчанию - сейчас)")
+    parser.add_argument("--funnels", action="append", help="пороги воронок в минутах, например 60,180,300")
+    parser.add_argument("--hours", action="append", help="рабочие часы, например 09:00-18:00")
+    parser.add_argument("--weekdays", action="append", help="рабочие дни: 0-4 или 0,1,2,3,4,5")
+    parser.add_argument("--interval", type=float, default=NOTIFICATION_INTERVAL / 60, help="интервал проверок, минут")
+    args = parser.parse_args(argv)
+
+    # Файлы настроек бот читает из текущего каталога
+    os.chdir(args.data_dir)
+    until = MOSCOW_TZ.localize(datetime.fromisoformat(args.until)).timestamp() if args.until else time_module.time()
+    since = until - args.days * 86400
+    paths = args.records or [bot.PENDING_MESSAGES_FILE, bot.MESSAGE_HISTORY_FILE]
+
+    started = time_module.perf_counter()
+    records = load_records(paths, since, until)
+    print(f"📥 Сообщений в окне: {len(records)} ({time_module.perf_counter() - started:.2f} с)")
+    if not records:
+        return 1
+
+    base_calendar = BusinessCalendar().config
+    funnel_variants = [[int(minutes) for minutes in value.split(',')] for value in args.funnels] if args.funnels else [None]
+    hour_variants = [parse_hours(value) for value in args.hours] if args.hours else [None]
+    weekday_variants = [parse_weekdays(value) for value in args.weekdays] if args.weekdays else [None]
+
+    for thresholds, hours, weekdays in itertools.product(funnel_variants, hour_variants, weekday_variants):
+        started = time_module.perf_counter()
+        funnels = build_funnels(thresholds)
+        calendar = build_calendar(base_calendar, hours, weekdays, since, until)
+        ticks = check_times(calendar, since, until, args.interval * 60)
+        result = simulate(records, funnels, calendar, ticks)
+
+        hours_text = f"{calendar.config['start']}-{calendar.config['end']}"
+        days_text = ",".join(str(day) for day in calendar.config['weekdays'])
+        print(f"\n⚙️ Пороги {funnels.thresholds} мин, часы {hours_text}, дни {days_text}")
+        print(f"   Чатов: {result['chats']}")
+        for funnel, count in enumerate(result['reached'], 1):
+            share = count / result['chats'] * 100 if result['chats'] else 0
+            print(f"   {funnels.get_emoji(funnel)} дошли до воронки {funnel}: {count} ({share:.1f}%)")
+        unchanged = result['sent'] - result['changed']
+        print(f"   📤 Проверок с отправкой: {result['sent']}, изменили уведомление: {result['changed']}, без изменений: {unchanged}")
+        print(f"   ⏱ {time_module.perf_counter() - started:.2f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
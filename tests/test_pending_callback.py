@@ -0,0 +1,33 @@
+from bot import decode_pending_callback, encode_pending_callback, parse_pending_filters
+
+
+def test_round_trip():
+    pending_filters = parse_pending_filters(['funnel=2', 'age=90', 'user=@Some_User', 'title=Чат | клиента', 'sort=funnel'])
+    data = encode_pending_callback(pending_filters, 3, 17, False)
+    assert len(data.encode()) <= 64
+    assert decode_pending_callback(data) == (pending_filters, 3, 17, False)
+
+
+def test_user_is_canonical():
+    assert parse_pending_filters(['user=' + '0' * 80 + '42'])['user'] == 42
+    assert parse_pending_filters(['user=' + '@' * 80 + 'Name_1'])['user'] == 'name_1'
+    data = encode_pending_callback(parse_pending_filters(['user=000042']), 2, 5, True)
+    assert decode_pending_callback(data)[0]['user'] == 42
+
+
+def test_invalid_user_rejected():
+    for value in ('a|b', 'x', '9' * 40, '@'):
+        assert parse_pending_filters(['user=' + value]) is None
+
+
+def test_long_title_is_truncated():
+    pending_filters = parse_pending_filters(['title=' + 'ж' * 100])
+    data = encode_pending_callback(pending_filters, 1, 0, True)
+    assert len(data.encode()) <= 64
+    title = decode_pending_callback(data)[0]['title']
+    assert title and set(title) == {'ж'}
+
+
+def test_overlong_header_drops_paging():
+    pending_filters = {'sort': 'age', 'age': int('9' * 70)}
+    assert encode_pending_callback(pending_filters, 2, 10, True) is None